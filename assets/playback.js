@@ -0,0 +1,208 @@
+// Client side playback for the 3D graph (graph4), loaded automatically by Dash from assets/
+
+function graph4Div() {
+    var graph = document.getElementById('graph4');
+    return graph ? graph.getElementsByClassName('js-plotly-plot')[0] : null;
+}
+
+// Draw one frame, traces is one [x, y, z] per trace in figure order
+function restyleFrame(traces) {
+    var gd = graph4Div();
+    if (!gd || !window.Plotly) {
+        return;
+    }
+    var indices = traces.map(function(t, i) { return i; });
+    window.Plotly.restyle(gd, {
+        x: traces.map(function(t) { return t[0]; }),
+        y: traces.map(function(t) { return t[1]; }),
+        z: traces.map(function(t) { return t[2]; })
+    }, indices);
+}
+
+// base64 little endian float32 bytes (pack_float32 in biomechVis.py) to a Float32Array
+function decodeFloat32(text) {
+    var raw = window.atob(text);
+    var bytes = new Uint8Array(raw.length);
+    for (var i = 0; i < raw.length; i++) {
+        bytes[i] = raw.charCodeAt(i);
+    }
+    return new Float32Array(bytes.buffer);
+}
+
+// [x, y, z] of frame i of a (frames, vertices, 3) Float32Array
+function frameXYZ(data, vertices, i) {
+    var x = new Array(vertices), y = new Array(vertices), z = new Array(vertices);
+    var off = i * vertices * 3;
+    for (var v = 0; v < vertices; v++) {
+        x[v] = data[off + v * 3];
+        y[v] = data[off + v * 3 + 1];
+        z[v] = data[off + v * 3 + 2];
+    }
+    return [x, y, z];
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    biomech: {
+        // Streaming playback: frames come from the server in batches (stream_batch in biomechVis.py)
+        // and wait in a queue that never holds more than config.buffer frames
+        stream_control: function(play, pause, restart, config) {
+            var no_update = window.dash_clientside.no_update;
+            var triggered = window.dash_clientside.callback_context.triggered.map(function(t) {
+                return t.prop_id.split('.')[0];
+            });
+            if (!config) {
+                window.biomechStream = null;
+                return [true, no_update];
+            }
+            var s = window.biomechStream;
+            if (!s || triggered.indexOf('3dStreamConfig') !== -1 || triggered.indexOf('3dStreamRestart') !== -1) {
+                // gen lets late batches from before a restart get ignored
+                s = window.biomechStream = {config: config, queue: [], next: config.start, pending: false,
+                                            gen: s ? s.gen + 1 : 0};
+            }
+            if (triggered.indexOf('3dStreamPlay') === -1 && triggered.indexOf('3dStreamRestart') === -1) {
+                return [true, no_update];
+            }
+            var request = no_update;
+            if (!s.pending && s.next < config.end) {
+                s.pending = true;
+                request = {start: s.next, count: config.batch, layers: config.layers, framerate: config.framerate, gen: s.gen};
+            }
+            return [false, request];
+        },
+
+        stream_tick: function(n_intervals) {
+            var no_update = window.dash_clientside.no_update;
+            var s = window.biomechStream;
+            if (!s) {
+                return [no_update, true];
+            }
+            if (s.queue.length) {
+                restyleFrame(s.queue.shift().traces);
+            } else if (!s.pending && s.next >= s.config.end) {
+                return [no_update, true]; // end of the trial
+            }
+            var request = no_update;
+            if (!s.pending && s.next < s.config.end && s.queue.length + s.config.batch <= s.config.buffer) {
+                s.pending = true;
+                request = {start: s.next, count: s.config.batch, layers: s.config.layers,
+                           framerate: s.config.framerate, gen: s.gen};
+            }
+            return [request, no_update];
+        },
+
+        stream_receive: function(batch) {
+            var s = window.biomechStream;
+            if (!s || !batch || batch.gen !== s.gen) {
+                return window.dash_clientside.no_update;
+            }
+            s.pending = false;
+            var blocks = batch.traces.map(function(t) {
+                return {vertices: t.vertices, data: decodeFloat32(t.data)};
+            });
+            for (var i = 0; i < batch.frames; i++) {
+                s.queue.push({n: batch.start + i, traces: blocks.map(function(b) {
+                    return frameXYZ(b.data, b.vertices, i);
+                })});
+            }
+            s.next = batch.frames ? batch.start + batch.frames : s.config.end;
+            while (s.queue.length > s.config.buffer) {
+                s.queue.shift();
+            }
+            return s.queue.length;
+        },
+
+        // Client playback: the whole trial arrives once (client_trial in biomechVis.py) and every
+        // frame is cut out of the typed arrays here, so play/pause/scrub never touch the server
+        client_load: function(trial) {
+            if (!trial) {
+                window.biomechClient = null;
+                return [1, 0];
+            }
+            window.biomechClient = {
+                frames: trial.frames,
+                markers: trial.markers,
+                points: decodeFloat32(trial.points),
+                lines: trial.lines.map(function(l) {
+                    return {pairs: l.pairs, data: decodeFloat32(l.data)};
+                })
+            };
+            return [Math.max(trial.frames - 1, 1), trial.start];
+        },
+
+        client_frame: function(value) {
+            var c = window.biomechClient;
+            if (!c || value >= c.frames) {
+                return window.dash_clientside.no_update;
+            }
+            var traces = [];
+            // points: markers x [x, y, z]
+            var x = [], y = [], z = [];
+            var off = value * c.markers * 3;
+            for (var m = 0; m < c.markers; m++) {
+                x.push(c.points[off + m * 3]);
+                y.push(c.points[off + m * 3 + 1]);
+                z.push(c.points[off + m * 3 + 2]);
+            }
+            traces.push([x, y, z]);
+            // lines: from, to, NaN gap for every pair
+            c.lines.forEach(function(l) {
+                var lx = [], ly = [], lz = [];
+                var base = value * l.pairs * 6;
+                for (var p = 0; p < l.pairs; p++) {
+                    for (var e = 0; e < 2; e++) {
+                        var o = base + p * 6 + e * 3;
+                        lx.push(l.data[o]);
+                        ly.push(l.data[o + 1]);
+                        lz.push(l.data[o + 2]);
+                    }
+                    lx.push(NaN);
+                    ly.push(NaN);
+                    lz.push(NaN);
+                }
+                traces.push([lx, ly, lz]);
+            });
+            restyleFrame(traces);
+            return value;
+        },
+
+        // Start frame moved without rebuilding the figure (patch_3d_graph in biomechVis.py)
+        // Client mode just moves its slider, embedded mode jumps the Plotly animation so Play continues from there
+        seek_frame: function(seek) {
+            var no_update = window.dash_clientside.no_update;
+            if (!seek) {
+                return no_update;
+            }
+            if (seek.mode === 'client') {
+                return seek.frame;
+            }
+            var name = String(seek.frame);
+            var tries = 0;
+            (function jump() {
+                var gd = graph4Div();
+                var frames = gd && gd._transitionData ? gd._transitionData._frameHash : null;
+                if (frames && frames[name] && window.Plotly) {
+                    window.Plotly.animate(gd, [name], {mode: 'immediate', frame: {duration: 0, redraw: true},
+                                                       transition: {duration: 0}});
+                } else if (tries++ < 50) {
+                    setTimeout(jump, 100); // the new figure may not be drawn yet
+                }
+            })();
+            return no_update;
+        },
+
+        client_play: function(play, pause, trial) {
+            var triggered = window.dash_clientside.callback_context.triggered.map(function(t) {
+                return t.prop_id.split('.')[0];
+            });
+            return triggered.indexOf('3dClientPlay') === -1;
+        },
+
+        client_tick: function(n_intervals, value, max) {
+            if (value >= max) {
+                return [max, true];
+            }
+            return [value + 1, window.dash_clientside.no_update];
+        }
+    }
+});
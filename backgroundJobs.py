@@ -0,0 +1,42 @@
+import functools
+import importlib.util
+import os
+
+from callbackMetrics import metrics
+
+#Results and progress of background callbacks are passed through here
+JOBS_DIR = os.environ.get('BIOMECHVIS_JOBS_DIR', os.path.join(os.path.expanduser('~'), '.biomechvis', 'jobs'))
+#How often the browser asks a running job for its progress (ms)
+JOB_POLL_MS = 250
+#Jobs leave their callback timings here for the serving process (callbackMetrics.py)
+JOB_METRICS_DIR = os.path.join(JOBS_DIR, 'metrics')
+
+def background_manager():
+    '''DiskcacheManager that runs background callbacks in their own process, None when diskcache isn't installed
+    (pip install "dash[diskcache]"), the jobs then run inside the request like before'''
+    if not all(importlib.util.find_spec(m) for m in ('diskcache', 'multiprocess', 'psutil')):
+        return None
+    import diskcache
+    from dash import DiskcacheManager
+    return DiskcacheManager(diskcache.Cache(JOBS_DIR))
+
+def job_callback(app, manager, *dependencies, progress=None, cancel=None, running=None, **kwargs):
+    '''app.callback for a slow job (parsing, building figures), used like @app.callback
+    With a manager it is a background callback: the request returns at once, progress is shown while it runs,
+    a new trigger (or one of the cancel inputs) stops the job it supersedes and the rest of the UI keeps working
+    The decorated function always gets set_progress first, without a manager it runs in the request
+    and set_progress does nothing. metrics.stage calls in a job are recorded in the job's process and sent back
+    (see CallbackMetrics.wrap_job)'''
+    def register(func):
+        if manager is not None:
+            metrics.job_dir = JOB_METRICS_DIR
+            app.callback(*dependencies, background=True, manager=manager, progress=progress,
+                         cancel=cancel, running=running, interval=JOB_POLL_MS, **kwargs)(metrics.wrap_job(func))
+            return func
+
+        @functools.wraps(func)
+        def inline(*args):
+            return func(lambda *value: None, *args)
+        app.callback(*dependencies, running=running, **kwargs)(inline)
+        return func
+    return register
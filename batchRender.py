@@ -0,0 +1,172 @@
+'''Headless batch rendering: every trial in a folder to a self-contained interactive HTML page, no tkinter window or Dash server
+
+    python batchRender.py trials/ -o rendered/ --layers Line "Anatomical Axes" --graph TBCM:X TBCM:Z --graph LFHD:Y
+
+Every .mat file under the folder is grouped into trials by its name with the kind left off
+(Dunk_mocapData.mat, Dunk_SegCOM.mat and Dunk_TBCM_.mat are trial Dunk, see files_by_kind in biomechVis.py)
+Each page has the 3D animation (Play/Pause/Restart like Embedded Frames) and one 2D graph per --graph over frames,
+written to the output folder with the same subfolders as the input
+Trials are rendered at the same time in a process pool, pages newer than all of their files are skipped unless --force
+'''
+import argparse
+import html
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import plotly.graph_objects as go
+import plotly.io as pio
+
+import biomechVis
+from matIngest import warm_sidecars
+from sessionStore import Session
+from trialBatch import trial_name
+
+LAYERS = ('Line', 'Anatomical Axes', 'Vector')
+LINE_COLORS = ('#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd', '#8c564b')
+
+def find_trials(folder):
+    '''{relative output path without extension: list of files} for every trial with mocap data under folder'''
+    groups = {}
+    for dirpath, _, filenames in os.walk(folder):
+        for filename in sorted(filenames):
+            if not filename.casefold().endswith('.mat'):
+                continue
+            name = trial_name(filename)
+            if name is None:
+                continue
+            relative = os.path.relpath(dirpath, folder)
+            #a trial whose files are only named by kind (mocapData.mat) is named after its folder
+            name = name or (os.path.basename(os.path.abspath(dirpath)) if relative == '.' else os.path.basename(relative))
+            groups.setdefault(os.path.normpath(os.path.join(relative, name)), []).append(os.path.join(dirpath, filename))
+    trials = {}
+    for key, files in sorted(groups.items()):
+        if biomechVis.files_by_kind(files)['MocapData']:
+            trials[key] = files
+        else:
+            print("skipping", key, "(no mocap data file)")
+    return trials
+
+def parse_graph(text):
+    '''--graph value (POINT:XYZ ...) as a 2D graph spec like add_new_graph keeps, x is always frames'''
+    lines = []
+    for line in text:
+        point, _, xyz = line.rpartition(':')
+        if not point or xyz.upper() not in ('X', 'Y', 'Z'):
+            raise argparse.ArgumentTypeError(f"2D graph lines are POINT:X, POINT:Y or POINT:Z, not {line}")
+        lines.append([point, xyz.upper()])
+    return {'x': ['frames', 'X'], 'lines': lines}
+
+#The page has no seek_frame (assets/playback.js), this moves the animation to the start frame once it is drawn
+#so Play (fromcurrent) goes on from there instead of from frame 0
+SEEK_SCRIPT = ("Plotly.animate(document.getElementById('{plot_id}'), ['%d'], "
+               "{mode: 'immediate', frame: {duration: 0, redraw: true}, transition: {duration: 0}});")
+
+def drawn_start(session, start):
+    '''Frame of the undersampled drawing the animation starts on'''
+    return min(start // session.framerate, session.drawn.frame_count - 1)
+
+def figure_3d(session, start, layers):
+    '''The 3D figure draw_3d_graph makes for Embedded Frames playback'''
+    start = drawn_start(session, start)
+    lines = biomechVis.layer_lines(session.points, session.axes, session.vectors, layers)
+    plot = biomechVis.base_plot(session.drawn, start, animate=True, lines=lines)
+    plot.update_layout(height=800)
+    return plot
+
+def figure_2d(session, spec, height=300):
+    '''One 2D graph over frames like add_new_graph, at full resolution since there is no server to refetch zooms from'''
+    fig = go.Figure()
+    for i, (point, xyz) in enumerate(spec['lines']):
+        series = biomechVis.graph_series(session, point)
+        if series is None or np.size(series) == 0: #missing, or its file wasn't given (ex: no TBCMVeloc)
+            print(f"  {point} is not in this trial, left out of its 2D graph")
+            continue
+        y = biomechVis.series_2d(session, point, xyz)
+        fig.add_trace(go.Scatter(x=list(range(len(y))), y=y, mode='markers+lines',
+                                 line=dict(color=LINE_COLORS[i % len(LINE_COLORS)]), name=f"{point} {xyz}"))
+    y_title = ", ".join(point + "_" + xyz for point, xyz in spec['lines'])
+    fig.update_layout(title=y_title + " Plotted Over Frames", xaxis_title="Frames", yaxis_title=y_title, height=height)
+    return fig
+
+def render_trial(name, files, out_path, framerate, start, layers, graphs):
+    '''Write the page of one trial, runs in a pool worker. Returns (name, seconds)'''
+    began = time.perf_counter()
+    session = Session(biomechVis.files_by_kind(files))
+    biomechVis.load_session(session, framerate)
+    figures = [figure_3d(session, start, layers)] + [figure_2d(session, spec) for spec in graphs]
+    #plotly.js goes in once with the first figure, so the page opens without a network connection
+    parts = [pio.to_html(fig, include_plotlyjs=(i == 0), full_html=False,
+                         post_script=SEEK_SCRIPT % drawn_start(session, start) if i == 0 else None)
+             for i, fig in enumerate(figures)]
+    os.makedirs(os.path.dirname(out_path) or '.', exist_ok=True)
+    tmp = out_path + '.tmp'
+    title = html.escape(name)
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write('<!DOCTYPE html>\n<html>\n<head><meta charset="utf-8"><title>' + title + '</title></head>\n<body>\n')
+        f.write('<h2>' + title + '</h2>\n')
+        f.write('\n'.join(parts))
+        f.write('\n</body>\n</html>\n')
+    os.replace(tmp, out_path)
+    return name, time.perf_counter() - began
+
+def up_to_date(out_path, files):
+    try:
+        return os.stat(out_path).st_mtime >= max(os.stat(f).st_mtime for f in files)
+    except OSError:
+        return False
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render every trial in a folder to self-contained interactive HTML")
+    parser.add_argument('folder', help="folder of trial .mat files (searched recursively)")
+    parser.add_argument('-o', '--out', default='rendered', help="folder the pages are written to (default: rendered)")
+    parser.add_argument('--framerate', type=int, default=biomechVis.frameRate,
+                        help=f"draw every nth frame in the 3D animation (default: {biomechVis.frameRate})")
+    parser.add_argument('--start', type=int, default=0, help="first frame of the 3D animation (default: 0)")
+    parser.add_argument('--layers', nargs='*', choices=LAYERS, default=[],
+                        help="layers drawn on top of the points in the 3D graph")
+    parser.add_argument('--graph', nargs='+', action='append', default=[], metavar='POINT:XYZ',
+                        help="add a 2D graph with one line per POINT:XYZ (ex: --graph TBCM:X TBCM:Z), can be repeated")
+    parser.add_argument('-j', '--workers', type=int, default=None, help="worker processes (default: one per core)")
+    parser.add_argument('--force', action='store_true', help="render pages that are already newer than their files too")
+    args = parser.parse_args(argv)
+
+    try:
+        graphs = [parse_graph(graph) for graph in args.graph]
+    except argparse.ArgumentTypeError as error:
+        parser.error(str(error))
+    if args.framerate < 1:
+        parser.error("--framerate must be at least 1")
+
+    trials = find_trials(args.folder)
+    todo = {name: files for name, files in trials.items()
+            if args.force or not up_to_date(os.path.join(args.out, name + '.html'), files)}
+    print(f"{len(trials)} trials, {len(trials) - len(todo)} already rendered, {len(todo)} to render")
+    if not todo:
+        return 0
+
+    workers = min(len(todo), args.workers or os.cpu_count() or 1)
+    #parse every file once up front (a pool over all of them), the renders below then just map the sidecars
+    kinds = {'TBCM': 'array', 'TBCMVeloc': 'array'}
+    warm_sidecars([(kinds.get(kind, 'struct'), f) for files in todo.values()
+                   for kind, paths in biomechVis.files_by_kind(files).items() for f in paths], workers)
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(render_trial, name, files, os.path.join(args.out, name + '.html'),
+                               args.framerate, args.start, args.layers, graphs): name
+                   for name, files in todo.items()}
+        for future in as_completed(futures):
+            try:
+                name, seconds = future.result()
+                print(f"rendered {name} ({seconds:.1f}s)")
+            except Exception as error: #one bad trial doesn't stop the batch
+                failed += 1
+                print(f"failed {futures[future]}: {type(error).__name__}: {error}")
+    print(f"{len(todo) - failed} rendered, {failed} failed")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
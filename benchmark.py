@@ -0,0 +1,294 @@
+'''Benchmarks of the hot paths on synthetic trials of several sizes, results as JSON to compare across commits
+
+    python benchmark.py -o before.json
+    (change things)
+    python benchmark.py -o after.json --compare before.json
+
+Every scale (markers x frames, ex: --scale 500x10000) gets a synthetic MocapData/SegCOM/AnatAx/TBCM/TBCMVeloc trial
+written as .mat files to a temp folder. Each step is timed --repeat times (seconds, median and min) and then run
+once more under tracemalloc for its peak memory, figures also get the size of their JSON
+Loads are timed cold (no sidecar, empty trial_cache), from the sidecars and from trial_cache
+Startup is timed in fresh processes: importing biomechVis (all that runs before the launch window opens) and
+serving the first page (import, reading the launch trial from its sidecars, create_app and the first requests).
+--startup only runs those, and the run fails when importing takes longer than --import-budget
+'''
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import plotly
+import plotly.io as pio
+import scipy.io as sio
+
+import biomechVis
+import matSidecar
+from sessionStore import Session
+
+#markers x frames, the biggest default trial is about the size of a long capture
+DEFAULT_SCALES = ('50x1000', '50x10000', '50x100000', '500x1000', '500x10000')
+#Seconds importing biomechVis may take before the run fails (the launch window waits for it)
+IMPORT_BUDGET = 0.5
+#Modules that should only be imported once their code path runs, listed in the report when an import pulls them in
+HEAVY_MODULES = ('dash', 'dash_bootstrap_components', 'plotly', 'pandas', 'scipy.io', 'tkinter', 'h5py', 'flask')
+#Runs in a fresh process for each startup measurement, the launch files are its arguments
+STARTUP_SCRIPT = '''
+import json, sys, time
+began = time.perf_counter()
+import biomechVis
+imported = time.perf_counter()
+heavy = [m for m in %r if m in sys.modules]
+biomechVis.filesList = biomechVis.files_by_kind(sys.argv[1:])
+biomechVis.read_Mitchell_data(biomechVis.frameRate, biomechVis.filesList)
+client = biomechVis.create_app().server.test_client()
+for path in ('/', '/_dash-layout', '/_dash-dependencies'):
+    client.get(path)
+served = time.perf_counter()
+print(json.dumps({'import': imported - began, 'first_page': served - began, 'heavy': heavy}))
+''' % (HEAVY_MODULES,)
+
+def parse_scale(text):
+    markers, _, frames = text.partition('x')
+    try:
+        markers, frames = int(markers), int(frames)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"scales are MARKERSxFRAMES (ex: 50x1000), not {text}")
+    if markers < 2 or frames < 2:
+        raise argparse.ArgumentTypeError("a scale needs at least 2 markers and 2 frames")
+    return markers, frames
+
+def write_trial(folder, markers, frames, seed=0):
+    '''Write a synthetic trial of markers mocap points over frames to folder, returns its filesList style dict
+    Points sway around random spots, there is one segment (COM and rotating anatomical axes) per 10 markers'''
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder, exist_ok=True)
+    t = np.arange(frames) / 100.0
+    def sway(count):
+        base = rng.uniform([-1, -1, 0], [1, 1, 2], size=(count, 3))
+        phase = rng.uniform(0, 2 * np.pi, size=(count, 3))
+        return {i: base[i] + 0.3 * np.sin(2 * np.pi * 0.5 * t[:, None] + phase[i]) for i in range(count)}
+
+    mocap = {f'M{i:03d}': xyz for i, xyz in sway(markers).items()}
+    segments = max(2, markers // 10)
+    coms = {f'S{i:03d}': xyz for i, xyz in sway(segments).items()}
+    anat = {}
+    for name in coms:
+        angle = rng.uniform(0, 2 * np.pi) + t
+        zeros, ones = np.zeros(frames), np.ones(frames)
+        #[x axis, y axis, z axis][x, y, z] over frames
+        anat[name] = np.array([[np.cos(angle), np.sin(angle), zeros],
+                               [-np.sin(angle), np.cos(angle), zeros],
+                               [zeros, zeros, ones]])
+    tbcm = np.mean(list(coms.values()), axis=0)
+
+    files = {}
+    for kind, name, data in (('MocapData', 'mocapData', mocap), ('SegCOM', 'SegCOM', coms), ('AnatAx', 'AnatAx', anat),
+                             ('TBCM', 'TBCM_', tbcm), ('TBCMVeloc', 'TBCMVeloc', np.gradient(tbcm, axis=0))):
+        path = os.path.join(folder, f'synthetic_{name}.mat')
+        sio.savemat(path, {'Data': data})
+        files[kind] = [path]
+    return files
+
+def measure(step, repeat, setup=lambda: None):
+    '''Time step(setup()) repeat times, then once more under tracemalloc for the peak memory
+    setup runs before every call and isn't timed. Returns the result dict and the last value step returned'''
+    times = []
+    for _ in range(repeat):
+        arg = setup()
+        began = time.perf_counter()
+        value = step(arg)
+        times.append(time.perf_counter() - began)
+    arg = setup()
+    tracemalloc.start()
+    try:
+        value = step(arg)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'seconds': times, 'median': statistics.median(times), 'min': min(times), 'peak_bytes': peak}, value
+
+def bench_scale(markers, frames, repeat, framerate, workdir):
+    '''Every benchmark of one scale, a list of result dicts'''
+    folder = os.path.join(workdir, f'{markers}x{frames}')
+    files = write_trial(folder, markers, frames)
+    mocap_file = files['MocapData']
+    sidecars = os.path.join(folder, 'sidecars')
+    matSidecar.SIDECAR_DIR = sidecars
+    cache = biomechVis.trial_cache
+
+    def cold():
+        cache.clear()
+        shutil.rmtree(sidecars, ignore_errors=True)
+    def warm():
+        cache.clear()
+    results = []
+    def record(name, result, figure=None):
+        result = dict(result, name=name, markers=markers, frames=frames)
+        if figure is not None:
+            result['json_bytes'] = len(pio.to_json(figure, validate=False))
+        results.append(result)
+        print(f"  {name:<32} {result['median'] * 1000:10.1f} ms  peak {result['peak_bytes'] / 2**20:8.1f} MB", file=sys.stderr)
+
+    record('load_from_mat (parse)', measure(lambda _: biomechVis.load_from_mat(mocap_file, {}), repeat, cold)[0])
+    record('load_from_mat (sidecar)', measure(lambda _: biomechVis.load_from_mat(mocap_file, {}), repeat, warm)[0])
+    record('load_from_mat (cached)', measure(lambda _: biomechVis.load_from_mat(mocap_file, {}), repeat)[0])
+    read = lambda _: biomechVis.read_Mitchell_data(framerate, files)
+    record('read_Mitchell_data (parse)', measure(read, repeat, cold)[0])
+    record('read_Mitchell_data (sidecar)', measure(read, repeat, warm)[0])
+    result, data = measure(read, repeat)
+    record('read_Mitchell_data (cached)', result)
+    points, axes = data[0], data[1]
+
+    result, drawn = measure(lambda _: biomechVis.filter_points_to_draw(points, points.point_names()[:1]), repeat)
+    record('filter_points_to_draw', result)
+    drawn = biomechVis.filter_points_to_draw(points)
+
+    result, plot = measure(lambda _: biomechVis.base_plot(drawn, 0, animate=True), repeat)
+    record('base_plot (embedded frames)', result, plot)
+    result, streamed = measure(lambda _: biomechVis.base_plot(drawn, 0, animate=False), repeat)
+    record('base_plot (first frame)', result, streamed)
+
+    #a line between every pair of neighbouring markers, like a skeleton
+    names = points.point_names()
+    froms, tos = [points.series(n) for n in names[:-1]], [points.series(n) for n in names[1:]]
+    fresh = lambda: biomechVis.base_plot(drawn, 0, animate=True)
+    result, lined = measure(lambda plot: biomechVis.draw_line(plot, froms, tos, 0), repeat, fresh)
+    record('draw_line', result, lined)
+    result, lined = measure(lambda _: biomechVis.base_plot(drawn, 0, animate=True, lines=[(froms, tos, 'red', 'lines')] * 3), repeat)
+    record('base_plot (embedded frames, 3 lines)', result, lined)
+    result, axed = measure(lambda plot: biomechVis.draw_anat_ax(plot, axes, points.coms(), 0), repeat, fresh)
+    record('draw_anat_ax', result, axed)
+
+    session = Session(files)
+    biomechVis.load_session(session, framerate)
+    spec = {'x': ['frames', 'X'], 'lines': [[name, 'X'] for name in names[:3]]}
+    colors = ['#000000'] * len(spec['lines'])
+    result, graph = measure(lambda _: biomechVis.new_graph_figure(session, spec, colors), repeat)
+    record('add_new_graph figure', result, graph)
+    cache.clear()
+    return results
+
+def run_startup(files, env):
+    '''One fresh process through STARTUP_SCRIPT, returns its timings and its max RSS'''
+    before = max_rss_bytes(children=True)
+    out = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT] + files, capture_output=True, text=True, env=env,
+                         cwd=os.path.dirname(os.path.abspath(__file__)))
+    if out.returncode != 0:
+        raise RuntimeError("startup run failed:\n" + out.stderr)
+    return json.loads(out.stdout.strip().splitlines()[-1]), max_rss_bytes(children=True) or before
+
+def bench_startup(repeat, workdir):
+    '''Import and first page times of fresh processes on a small synthetic trial, a list of result dicts
+    The first run writes the sidecars and isn't counted'''
+    files = write_trial(os.path.join(workdir, 'startup'), 50, 1000)
+    files = [f for kind in files for f in files[kind]]
+    env = dict(os.environ, BIOMECHVIS_CACHE_DIR=os.path.join(workdir, 'startup', 'sidecars'),
+               BIOMECHVIS_SESSION_DIR=os.path.join(workdir, 'startup', 'sessions'),
+               BIOMECHVIS_JOBS_DIR=os.path.join(workdir, 'startup', 'jobs'), BIOMECHVIS_WATCH_DIR='')
+    run_startup(files, env)
+    runs = [run_startup(files, env) for _ in range(repeat)]
+    results = []
+    for key, name in (('import', 'startup: import biomechVis'), ('first_page', 'startup: first page served')):
+        times = [timings[key] for timings, _ in runs]
+        #the children's max RSS is the biggest of any of them, the same for both
+        result = {'seconds': times, 'median': statistics.median(times), 'min': min(times), 'peak_bytes': runs[-1][1] or 0,
+                  'name': name, 'markers': 0, 'frames': 0}
+        if key == 'import':
+            result['heavy_modules'] = runs[-1][0]['heavy']
+        results.append(result)
+        print(f"  {name:<32} {result['median'] * 1000:10.1f} ms", file=sys.stderr)
+    if results[0]['heavy_modules']:
+        print("  importing biomechVis pulled in", ', '.join(results[0]['heavy_modules']), file=sys.stderr)
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def max_rss_bytes(children=False):
+    try:
+        import resource
+    except ImportError: #Windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+def compare(report, baseline):
+    '''Print median time and peak memory of every result against the same result in an older report'''
+    old = {(r['name'], r['markers'], r['frames']): r for r in baseline['results']}
+    print(f"vs {baseline['meta'].get('commit')}")
+    for r in report['results']:
+        before = old.get((r['name'], r['markers'], r['frames']))
+        if before is None:
+            continue
+        scale = f"{r['markers']:>4}x{r['frames']:<7}" if r['markers'] else f"{'':12}"
+        print(f"  {scale} {r['name']:<32} time x{r['median'] / max(before['median'], 1e-9):6.2f}"
+              f"  memory x{r['peak_bytes'] / max(before['peak_bytes'], 1):6.2f}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark BiomechVis on synthetic trials, results are written as JSON")
+    parser.add_argument('--scale', type=parse_scale, action='append', metavar='MARKERSxFRAMES',
+                        help=f"trial size to run, can be repeated (default: {' '.join(DEFAULT_SCALES)})")
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs of each step (default: 3)")
+    parser.add_argument('--framerate', type=int, default=biomechVis.frameRate,
+                        help=f"framerate the trial is drawn at (default: {biomechVis.frameRate})")
+    parser.add_argument('-o', '--out', help="write the JSON here instead of stdout")
+    parser.add_argument('--compare', help="an earlier JSON report to print the changes against")
+    parser.add_argument('--keep', action='store_true', help="keep the synthetic trials (their folder is printed)")
+    parser.add_argument('--startup', action='store_true', help="only time the startup (import and first page)")
+    parser.add_argument('--import-budget', type=float, default=IMPORT_BUDGET,
+                        help=f"fail when importing biomechVis takes longer than this many seconds, 0 never fails (default: {IMPORT_BUDGET})")
+    args = parser.parse_args(argv)
+    scales = [] if args.startup else args.scale or [parse_scale(s) for s in DEFAULT_SCALES]
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+
+    workdir = tempfile.mkdtemp(prefix='biomechvis-bench-')
+    sidecar_dir = matSidecar.SIDECAR_DIR
+    results = []
+    try:
+        print("startup", file=sys.stderr)
+        results += bench_startup(args.repeat, workdir)
+        for markers, frames in scales:
+            print(f"{markers} markers x {frames} frames", file=sys.stderr)
+            results += bench_scale(markers, frames, args.repeat, args.framerate, workdir)
+    finally:
+        matSidecar.SIDECAR_DIR = sidecar_dir
+        if args.keep:
+            print("trials kept in", workdir, file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {'meta': {'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                       'python': platform.python_version(), 'numpy': np.__version__, 'plotly': plotly.__version__,
+                       'platform': platform.platform(), 'repeat': args.repeat, 'framerate': args.framerate,
+                       'max_rss_bytes': max_rss_bytes()},
+              'results': results}
+    text = json.dumps(report, indent=1)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+    imported = results[0]['median']
+    if args.import_budget and imported > args.import_budget:
+        print(f"importing biomechVis took {imported:.2f}s, over the {args.import_budget:.2f}s budget", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,16 +1,23 @@
-import plotly.express as px
-import plotly.graph_objects as go
-import scipy.io as sio
+#dash, plotly, scipy.io and tkinter are imported where they are used so the launch window opens quickly
+#(python benchmark.py --startup tracks it)
 import numpy as np
-import pandas as pd
 import sys
-from dash import Dash, dcc, html, Input, Output, State, callback_context, MATCH, no_update, ALL
-import dash_bootstrap_components as dbc
-import plotly.express as px
 import os
-import tkinter as tk
-from tkinter import filedialog
-from dash.exceptions import PreventUpdate
+from trialCache import TrialCache, file_key
+from trialStore import build_trial_store
+from trialPyramid import TrialPyramid
+from trialKinematics import KinematicSeries, kinematics_kind
+from trialBatch import group_trials, stack_trials, align_trials, mean_sd
+from trialWatcher import TrialWatcher, WATCH_DIR, WATCH_POLL_S
+from seriesDownsample import lttb, window
+from uploadSpool import spool_upload, touch_uploads
+from sessionStore import Session, SessionStore, SessionExpired, new_session_id, SESSION_DIR
+from matSidecar import load_store, load_derived, load_batch
+from matHdf5 import is_v73
+from matIngest import parse_struct, parse_array, warm_sidecars
+from callbackMetrics import metrics, DEBUG_PANEL
+from figureEncoding import typed_array, pack_float32, HTTP_COMPRESSION
+from backgroundJobs import background_manager, job_callback
 
 #TODO color groups more distinctly 
 #want the df to hold group names instead of a numerical id for the group names
@@ -18,15 +25,33 @@ from dash.exceptions import PreventUpdate
 #TODO want a bar for the frame number
 #TODO plot axis
 # note we can use the add trace thing to make it so you can click to show points/groups and lines
-global numOf2dGraphs, all_points_for_2D_graphs, mocap_data_2D_graphs, TBCM_2D_graphs, TBCMVeloc_2D_graphs, selected_y_axis_point_2D, file_list_2D
-numOf2dGraphs= 0
-global newGraphNumOfLines
-newGraphNumOfLines=1
+#files picked at launch, every new session (browser tab) starts on these
 global filesList
 filesList = {}
 filesList = {'AnatAx' : [], 'SegCOM': [], 
              'TBCM' : [], 'TBCMVeloc' : [],
              'MocapData' : []}
+global trial_cache
+trial_cache = TrialCache() #parsed files and built trials, keyed by path/mtime/size
+#trial and 2D graph state of each browser tab, keyed by the session-id store in the layout
+sessions = SessionStore()
+#new trials landing in the capture folder are parsed while the app runs (BIOMECHVIS_WATCH_DIR, see trialWatcher.py)
+watcher = TrialWatcher(WATCH_DIR, lambda paths: ingest_files(paths)) if WATCH_DIR else None
+
+#X, Y, Z anatomical axes are drawn red, green, blue (vertex values 0, 1, 2)
+AXIS_COLORSCALE = [[0, 'red'], [0.5, 'green'], [1, 'blue']]
+
+#Streaming playback, frames per request / max frames buffered in the browser / ms per frame
+STREAM_BATCH = 30
+STREAM_BUFFER = 120
+STREAM_TICK_MS = 50
+
+#Layers of the 3D graph with line traces, Embedded Frames figures have all of them (see patch_3d_graph)
+LINE_LAYERS = ('Line', 'Anatomical Axes', 'Vector')
+
+#Coarse framerates average the frames they skip instead of just dropping them
+#Off the framerate levels are views of the trial, on they are copies kept in a sidecar (about 94% more memory and disk)
+PYRAMID_AVERAGE = False
 
 # Change each field to be an array; append to the array when adding fields 
 # Wipe arrays clean when changing files from other thing
@@ -36,48 +61,89 @@ filesList = {'AnatAx' : [], 'SegCOM': [],
 
 def load_from_mat(filenames=None, data={}, loaded=None):
     '''Turn .mat file to nested dict of all values
-    Pulled from https://stackoverflow.com/questions/62995712/extracting-mat-files-with-structs-into-python'''
+    Pulled from https://stackoverflow.com/questions/62995712/extracting-mat-files-with-structs-into-python
+    Each file is only parsed once, after that it comes out of trial_cache until it changes on disk
+    Across launches the parse is memory mapped from its sidecar (see matSidecar)
+    v7.3 files are opened lazily instead (see matHdf5), nothing is read until it is sliced'''
     for filename in filenames:
         if filename:
-            vrs = sio.whosmat(filename)
-            #name = vrs[0][0]
-            loaded = sio.loadmat(filename,struct_as_record=True)
-            if 'Data' in loaded.keys():
-                loaded = loaded["Data"] #Data is labeled differently, so just specified data field - Nick
-
-        whats_inside = loaded.dtype.fields
-        fields = list(whats_inside.keys())
-        for field in fields:
-            if len(loaded[0,0][field].dtype) > 0: # it's a struct
-                data[field] = {}
-                data[field] = load_from_mat(data=data[field], loaded=loaded[0,0][field])
-            else: # it's a variable
-                data[field] = loaded[0,0][field]
+            parsed = trial_cache.get(('struct',) + file_key(filename), lambda: parse_struct(filename), [filename])
+            data.update(parsed)
 
     return data
 
 def load_from_mat2(filenames):
-    noDataInit = True
-    for filename in filenames:
-        fileData = sio.loadmat(filename, struct_as_record=True)['Data']
-        if (noDataInit):
-            data = fileData
-            noDataInit = False
-        else:
-            data = np.concatenate((data, fileData)) #We dont care about order, just add em together
-    return data
-
-def read_Mitchell_data(framerate):
+    '''Data arrays of the files one after the other (TBCM, TBCMVeloc), each file is cached like load_from_mat'''
+    arrays = [trial_cache.get(('array',) + file_key(filename), lambda: parse_array(filename), [filename])
+              for filename in filenames]
+    if len(arrays) == 1:
+        return arrays[0]
+    return np.concatenate(arrays) #We dont care about order, just add em together (one copy for all the files)
+
+def trial_key(files):
+    '''Cache key for the full trial built from files (a filesList style dict)'''
+    return ('trial',) + tuple((kind, tuple(file_key(f) for f in files[kind])) for kind in sorted(files))
+
+def read_Mitchell_data(framerate, files, progress=None):
     '''Read Mitchell data 
-    Specified as a folder with hardcoded to contain exactly the five sample folders for now
-    Folder path is sys.argv[1]
-    Returns dictonary of COM dfs and dictonary of points dfs'''
+    files is a filesList style dict (kind => list of paths)
+    The full resolution trial and its temporal pyramid (trialPyramid.py) are cached so changing the framerate/start frame only re-slices
+    Returns the undersampled TrialStore (points and COMs), axes and vectors, then the full resolution data for the 2D graphs
+    (the last one is the derived signals, computed when a graph reads them, see trialKinematics.py)
+    progress(text) is told what is being done, for the progress shown by background jobs (backgroundJobs.py)'''
+    progress = progress or (lambda text: None)
+    paths = [f for kind in files for f in files[kind]]
+    trial = trial_cache.get(trial_key(files), lambda: build_trial(files, progress), paths)
+    store, axes, vectors, noVectors, TBCM, TBCMVeloc, files_2D = trial
+
+    #every framerate is served from the precomputed pyramid level closest to it
+    progress("Building framerate levels")
+    pyramid = trial_cache.get(('pyramid', trial_key(files), PYRAMID_AVERAGE),
+                              lambda: build_pyramid(store, axes, vectors if noVectors else {}, paths), paths)
+    undersampled_store, undersampled_axes, undersampled_vectors = pyramid.undersample(framerate)
+
+    #2D graphs read (frames, 3) views straight out of the store
+    mocap_points = store.as_dict(store.point_names())
+    all_points = dict(mocap_points)
+    all_points['TBCM'] = TBCM
+    all_points['TBCMVeloc'] = TBCMVeloc
+
+    #velocities, accelerations, speeds, distances and segment angles, each one only computed when a graph asks for it
+    kinematics = trial_cache.get((kinematics_kind(), trial_key(files)), lambda: build_kinematics(store, axes, TBCM), paths)
+    if kinematics:
+        files_2D = files_2D + [{"label": "Derived", "value": "Derived"}]
+
+    return undersampled_store, undersampled_axes, undersampled_vectors, all_points, mocap_points, {"TBCM": TBCM} , {"TBCMVeloc": TBCMVeloc}, files_2D, kinematics
+
+def build_kinematics(store, axes, TBCM):
+    '''Derived signals of a trial (trialKinematics.py), named now and computed series by series
+    v7.3 trials get none, every marker would have to be read from disk'''
+    if not isinstance(store.positions, np.ndarray):
+        return {}
+    return KinematicSeries(store, axes, TBCM)
+
+def build_pyramid(store, axes, vectors, sources):
+    '''TrialPyramid of a trial, averaged levels are memory mapped from a sidecar so worker processes share them (wsgi.py)'''
+    if not PYRAMID_AVERAGE or not isinstance(store.positions, np.ndarray): #strided views (lazy ones for v7.3), nothing to save
+        return TrialPyramid(store, axes, vectors, average=PYRAMID_AVERAGE)
+    levels = load_derived('pyramid-avg', sources,
+                          lambda: TrialPyramid(store, axes, vectors, average=PYRAMID_AVERAGE).saved_levels())
+    return TrialPyramid(store, axes, vectors, average=PYRAMID_AVERAGE, levels=levels)
+
+def build_trial(filesList, progress=lambda text: None):
+    '''Load every file in filesList and build the full resolution (not undersampled) trial
+    Returns the TrialStore, axes, vectors, noVectors, TBCM, TBCMVeloc and the 2D file options'''
     #TODO update to take general file names in given folder
     #Note: The data dict in load_from_math seems to carry over somehow? If I don't set it to {} Then SegCOM will change once we read MocapData for example - Gavin
     #folder_path = sys.argv[1]
 
     files_2D = [{"label": "Mocap Data", "value": "Mocap"}]
 
+    #parse every file that isn't cached yet at the same time, the loads below then just map the sidecars
+    warm_sidecars(ingest_jobs(filesList),
+                  progress=lambda done, total, f: progress(f"Parsed {os.path.basename(f)} ({done}/{total})"))
+    progress("Reading files")
+
     # AnatAx => key = seg name, val = 3x3xN array for location so [frame][x_axis,y_axis,z_axis][x,y,z]   
     if len(filesList['AnatAx']) == 0:
         AnatAx = {}
@@ -105,21 +171,23 @@ def read_Mitchell_data(framerate):
     # MocapData => key = point name, val = Nx3 array for location
     MocapData = load_from_mat(filesList['MocapData'], {})
 
-    #make dictonary of points dfs indexed by point name
-    final_points = {}
-    for i, name in enumerate(MocapData):
-        points = MocapData[name]
-        tag = np.full((points.shape[0], 1), i + 1) #id for later (eventually should be segment based rn its point based)
-        points = np.append(points, tag, 1)
-        final_points[name] = points
-
-    #make COM dict 
-    COMs = {}
-    for name in SegCOM:
-        points = SegCOM[name]
-        tag = np.full((points.shape[0], 1), 0) #0 tag for COMs
-        points = np.append(points, tag, 1)
-        COMs[name] = points
+    #one (frames, markers, 3) array for all points and COMs, segment id is point based for now (COMs are 0)
+    #memory mapped from the store sidecar so only the frames that get drawn are paged in
+    #v7.3 files skip the sidecar, their markers are already read lazily window by window
+    store_sources = filesList['MocapData'] + filesList['SegCOM']
+    progress("Building trial")
+    if any(is_v73(f) for f in store_sources):
+        store = build_trial_store(MocapData, SegCOM)
+    else:
+        store = load_store(store_sources, lambda: build_trial_store(MocapData, SegCOM))
+
+    #axes and vector ends are computed, they get a sidecar too so every worker process maps the same copy (wsgi.py)
+    derived_sources = filesList['AnatAx'] + filesList['SegCOM'] + filesList['TBCM'] + filesList['TBCMVeloc']
+    build = lambda: {'axes': build_axes(AnatAx, SegCOM), 'TBCMEnd': TBCM + TBCMVeloc if len(TBCM) != 0 and len(TBCMVeloc) != 0 else []}
+    if derived_sources and not any(is_v73(f) for f in derived_sources):
+        derived = load_derived('derived', derived_sources, build)
+    else:
+        derived = build()
 
     vectors = {}
     #TODO change from hardcoded
@@ -128,15 +196,77 @@ def read_Mitchell_data(framerate):
     noVectors = False
     vectors['TBCM'][0] = TBCM
     if (len(TBCM) != 0 and len(TBCMVeloc) != 0):
-        vectors['TBCM'][1] = TBCM + TBCMVeloc
+        vectors['TBCM'][1] = derived['TBCMEnd']
         noVectors = True
 
+    axes = derived.get('axes', {})
+
+    return store, axes, vectors, noVectors, TBCM, TBCMVeloc, files_2D
+
+def ingest_jobs(filesList):
+    '''(parse kind, file) of every file in filesList that isn't in trial_cache yet, for warm_sidecars'''
+    jobs = [('struct', f) for kind in ('AnatAx', 'SegCOM', 'MocapData') for f in filesList[kind]] \
+        + [('array', f) for kind in ('TBCM', 'TBCMVeloc') for f in filesList[kind]]
+    return [(kind, f) for kind, f in jobs if (kind,) + file_key(f) not in trial_cache]
+
+def load_trial_batch(trials, progress=lambda text: None):
+    '''TrialBatch (trialBatch.py) of several trials, trials is {trial name: filesList style dict}
+    Each trial is built and cached like read_Mitchell_data does, the files of every trial are parsed at the same time first
+    The stacked batch is kept in a sidecar, so redrawing the comparison in another process only maps it'''
+    names = sorted(trials)
+    paths = [f for name in names for kind in trials[name] for f in trials[name][kind]]
+    touch_uploads(paths)
+    def build():
+        warm_sidecars([job for name in names for job in ingest_jobs(trials[name])],
+                      progress=lambda done, total, f: progress(f"Parsed {os.path.basename(f)} ({done}/{total})"))
+        stores = []
+        for i, name in enumerate(names):
+            progress(f"Building trial {name} ({i + 1}/{len(names)})")
+            files = trials[name]
+            trial = trial_cache.get(trial_key(files), lambda: build_trial(files), [f for kind in files for f in files[kind]])
+            stores.append(trial[0])
+        progress("Stacking trials")
+        return stack_trials(stores, names)
+    return trial_cache.get(('batch',) + tuple((name, trial_key(trials[name])) for name in names),
+                           lambda: load_batch(paths, build), paths)
+
+def comparison_figure(batch, label, xyz, alignment, show=('trials', 'mean'), event=None):
+    '''One 2D figure of label's xyz coordinate in every trial of batch (TrialBatch), lined up the way alignment says
+    (trialBatch.ALIGNMENTS). show picks the trial overlays and/or the mean with a +-1 SD band
+    event is the (marker, xyz) signal max/min look for (ex: the lowest heel Z for foot contact), the compared one by default'''
+    import plotly.graph_objects as go
+    values = batch.series(label)[:, :, 'XYZ'.index(xyz)]
+    event_label, event_xyz = event or (label, xyz)
+    signal = batch.series(event_label)[:, :, 'XYZ'.index(event_xyz)]
+    aligned, x = align_trials(values, batch.lengths, alignment, signal)
+    fig = go.Figure()
+    if 'mean' in show:
+        mean, sd, count = mean_sd(aligned)
+        band = count > 0
+        fig.add_trace(go.Scatter(x=np.concatenate([x[band], x[band][::-1]]),
+                                 y=np.concatenate([(mean + sd)[band], (mean - sd)[band][::-1]]),
+                                 fill='toself', fillcolor='rgba(77, 162, 247, 0.3)', line=dict(width=0),
+                                 hoverinfo='skip', name="Mean ± SD"))
+    if 'trials' in show:
+        for t, name in enumerate(batch.names):
+            fig.add_trace(go.Scatter(x=x, y=aligned[t], mode='lines', line=dict(width=1), opacity=0.7, name=name or "(unnamed)"))
+    if 'mean' in show:
+        fig.add_trace(go.Scatter(x=x, y=mean, mode='lines', line=dict(color='black', width=3), name="Mean"))
+
+    x_axis_title = {'start': "Frames", 'max': f"Frames from the highest {event_label}_{event_xyz}",
+                    'min': f"Frames from the lowest {event_label}_{event_xyz}", 'normalized': "% of movement"}[alignment]
+    fig.update_layout(title=f"{label}_{xyz} over {len(batch)} trials", xaxis_title=x_axis_title,
+                      yaxis_title=f"{label}_{xyz}", height=400)
+    return fig
+
+def build_axes(AnatAx, SegCOM):
+    '''End points of the X, Y and Z anatomical axes of every segment: {segment: {'X'|'Y'|'Z': Nx3}}'''
     # add points for AnatAx to invis points 
     # structure is key is name points to x,y,z dicts 
     axes = {}
     a = ['X', 'Y', 'Z']
     for ax in AnatAx:
-        com = COMs[ax]
+        com = SegCOM[ax]
         temp = {}
         for i, line in enumerate(AnatAx[ax]): #x line then y then z
             try:
@@ -147,112 +277,109 @@ def read_Mitchell_data(framerate):
             except:
                 print("AnatAx Error")
         axes[ax] = temp
+    return axes
 
-    
-    undersampled_final_points = {key: value[::framerate] for key, value in final_points.items()}
-    # Undersample COMs
-    undersampled_COMs = {key: value[::framerate] for key, value in COMs.items()}
-    # Undersample vectors
-    if (noVectors):
-        undersampled_vectors = {key: [value[0][::framerate], value[1][::framerate]] for key, value in vectors.items()}
-    else:
-        undersampled_vectors = {}
-    # Undersample axes
-    undersampled_axes = {}
-    for ax, temp in axes.items():
-        undersampled_axes[ax] = {coord: data[::framerate] for coord, data in temp.items()}
+def filter_points_to_draw(points, p_filter=[]):
+    '''Takes in the TrialStore and filters out the points in the filter
+    Returns a TrialStore, labels are in the same order as the marker axis'''
+    return points.select(p_filter)
 
-    all_points = final_points
-    all_points['TBCM'] = TBCM
-    all_points['TBCMVeloc'] = TBCMVeloc
 
-    return undersampled_final_points, undersampled_COMs, undersampled_axes, undersampled_vectors, all_points, final_points, {"TBCM": TBCM} , {"TBCMVeloc": TBCMVeloc}, files_2D
-
-def filter_points_to_draw(points, COMs, p_filter=[]):
-    '''Takes in all points and filters out those in the filter
-    Returns one df list.  Each frame is a df at its index
-    Returns a list of names for each point in order they are listed in df'''
-    frames = []
-    labels = []
-    #add mocap points
-    for point_name in points:
-        if point_name not in p_filter:
-            for i, point in enumerate(points[point_name]):
-                if len(frames) <= i:
-                    frames.append([])
-                frames[i].append(point)
-            labels.append(point_name)
-
-    #add COM points
-    for point_name in COMs:
-        if point_name not in p_filter:
-            for i, point in enumerate(COMs[point_name]):
-                if len(frames) <= i:
-                    frames.append([])
-                frames[i].append(point)
-            labels.append(point_name)
-
-    dfs = []
-    for frame in frames:
-        df = pd.DataFrame(frame)
-        df.columns = ['X', 'Y', 'Z', 'Segment_ID']
-        dfs.append(df)
-
-    return dfs, labels
-
-
-def draw_anat_ax(plot, axes, COMs, frame, a_filter=[]):
-    '''Draws the lines for each anat ax starting from its corresponding COM'''
-    #TODO see if this can be done in one draw_line call (not sure if an array of colors is possible)
-    froms = []
-    tos = []
-    for name in COMs:
-        try:
-            if name not in a_filter:
-                froms.append(COMs[name])
-                tos.append(axes[name]['X'])
-        except Exception as error:
-            print("draw x anat error", type(error).__name__)
-    draw_line(plot, froms, tos, frame, 'red', name='AnatAx X')
+def draw_anat_ax(plot, axes, COMs, frame, a_filter=[], single_trace=True):
+    '''Draws the lines for each anat ax starting from its corresponding COM
+    By default all three axes are one trace with per vertex colors (see anat_ax_line),
+    single_trace=False draws the old separate X, Y and Z traces'''
+    lines = anat_ax_line(axes, COMs, a_filter) if single_trace else anat_ax_lines(axes, COMs, a_filter)
+    for froms, tos, cs, name in lines:
+        draw_line(plot, froms, tos, frame, cs, name=name)
 
-    tos = []
-    for name in COMs:   
-        try:
-            if name not in a_filter:
-                tos.append(axes[name]['Y'])
-        except Exception as error:
-            print("draw y anat error", type(error).__name__)
-    draw_line(plot, froms, tos, frame, 'green', name='AnatAx Y')
+    return plot
 
-    tos = []
+def anat_ax_line(axes, COMs, a_filter=[]):
+    '''(froms, tos, line, name) drawing the X, Y and Z axes of every COM as one trace
+    Every vertex gets 0/1/2 for X/Y/Z which AXIS_COLORSCALE maps to red/green/blue,
+    so the axes layer is one trace in the figure and in each frame instead of three'''
+    x, y, z = anat_ax_lines(axes, COMs, a_filter)
+    froms = x[0] * 3
+    tos = x[1] + y[1] + z[1]
+    colors = np.repeat([0, 1, 2], len(x[0]) * 3) #3 vertices (from, to, gap) per axis per COM
+    line = dict(color=colors, colorscale=AXIS_COLORSCALE, cmin=0, cmax=2)
+    return [(froms, tos, line, 'AnatAx')]
+
+def anat_ax_lines(axes, COMs, a_filter=[]):
+    '''(froms, tos, color, name) for the X (red), Y (green) and Z (blue) axes of every COM'''
+    names = []
     for name in COMs:
-        try:
-            if name not in a_filter:
-                tos.append(axes[name]['Z'])
-        except Exception as error:
-            print("draw z anat error", type(error).__name__)
-    draw_line(plot, froms, tos, frame, 'blue', name='AnatAx Z')
-
-
-    return plot
+        if name not in a_filter:
+            if name in axes and all(a in axes[name] for a in ('X', 'Y', 'Z')):
+                names.append(name)
+            else:
+                print("draw anat error", name)
+    froms = [COMs[name] for name in names]
+    return [(froms, [axes[name][a] for name in names], cs, 'AnatAx ' + a)
+            for a, cs in (('X', 'red'), ('Y', 'green'), ('Z', 'blue'))]
 
 def draw_vectors(plot, vectors,  startingFrame, v_filter=[]):
     '''Draw the vectors
     Currently just a line from vector[key][0] to vector[key][1] at every frame'''
+    for froms, tos, cs, name in vector_lines(vectors, v_filter):
+        plot = draw_line(plot, froms, tos, startingFrame, cs, name=name)
+    return plot
+
+def vector_lines(vectors, v_filter=[]):
+    '''(froms, tos, color, name) for the vectors layer'''
     froms = []
     tos = []
     for vector in vectors:
         if vector not in v_filter:
             froms.append(vectors[vector][0])
             tos.append(vectors[vector][1])
-    plot = draw_line(plot, froms, tos, startingFrame, 'purple', name='Vectors')
-    return plot
-
-def base_plot(dfs, labels, frame):
-    '''Takes dfs and labels and returns the plot
-    invis_dfs is the points to plot but not show (used for axis and vectors)
-    Each index in dfs is a frame each point in dfs[x] is labeled in order by labels
+    return [(froms, tos, 'purple', 'Vectors')]
+
+def point_lines(points):
+    '''(froms, tos, color, name) for the Line layer, first COM to second COM and first point to second point'''
+    coms, mocap = points.com_names(), points.point_names()
+    return [([points.series(coms[0]), points.series(mocap[0])], [points.series(coms[1]), points.series(mocap[1])], 'red', 'lines')]
+
+def layer_lines(points, axes, vectors, checklistValues):
+    '''Every line trace for the checked layers, in checklistValues order, as they are added on top of the points'''
+    lines = []
+    for layer in checklistValues:
+        lines += layer_traces(points, axes, vectors, layer)
+    return lines
+
+def layer_traces(points, axes, vectors, layer):
+    '''(froms, tos, line, name) for each trace of one layer of the 3D graph (Points has none, it is always trace 0)
+    Layers with nothing to draw (ex: no TBCM files for Vector) give an empty list'''
+    lines = []
+    if layer == 'Line':
+        lines = point_lines(points)
+    elif layer == 'Anatomical Axes':
+        lines = anat_ax_line(axes, points.coms())
+    elif layer == 'Vector':
+        lines = vector_lines(vectors)
+    return [line for line in lines if len(line[0]) > 0]
+
+def base_plot(store, frame, animate=True, lines=()):
+    '''Takes a TrialStore and returns the plot
+    store.positions[i] is frame i, each marker is labeled in order by store.labels
+    lines are (froms, tos, line, name) traces drawn on top of the points (see layer_lines), in that order
+    With animate True there is a frame (named by index) for every frame so the start frame can be changed
+    without rebuilding (see seek_frame in assets/playback.js), Restart goes back to frame
+    With animate False only frame is drawn and there are no frames (frames get streamed instead)
     returns the plot object'''
+    import plotly.graph_objects as go
+    labels = store.labels
+    #read the frames once (only pages/reads the displayed window for sidecar and v7.3 stores)
+    positions = np.asarray(store.positions[:] if animate else store.positions[frame:frame + 1])
+    shown = positions[frame] if animate else positions[0]
+    geometries = []
+    for froms, tos, cs, name in lines:
+        geometry = segment_geometry(froms, tos, 0, len(positions)) if animate else segment_geometry(froms, tos, frame, frame + 1)
+        if len(geometry) == 0:
+            print("line drawing error, no frames")
+            continue
+        geometries.append((geometry, cs, name))
     #info for the axis scaling
     x_min = -5
     x_max = 5
@@ -267,14 +394,14 @@ def base_plot(dfs, labels, frame):
                         aspectmode='cube')
     #the figure (full library)
     main_plot = go.Figure(
-        data=[go.Scatter3d( x=dfs[frame]['X'],
-                            y=dfs[frame]['Y'], 
-                            z=dfs[frame]['Z'],
+        data=[go.Scatter3d( x=typed_array(shown[:, 0]),
+                            y=typed_array(shown[:, 1]), 
+                            z=typed_array(shown[:, 2]),
                             mode='markers', #gets rid of line connecting all points
-                            marker={'color':dfs[frame]['Segment_ID'], 'size': p_size},
+                            marker={'color':store.segment_ids, 'size': p_size},
                             hovertext= labels
                             ),
-        ],
+        ] + [line_trace(geometry[frame if animate else 0], cs, name) for geometry, cs, name in geometries],
         layout=go.Layout(#TODO Setting that size of the plot seems to make it not responsive to a change in window size.
                         scene = scene_scaling,
                         margin=dict(l=0, r=0, b=0, t=0, pad=4),
@@ -290,7 +417,7 @@ def base_plot(dfs, labels, frame):
                                                         args=[[None], {"mode": "immediate"}]),
                                                     dict(label="Restart",
                                                         method="animate",
-                                                        args=[None, {"frame": {"duration": 50, 'redraw': True}, "mode": 'immediate',}]),
+                                                        args=[restart_frames(frame, len(positions)), {"frame": {"duration": 50, 'redraw': True}, "mode": 'immediate',}]),
                                                     ])],
                         legend=dict(
                             x=0.5,
@@ -300,72 +427,291 @@ def base_plot(dfs, labels, frame):
                             yanchor='bottom',
                         )
         ),
-        frames=[go.Frame(
-                data= [go.Scatter3d(
-                            x=dfs[i]['X'],
-                            y=dfs[i]['Y'], 
-                            z=dfs[i]['Z'], 
-                            mode='markers', #gets rid of line connecting all points
-                            marker={'color':dfs[i]['Segment_ID'],  'size': p_size},
-                            connectgaps=False, #TODO ask what we should do in this case.  Currently this stops the filling in of blanks/NaNs
-                            hovertext = labels
-                            ),
-                            ])
-                for i in range(frame, len(dfs))] #https://plotly.com/python-api-reference/generated/plotly.graph_objects.Figure.html
+        #frames only carry the coordinates, labels, colors and mode stay the ones of the base traces (animate keeps them)
+        #every frame is built once with all of its traces, as plain dicts so the figure validates each one once
+        frames=[dict(name=str(i), data=[frame_trace(positions[i])] + [frame_trace(geometry[i]) for geometry, _, _ in geometries])
+                for i in range(len(positions))] if animate else None #https://plotly.com/python-api-reference/generated/plotly.graph_objects.Figure.html
     )
+    if not animate:
+        main_plot.update_layout(updatemenus=[]) #Play/Pause are the stream controls instead
 
     return main_plot
 
+def restart_frames(frame, frame_count):
+    '''Frame names the Restart button plays, from the start frame to the end'''
+    return [str(i) for i in range(frame, frame_count)]
+
+def frame_trace(coords):
+    '''Coordinates of one trace in an animation frame, (vertices, 3)'''
+    return dict(type='scatter3d', x=typed_array(coords[:, 0]), y=typed_array(coords[:, 1]), z=typed_array(coords[:, 2]))
+
+def line_trace(coords, cs, name):
+    '''Base trace of a line layer shown at coords (vertices, 3)
+    cs is a color or a dict of line properties (ex: per vertex colors), only set here since frames keep
+    whatever they don't change'''
+    import plotly.graph_objects as go
+    line = cs if isinstance(cs, dict) else dict(color=cs)
+    return go.Scatter3d(x=typed_array(coords[:, 0]), y=typed_array(coords[:, 1]), z=typed_array(coords[:, 2]),
+                        mode='lines', line=line, name=name)
+
 def draw_line(plot, froms, tos, startingFrame, cs='red', name='lines'):
-    '''Add a line in all frames of plot from froms[x] to tos[x]'''
-
-    #point list is [from, to, None] in a loop
-    frames = []
-    for n in range(startingFrame, len(froms[0])): #for every frame
-        try:
-            x = []
-            y = []
-            z = []
-            frame = []
-            for i in range(len(froms)): #for every set of points 
-                x.append(froms[i][n][0])
-                x.append(tos[i][n][0])
-                y.append(froms[i][n][1])
-                y.append(tos[i][n][1])
-                z.append(froms[i][n][2])
-                z.append(tos[i][n][2])
-                x.append(None)
-                y.append(None)
-                z.append(None)
-            frame.append(x)
-            frame.append(y)
-            frame.append(z)
-            frames.append(frame)
-        except Exception as error:
-            print("line drawing error", type(error).__name__)
-
-    try:
-        plot.add_trace(go.Scatter3d(
-            x=frames[0][0],
-            y=frames[0][1],
-            z=frames[0][2],
-            mode='lines', line=dict(color=cs), name=name
-        ))
-    except Exception as error:
-        print("continued line error", type(error).__name__)
-
-    #one pass per frame for all lines O(n) where n = #frames
-    for i, frame in enumerate(plot.frames):
-        try:
-            temp = list(frame.data)
-            temp.append(go.Scatter3d(x=frames[i][0], y=frames[i][1], z=frames[i][2], mode='lines', line=dict(color=cs)))
-            frame.data = temp
-        except Exception as error:
-            print("index error", type(error).__name__)
+    '''Add a line in all frames of plot from froms[x] to tos[x], cs as in line_trace
+    Every frame of plot is rebuilt, to draw several lines pass them to base_plot instead'''
+    #animation frames cover the whole trial, without them (streaming) only startingFrame is drawn
+    if plot.frames:
+        geometry = segment_geometry(froms, tos, 0, len(plot.frames))
+        shown = geometry[startingFrame] if startingFrame < len(geometry) else None
+    else:
+        geometry = segment_geometry(froms, tos, startingFrame, startingFrame + 1)
+        shown = geometry[0] if len(geometry) else None
+    if shown is None:
+        print("line drawing error, no frames")
+        return plot
+
+    plot.add_trace(line_trace(shown, cs, name))
+
+    if plot.frames:
+        frames = [frame.to_plotly_json() for frame in plot.frames]
+        for frame, block in zip(frames, geometry):
+            frame['data'] = list(frame['data']) + [frame_trace(block)]
+        plot.frames = frames
 
     return plot
 
+def stack_series(series, start=0, stop=None):
+    '''Stack Nx3 series (points, COMs, axes ends) into one (frames, len(series), 3) float array
+    Frames run from start to stop (default the longest series), shorter series are NaN padded'''
+    if stop is None:
+        stop = max((len(s) for s in series), default=start)
+    frames = max(stop - start, 0)
+    out = np.full((frames, len(series), 3), np.nan)
+    for i, s in enumerate(series):
+        block = np.asarray(s[start:stop])
+        out[:len(block), i] = block[:, :3]
+    return out
+
+def segment_geometry(froms, tos, start=0, stop=None):
+    '''Line coordinates for every frame at once, froms[i] to tos[i] for each pair
+    Returns (frames, pairs * 3, 3): from, to, NaN gap for every pair (NaN breaks the line like None did)'''
+    if stop is None:
+        stop = len(froms[0]) if len(froms) else start
+    froms = stack_series(froms, start, stop)
+    tos = stack_series(tos, start, stop)
+    geometry = np.full((len(froms), froms.shape[1], 3, 3), np.nan)
+    geometry[:, :, 0] = froms
+    geometry[:, :, 1] = tos
+    return geometry.reshape(len(froms), -1, 3)
+
+def patch_3d_graph(session, state, start, layers):
+    '''Patch for the current 3D figure instead of rebuilding it with base_plot
+    state describes what is in the figure (3dLayerState): the layers checked, the layers drawn and their trace counts
+    Embedded Frames figures have every layer drawn (in every frame too) so toggling one only sets visible on its traces,
+    streaming and client figures have no frames and only the checked layers, unchecked layers lose their traces and
+    newly checked ones are appended. Every trace is moved to show frame start
+    Returns the Patch and the new state'''
+    from dash import Patch
+    patched = Patch()
+    drawn = list(state['drawn'])
+    counts = list(state['traces'])
+
+    if state['mode'] not in ('stream', 'client'):
+        for i, layer in enumerate(drawn):
+            if (layer in layers) != (layer in state['layers']):
+                first = 1 + sum(counts[:i]) #trace 0 is the points
+                for idx in range(first, first + counts[i]):
+                    patched['data'][idx]['visible'] = layer in layers
+    else:
+        #remove from the back so the indices of earlier traces don't move
+        for i in reversed(range(len(drawn))):
+            if drawn[i] not in layers:
+                first = 1 + sum(counts[:i])
+                for idx in reversed(range(first, first + counts[i])):
+                    del patched['data'][idx]
+                del drawn[i]
+                del counts[i]
+        for layer in layers:
+            if layer in drawn:
+                continue
+            lines = layer_traces(session.points, session.axes, session.vectors, layer)
+            for froms, tos, cs, name in lines:
+                line = cs if isinstance(cs, dict) else dict(color=cs)
+                patched['data'].append(dict(type='scatter3d', x=[], y=[], z=[], mode='lines', line=line, name=name))
+            drawn.append(layer)
+            counts.append(len(lines))
+        layers = drawn
+
+    #show frame start in every trace (hidden ones too, they show it once checked)
+    for idx, coords in enumerate(frame_coords(session, start, drawn)):
+        patched['data'][idx]['x'] = typed_array(coords[:, 0])
+        patched['data'][idx]['y'] = typed_array(coords[:, 1])
+        patched['data'][idx]['z'] = typed_array(coords[:, 2])
+    if state['mode'] not in ('stream', 'client'):
+        patched['layout']['updatemenus'][0]['buttons'][2]['args'][0] = restart_frames(start, state['frames'])
+
+    return patched, dict(state, layers=layers, drawn=drawn, traces=counts)
+
+def frame_coords(session, frame, layers):
+    '''(vertices, 3) coordinates of every trace at one frame, the points then each layer's lines'''
+    coords = [np.asarray(session.drawn.positions[frame])]
+    for froms, tos, _, _ in layer_lines(session.points, session.axes, session.vectors, layers):
+        coords.append(segment_geometry(froms, tos, frame, frame + 1)[0])
+    return coords
+
+def stream_config(session, start, layers):
+    '''What the browser needs to stream frames from start (see stream_control in assets/playback.js)
+    The framerate comes back with every request, the process answering it may not be the one that drew the figure
+    (background jobs, wsgi.py workers) and has to undersample the same way'''
+    return {'start': start, 'end': session.drawn.frame_count, 'layers': layers, 'framerate': session.framerate,
+            'batch': STREAM_BATCH, 'buffer': STREAM_BUFFER}
+
+def stream_batch(session, start, count, checklistValues):
+    '''Frames start to start + count of the current 3D drawing for streaming playback
+    Each trace (in the same order as draw_3d_graph, points then layer_lines) is one float32 (frames, vertices, 3)
+    array sent as base64 bytes like client_trial, assets/playback.js cuts the frames out of it'''
+    stop = min(start + count, session.drawn.frame_count)
+    blocks = [np.asarray(session.drawn.positions[start:stop])]
+    blocks += [segment_geometry(froms, tos, start, stop)
+               for froms, tos, _, _ in layer_lines(session.points, session.axes, session.vectors, checklistValues)]
+    return {'start': start, 'frames': len(blocks[0]),
+            'traces': [{'vertices': block.shape[1], 'data': pack_float32(block)} for block in blocks]}
+
+def client_trial(session, start, checklistValues):
+    '''The whole current 3D drawing packed for client playback (assets/playback.js), shown from frame start
+    Points are one float32 (frames, markers, 3) array and each line layer one float32 (frames, pairs, 2, 3) array,
+    sent as base64 bytes. Labels, colors and styling are only in the figure so they go over once'''
+    positions = np.asarray(session.drawn.positions[:], dtype=np.float32)
+    frames = len(positions)
+    lines = []
+    for froms, tos, _, _ in layer_lines(session.points, session.axes, session.vectors, checklistValues):
+        pairs = np.stack([stack_series(froms, 0, frames), stack_series(tos, 0, frames)], axis=2)
+        lines.append({'pairs': len(froms), 'data': pack_float32(pairs)})
+    return {'start': start, 'frames': frames, 'markers': positions.shape[1], 'points': pack_float32(positions), 'lines': lines}
+
+def graph_series(session, key):
+    '''Full resolution series of a 2D graph point, a derived one is computed now. None when the trial has none'''
+    if key in session.all_points_for_2D_graphs:
+        return session.all_points_for_2D_graphs[key]
+    return session.derived_2D_graphs.get(key)
+
+def series_2d(session, key, xyz):
+    '''One coordinate (X, Y or Z) of a 2D graph point over the whole trial (full resolution)'''
+    series = np.asarray(graph_series(session, key))
+    if series.ndim == 1: #speeds and distances have no X/Y/Z
+        return series
+    return series[:, "XYZ".index(xyz)]
+
+def line_samples(session, spec, i, x_range=None):
+    '''x, y of line i of a 2D graph downsampled to TARGET_POINTS with LTTB (seriesDownsample.py)
+    spec is kept with the graph by add_new_graph: {'x': [point or 'frames', xyz], 'lines': [[point, xyz], ...]}
+    With x_range (a zoom) only the samples inside it are used, so zooming in far enough shows every real sample'''
+    y = series_2d(session, *spec['lines'][i])
+    x = np.arange(len(y)) if spec['x'][0] == 'frames' else series_2d(session, *spec['x'])
+    n = min(len(x), len(y))
+    x, y = x[:n], y[:n]
+    idx = np.arange(n) if x_range is None else window(x, x_range)
+    #buckets are picked along the frame axis so X vs Y plots of a point keep their shape too
+    keep = idx[lttb(idx, y[idx])]
+    return x[keep], y[keep]
+
+def new_graph_figure(session, spec, lineColors, title=None, x_axis_title=None, y_axis_title=None, height=None):
+    '''The figure of a new 2D graph (add_new_graph), one downsampled line per spec line
+    Titles that aren't given are made from the selected points'''
+    import plotly.graph_objects as go
+    fig = go.Figure()
+    y_title_not_given = False
+
+    if y_axis_title is None: 
+        y_title_not_given = True
+        y_axis_title = ""
+    if height is None: height = 300
+
+    x_axis_point, x_axis_xyz = spec['x']
+    if x_axis_title is None:
+        x_axis_title = "Frames" if x_axis_point == "frames" else x_axis_point + "_" + x_axis_xyz
+
+    for i, (selected_point_key, selected_xyz) in enumerate(spec['lines']):
+        lineColor = lineColors[i]
+        if y_title_not_given:
+            y_axis_title = y_axis_title + selected_point_key + "_" + selected_xyz
+            if i < len(spec['lines'])-1:
+                y_axis_title += ", "
+
+        x, y = line_samples(session, spec, i)
+        fig.add_trace(go.Scatter(x=x , y=y, mode='markers+lines', line=dict(color=lineColor), name=f"{selected_point_key} {selected_xyz}"))
+    
+    if title is None: title = y_axis_title + " Plotted Over " + x_axis_title
+
+    fig.update_layout(title=title, xaxis_title=x_axis_title,
+                                        yaxis_title=y_axis_title, height=height,
+                                        uirevision='zoom') #keep the zoom when zoom_2d_graph swaps the samples
+    return fig
+
+def zoom_range(relayoutData):
+    '''(changed, x range) from a 2D graph's relayoutData, x range is None when zoomed back out'''
+    if not relayoutData:
+        return False, None
+    if 'xaxis.range[0]' in relayoutData:
+        return True, (relayoutData['xaxis.range[0]'], relayoutData['xaxis.range[1]'])
+    if 'xaxis.range' in relayoutData:
+        return True, tuple(relayoutData['xaxis.range'])
+    if relayoutData.get('xaxis.autorange'):
+        return True, None
+    return False, None
+
+def session_for(sid, framerate=None, progress=None):
+    '''Session of a browser tab (sessionStore.py), loaded with its trial undersampled at framerate
+    (the framerate it already has when not given). SessionExpired when the tab's session is gone'''
+    session = sessions.get(sid)
+    framerate = framerate or session.framerate or frameRate
+    if not session.loaded or session.framerate != framerate:
+        load_session(session, framerate, progress)
+        sessions.fit(sid)
+    return session
+
+def switch_files(sid, files, progress=None):
+    '''Switch only the tab sid to files (a filesList style dict) and load them
+    Returns what update_output sends back: the first point and point options of the new graph modal,
+    the frame length (chainCallback), no 2D graphs and the 2D file options'''
+    #only drop cached parses for files that actually changed on disk
+    trial_cache.invalidate([f for kind in files for f in files[kind]], stale_only=True)
+    session = sessions.get(sid, lambda: Session(files))
+    session.files = files
+    session.numOf2dGraphs = 0
+    sessions.save(sid)
+    with metrics.stage('load'):
+        load_session(session, frameRate, progress)
+    sessions.fit(sid)
+    points, frameLength, file_list_2D = session.points, session.frameLength, session.file_list_2D
+    return points.point_names()[0], points.point_names(), frameLength, [], file_list_2D, file_list_2D
+
+def ingest_files(paths):
+    '''Parse the given files into trial_cache (and their sidecars) without building a trial, for the capture folder
+    watcher (trialWatcher.py). A file that can't be read is reported and skipped, it is tried again once it changes'''
+    trial_cache.invalidate(paths, stale_only=True)
+    files = files_by_kind(paths)
+    warm_sidecars(ingest_jobs(files))
+    for kind in files:
+        for f in files[kind]:
+            try:
+                if kind in ('TBCM', 'TBCMVeloc'):
+                    load_from_mat2([f])
+                else:
+                    load_from_mat([f], {})
+            except Exception as error:
+                print("could not read", f, type(error).__name__, error)
+
+def load_session(session, framerate, progress=None):
+    '''Read the session's files (cached, see read_Mitchell_data) into the session'''
+    touch_uploads([f for kind in session.files for f in session.files[kind]])
+    (session.points, session.axes, session.vectors, session.all_points_for_2D_graphs, session.mocap_data_2D_graphs,
+     session.TBCM_2D_graphs, session.TBCMVeloc_2D_graphs, session.file_list_2D, session.derived_2D_graphs) = read_Mitchell_data(framerate, session.files, progress)
+    session.drawn = filter_points_to_draw(session.points)
+    session.frameLength = session.drawn.frame_count * framerate
+    session.framerate = framerate
+    session.loaded = True
+
 def detect_filetype(filename):
+    import scipy.io as sio
     loaded = sio.loadmat(filename)
     if (loaded):
         loaded = loaded["Data"]
@@ -386,14 +732,11 @@ def detect_filetype(filename):
 
     return filetype
 
-def UploadAction(event=None):
-    filenames = filedialog.askopenfilenames()
-
-    global filesList
+def files_by_kind(filenames):
+    '''filesList style dict of the given files, the kind is told from the file name'''
     filesList = {'AnatAx' : [], 'SegCOM': [], 
              'TBCM' : [], 'TBCMVeloc' : [],
              'MocapData' : []}
-            #https://stackoverflow.com/questions/1124810/how-can-i-find-path-to-given-file
     for filename in filenames:
         if "tbcm_" in filename.casefold():
             filesList['TBCM'].append(filename)
@@ -405,256 +748,521 @@ def UploadAction(event=None):
             filesList['AnatAx'].append(filename)
         if "mocap" in filename.casefold():
             filesList['MocapData'].append(filename)
+    return filesList
 
-    global points, COMs, axes, vectors, all_points_for_2D_graphs, mocap_data_2D_graphs, TBCM_2D_graphs, TBCMVeloc_2D_graphs, selected_y_axis_point_2D, file_list_2D
-    global dfs, labels
-    global frameLength
-    points, COMs, axes, vectors, all_points_for_2D_graphs, mocap_data_2D_graphs, TBCM_2D_graphs, TBCMVeloc_2D_graphs, file_list_2D = read_Mitchell_data(frameRate)
-    selected_y_axis_point_2D = mocap_data_2D_graphs
-    dfs, labels = filter_points_to_draw(points, COMs)
-    frameLength = len(dfs) * frameRate
+def UploadAction(event=None):
+    from tkinter import filedialog
+    filenames = filedialog.askopenfilenames()
+
+    global filesList
+    filesList = files_by_kind(filenames)
+
+    #the launch files are what every new session (browser tab) starts on, read them once now so the first page is quick
+    read_Mitchell_data(frameRate, filesList)
     root.destroy()
     dash()
 
 def dash():
-    app = Dash("plots", suppress_callback_exceptions=True, external_stylesheets=[dbc.themes.BOOTSTRAP]) #Suppress is true to allow divs to spawn divs without breaking system
-    global frameLength
-    global points
-
-    app.layout = html.Div([ # Start of Dash App
-        html.Link(
-        rel='stylesheet',
-        href='/assets/styles.css'  # Adjust the path to your CSS file
-    ),
-        html.Header(
-        html.H1("BiomechVis", style={'textAlign': 'center'}),
-        style={
-            'background-color': '#4da2f7',  # Set the background color of the header
-            'padding': '0px',
-            'padding-top': '5px',  # Set padding for the header
-            'padding-bottom': '5px',  # Set padding for the header
-            'color': 'white',  # Set text color
-            'width': '100%',
+    app = create_app()
+    #When giving code, set debug to False to make only one tkinter run needed
+    app.run_server(debug=False)
 
-        }
-    ),
-    dbc.Modal(id = "newGraphModal", children=[
-            dbc.ModalHeader("Add New 2D Graph", id='new-graph-modal-header'),
-            dbc.ModalBody(id='new-graph-modal-body', children=[
-                html.Div(id='new-graph-attributes-div', children=[
-                    html.H5("Graph Attributes:"),
-                    html.Div(id='new-graph-attributes-inputs-div', children=[
-                        html.H6("Title:"), 
-                        dcc.Input(id='new-graph-title-input', type='text', placeholder='My New 2D Graph'),
-                        html.H6("X-Axis Title:"), 
-                        dcc.Input(id='new-graph-x-axis-input', type='text', placeholder='X'),
-                        html.H6("Y-Axis Title:"), 
-                        dcc.Input(id='new-graph-y-axis-input', type='text', placeholder='Y'),
-                        html.H6("Height:"), 
-                        dcc.Input(id="new-graph-height-input", type="number", placeholder=300, value=300, min=200, max=1000, debounce=True, style={"height": "20px", "margin-left": "5px"})
-                    ]),
-                ]),
-                html.H5("Select the data for the Y-Axis:"),
-
-                html.H6("Select the File:"),
-                dcc.Dropdown(
-                    id='y-axis-select-file',
-                    options=file_list_2D,
-                    value='Mocap',
-                    clearable=False,
-                    style={'margin-bottom': '5px'}
-                ),
-                html.Div(id='new-graph-add-line-dropdowns-div', children = [ # Div that hold dropdown
-                    html.Div(id='new-graph-line-1-title', children=[
-                        html.H6("Line:", id='new-graph-modal-line-1-text'),
+def watch_panel():
+    '''Trials captured in the watched folder (BIOMECHVIS_WATCH_DIR), picking one opens it like an upload
+    Empty when no folder is watched'''
+    from dash import dcc, html
+    if watcher is None:
+        return html.Div(id='watch-panel')
+    return html.Div(id='watch-panel', children=[
+                dcc.Dropdown(id='watch-trials', placeholder=f"Captured trials in {watcher.folder}", options=[]),
+                dcc.Interval(id='watch-interval', interval=WATCH_POLL_S * 1000),
+                dcc.Store(id='watch-version', data=-1),
+            ], style={'margin': '10px'})
+
+def compare_panel():
+    '''Collapsible multi-trial comparison under the app: several trials uploaded together, one marker compared across them'''
+    from dash import dcc, html
+    return [html.Details(id='compare-panel', children=[
+                html.Summary("Compare trials"),
+                dcc.Upload(id='compare-upload', children=html.Div(['Drag and Drop or ', html.A('Select Files'),
+                                                                   ' of every trial (grouped by file name, ex: Dunk1_mocapData.mat)']),
+                           style={'width': '98%', 'height': '60px', 'lineHeight': '60px', 'borderWidth': '1px',
+                                  'borderStyle': 'dashed', 'borderRadius': '5px', 'textAlign': 'center', 'margin': '10px'},
+                           multiple=True),
+                html.Div(id='compare-progress', className='job-progress', style={'display': 'none'}),
+                html.Div(id='compare-trials'),
+                html.Div([
+                    dcc.Dropdown(id='compare-marker', placeholder="Marker", style={'width': '250px'}),
+                    dcc.RadioItems(['X', 'Y', 'Z'], 'X', id='compare-xyz', inline=True, labelStyle={"margin-right": "10px"}),
+                    dcc.Dropdown(id='compare-align', clearable=False, value='start', style={'width': '250px'}, options=[
+                        {'label': "Align on first frame", 'value': 'start'},
+                        {'label': "Align on highest value", 'value': 'max'},
+                        {'label': "Align on lowest value", 'value': 'min'},
+                        {'label': "Normalized time (0-100%)", 'value': 'normalized'},
                     ]),
-                    html.Div(id='new-graph-line-1-inputs',className='new-graph-line-inputs', children=[ 
-                        dcc.Dropdown(
-                            id={'type': 'new-graph-point-dropdown', 'index': f'{newGraphNumOfLines}'},
-                            options=[{"label": point, "value": point} for point in selected_y_axis_point_2D.keys()],
-                            value= list(selected_y_axis_point_2D.keys())[0],
-                            clearable=False,
-                            style={'width': '100%', 'margin-right': '4px'}
-                        ),
-                        dcc.Dropdown(
-                            id={'type': 'new-graph-xyz-dropdown', 'index': f'{newGraphNumOfLines}'},
-                            options=[{"label": "X", "value": "X"},
-                                    {"label": "Y", "value": "Y"},
-                                    {"label": "Z", "value": "Z"}],
-                            value="X",
-                            clearable=False,
-                            style={'width': '10%', 'margin-right': '4px'}
-                        ),     
-                        dbc.Input(type="color", id={'type': 'new-graph-color-picker', 'index': f'{newGraphNumOfLines}'},value="#000000",style={"width": '10%', 'height': '36px'}),
-                        dbc.Button("Remove", id='new-graph-original-remove-button', className='new-graph-remove-line-button')
+                    #what highest/lowest look at, the compared marker and coordinate when left empty
+                    dcc.Dropdown(id='compare-event-marker', placeholder="Event marker (compared one)", disabled=True,
+                                 style={'width': '250px'}),
+                    dcc.Dropdown(['X', 'Y', 'Z'], id='compare-event-xyz', placeholder="Event axis (compared one)",
+                                 disabled=True, style={'width': '200px'}),
+                    dcc.Checklist([{'label': "Trials", 'value': 'trials'}, {'label': "Mean ± SD", 'value': 'mean'}],
+                                  ['trials', 'mean'], id='compare-show', inline=True, labelStyle={"margin-right": "10px"}),
+                ], style={'display': 'flex', 'flex-wrap': 'wrap', 'align-items': 'center', 'gap': '15px', 'margin': '10px'}),
+                dcc.Graph(id='compare-graph', style={'display': 'none'}),
+            ], style={'margin': '10px'})]
+
+def debug_panel():
+    '''Collapsible callback timings under the app (BIOMECHVIS_DEBUG_PANEL=1), nothing when it is off'''
+    from dash import dcc, html
+    if not DEBUG_PANEL:
+        return []
+    return [html.Details(id='debug-panel', children=[
+                html.Summary("Debug: callback timings"),
+                html.Div(id='debug-metrics'),
+                dcc.Interval(id='debug-metrics-interval', interval=2000, disabled=True),
+            ], style={'margin': '10px', 'font-size': '12px'})]
+
+def metrics_table(snapshot):
+    '''html.Table of a metrics snapshot, slowest callbacks first, stages are listed under their callback'''
+    from dash import html
+    header = html.Tr([html.Th(h, style={'padding': '0 8px'}) for h in
+                      ("Callback", "Calls", "Last ms", "Mean ms", "Max ms", "Last KB", "Max KB", "Peak MB", "Errors")])
+    rows = [header]
+    callbacks = sorted(snapshot['callbacks'].items(), key=lambda item: -item[1]['wall_ms']['max'])
+    for name, c in callbacks:
+        peak = f"{c['peak_bytes']['max'] / 2**20:.1f}" if c['peak_bytes']['count'] else "-"
+        cells = [name, c['calls'], f"{c['wall_ms']['last']:.1f}", f"{c['wall_ms']['mean']:.1f}", f"{c['wall_ms']['max']:.1f}",
+                 f"{c['bytes']['last'] / 1024:.1f}", f"{c['bytes']['max'] / 1024:.1f}", peak, c['errors']]
+        rows.append(html.Tr([html.Td(cell, style={'padding': '0 8px'}) for cell in cells]))
+        for stage, st in c['stages'].items():
+            cells = ["    " + stage, st['count'], f"{st['last']:.1f}", f"{st['mean']:.1f}", f"{st['max']:.1f}", "", "", "", ""]
+            rows.append(html.Tr([html.Td(cell, style={'padding': '0 8px', 'white-space': 'pre', 'color': '#666'}) for cell in cells]))
+    return html.Table(rows)
+
+def create_app():
+    '''The Dash app with its layout and callbacks, dash() runs it on the dev server and wsgi.py serves it with workers'''
+    from dash import Dash, dcc, html, Input, Output, State, callback_context, MATCH, no_update, ALL, ClientsideFunction, Patch, set_props
+    from dash.exceptions import PreventUpdate
+    import dash_bootstrap_components as dbc
+    import flask
+
+    def on_callback_error(error):
+        '''A tab whose session expired is asked to reload, rather than starting over on the launch files'''
+        #errors of background jobs come back as their traceback text
+        if isinstance(error, SessionExpired) or 'SessionExpired' in str(error):
+            set_props('session-expired', {'is_open': True})
+            return None
+        raise error
+
+    app = Dash("plots", suppress_callback_exceptions=True, external_stylesheets=[dbc.themes.BOOTSTRAP], #Suppress is true to allow divs to spawn divs without breaking system
+               compress=HTTP_COMPRESSION, #gzip the figures when flask-compress is installed
+               on_error=on_callback_error)
+    #parsing and 3D figures run as background jobs in their own process when diskcache is installed,
+    #they pick sessions up from disk like wsgi.py workers do
+    manager = background_manager()
+    if manager is not None and not sessions.shared_dir:
+        sessions.shared_dir = SESSION_DIR
+    #the sessions a request got stay loaded until it is answered (SessionStore.fit)
+    app.server.teardown_request(lambda error: sessions.unpin())
+    if watcher is not None:
+        #one process watches, the others (background jobs, wsgi.py workers) read its trial list from the shared dir
+        watcher.shared_dir = sessions.shared_dir
+        watcher.start()
+
+    def serve_layout():
+        '''Layout for each page load, every tab gets its own session id (see sessionStore.py)'''
+        sid = new_session_id()
+        sessions.get(sid, lambda: Session(filesList)) #new tabs start on the files picked at launch
+        session = session_for(sid)
+        return html.Div([ # Start of Dash App
+        dcc.Store(id='session-id', data=sid),
+        dbc.Alert("This page's session expired, reload the page to start again", id='session-expired',
+                  color='warning', is_open=False, style={'margin': '10px'}),
+            html.Link(
+            rel='stylesheet',
+            href='/assets/styles.css'  # Adjust the path to your CSS file
+        ),
+            html.Header(
+            html.H1("BiomechVis", style={'textAlign': 'center'}),
+            style={
+                'background-color': '#4da2f7',  # Set the background color of the header
+                'padding': '0px',
+                'padding-top': '5px',  # Set padding for the header
+                'padding-bottom': '5px',  # Set padding for the header
+                'color': 'white',  # Set text color
+                'width': '100%',
+
+            }
+        ),
+        dbc.Modal(id = "newGraphModal", children=[
+                dbc.ModalHeader("Add New 2D Graph", id='new-graph-modal-header'),
+                dbc.ModalBody(id='new-graph-modal-body', children=[
+                    html.Div(id='new-graph-attributes-div', children=[
+                        html.H5("Graph Attributes:"),
+                        html.Div(id='new-graph-attributes-inputs-div', children=[
+                            html.H6("Title:"), 
+                            dcc.Input(id='new-graph-title-input', type='text', placeholder='My New 2D Graph'),
+                            html.H6("X-Axis Title:"), 
+                            dcc.Input(id='new-graph-x-axis-input', type='text', placeholder='X'),
+                            html.H6("Y-Axis Title:"), 
+                            dcc.Input(id='new-graph-y-axis-input', type='text', placeholder='Y'),
+                            html.H6("Height:"), 
+                            dcc.Input(id="new-graph-height-input", type="number", placeholder=300, value=300, min=200, max=1000, debounce=True, style={"height": "20px", "margin-left": "5px"})
+                        ]),
                     ]),
+                    html.H5("Select the data for the Y-Axis:"),
+
+                    html.H6("Select the File:"),
+                    dcc.Dropdown(
+                        id='y-axis-select-file',
+                        options=session.file_list_2D,
+                        value='Mocap',
+                        clearable=False,
+                        style={'margin-bottom': '5px'}
+                    ),
+                    html.Div(id='new-graph-add-line-dropdowns-div', children = [ # Div that hold dropdown
+                        html.Div(id='new-graph-line-1-title', children=[
+                            html.H6("Line:", id='new-graph-modal-line-1-text'),
+                        ]),
+                        html.Div(id='new-graph-line-1-inputs',className='new-graph-line-inputs', children=[ 
+                            dcc.Dropdown(
+                                id={'type': 'new-graph-point-dropdown', 'index': f'{session.newGraphNumOfLines}'},
+                                options=[{"label": point, "value": point} for point in session.mocap_data_2D_graphs.keys()],
+                                value= list(session.mocap_data_2D_graphs.keys())[0],
+                                clearable=False,
+                                style={'width': '100%', 'margin-right': '4px'}
+                            ),
+                            dcc.Dropdown(
+                                id={'type': 'new-graph-xyz-dropdown', 'index': f'{session.newGraphNumOfLines}'},
+                                options=[{"label": "X", "value": "X"},
+                                        {"label": "Y", "value": "Y"},
+                                        {"label": "Z", "value": "Z"}],
+                                value="X",
+                                clearable=False,
+                                style={'width': '10%', 'margin-right': '4px'}
+                            ),     
+                            dbc.Input(type="color", id={'type': 'new-graph-color-picker', 'index': f'{session.newGraphNumOfLines}'},value="#000000",style={"width": '10%', 'height': '36px'}),
+                            dbc.Button("Remove", id='new-graph-original-remove-button', className='new-graph-remove-line-button')
+                        ]),
+                        ]),
+                    html.Div(id='new-graph-add-another-line-button-div', children=[dbc.Button("Add Another Line", id='new-graph-add-another-line-button')]),
+                    html.H5("Select the data for the X-Axis:", id="new-graph-x-axis-title"),
+                    html.P("(Default will be frames)"),
+                    html.H6("Select the File:"),
+                    dcc.Dropdown(
+                        id='x-axis-select-file',
+                        options=session.file_list_2D,
+                        value='Mocap',
+                        clearable=False,
+                        style={'margin-bottom': '5px'}
+                    ),
+                    html.H6("Select the Data:"),
+                    html.Div(id="new-graph-x-axis-dropdown-div", children= [
+                            dcc.Dropdown(
+                                id="x-axis-point-dropdown",
+                                options=[{"label": "Frames", "value": "frames"}] + [{"label": point, "value": point} for point in session.mocap_data_2D_graphs.keys()],
+                                value= "frames",
+                                clearable=False,
+                                style={'width': '100%', 'margin-right': '4px'}
+                            ),
+                            dcc.Dropdown(
+                                id="x-axis-xyz-dropdown",
+                                options=[{"label": "X", "value": "X"},
+                                        {"label": "Y", "value": "Y"},
+                                        {"label": "Z", "value": "Z"}],
+                                value="X",
+                                clearable=False,
+                                style={'width': '10%', 'margin-right': '4px', 'display': 'none'}
+                            ),                             
                     ]),
-                html.Div(id='new-graph-add-another-line-button-div', children=[dbc.Button("Add Another Line", id='new-graph-add-another-line-button')]),
-                html.H5("Select the data for the X-Axis:", id="new-graph-x-axis-title"),
-                html.P("(Default will be frames)"),
-                html.H6("Select the File:"),
-                dcc.Dropdown(
-                    id='x-axis-select-file',
-                    options=file_list_2D,
-                    value='Mocap',
-                    clearable=False,
-                    style={'margin-bottom': '5px'}
-                ),
-                html.H6("Select the Data:"),
-                html.Div(id="new-graph-x-axis-dropdown-div", children= [
-                        dcc.Dropdown(
-                            id="x-axis-point-dropdown",
-                            options=[{"label": "Frames", "value": "frames"}] + [{"label": point, "value": point} for point in mocap_data_2D_graphs.keys()],
-                            value= "frames",
-                            clearable=False,
-                            style={'width': '100%', 'margin-right': '4px'}
-                        ),
-                        dcc.Dropdown(
-                            id="x-axis-xyz-dropdown",
-                            options=[{"label": "X", "value": "X"},
-                                    {"label": "Y", "value": "Y"},
-                                    {"label": "Z", "value": "Z"}],
-                            value="X",
-                            clearable=False,
-                            style={'width': '10%', 'margin-right': '4px', 'display': 'none'}
-                        ),                             
                 ]),
-            ]),
-            dbc.ModalFooter(id='new-graph-modal-footer', children=[dbc.Button("Cancel", id="cancel-add-new-modal", className="ml-auto", style={'background': '#ededed', 'color': 'black', 'border-color': 'black'}),
-                             dbc.Button("Submit", id="submit-add-new-modal", className="ml-auto", style={'border-color': 'black'})]),
-            ], backdrop="static",
-    ), # End of the New Graph Modal
-    html.Div([ # Start of the Div that holds EVERYTHING
-        dcc.Location(
-            id="url",
-            pathname="/",
-            refresh=True
-        ),
+                dbc.ModalFooter(id='new-graph-modal-footer', children=[dbc.Button("Cancel", id="cancel-add-new-modal", className="ml-auto", style={'background': '#ededed', 'color': 'black', 'border-color': 'black'}),
+                                 dbc.Button("Submit", id="submit-add-new-modal", className="ml-auto", style={'border-color': 'black'})]),
+                ], backdrop="static",
+        ), # End of the New Graph Modal
+        html.Div([ # Start of the Div that holds EVERYTHING
+            dcc.Location(
+                id="url",
+                pathname="/",
+                refresh=True
+            ),
         
-        html.Div([ # Div to hold the dropdown stuff and the time series graphs
-            html.Div([ #Div for the drop Down stuff
-                html.Div([
-                    dcc.Upload(
-                        id='upload-data',
-                        children=html.Div([
-                            'Drag and Drop or ',
-                            html.A('Select Files')
-                        ]),
-                        style={
-                            'width': '98%',
-                            'height': '60px',
-                            'lineHeight': '60px',
-                            'borderWidth': '1px',
-                            'borderStyle': 'dashed',
-                            'borderRadius': '5px',
-                            'textAlign': 'center',
-                            'margin': '10px'
-                        },
-                        # Allow multiple files to be uploaded
-                        multiple=True
-                        ),
-                html.H4('Interactive Graph Selection for Time Series', style={"margin": '0px', 'margin-top': '5px', 'margin-bottom': '5px'}),
-                ]),
-                html.Div(id='hidden-div', children=[
-                    html.P('', id="chainCallback")
-                ], style={'display':'none'}),
-               
-            ]),
-            html.Div(id="outer-2d-graph-div", children=[ # Time Series Graphs Div
-                html.Div(id="inner-2d-graph-div", children=[
-                    html.Div(id='add-new-btn-and-graphs-div', children=[
-                        html.Div(id="normal-graphs-div", children=[]),
-                        html.Button("Add New 2D Graph", id="addNew2dGraphBtn")
+            html.Div([ # Div to hold the dropdown stuff and the time series graphs
+                html.Div([ #Div for the drop Down stuff
+                    html.Div([
+                        dcc.Upload(
+                            id='upload-data',
+                            children=html.Div([
+                                'Drag and Drop or ',
+                                html.A('Select Files')
+                            ]),
+                            style={
+                                'width': '98%',
+                                'height': '60px',
+                                'lineHeight': '60px',
+                                'borderWidth': '1px',
+                                'borderStyle': 'dashed',
+                                'borderRadius': '5px',
+                                'textAlign': 'center',
+                                'margin': '10px'
+                            },
+                            # Allow multiple files to be uploaded
+                            multiple=True
+                            ),
+                    html.Div(id='uploadProgress', className='job-progress', style={'display': 'none'}),
+                    watch_panel(),
+                    html.H4('Interactive Graph Selection for Time Series', style={"margin": '0px', 'margin-top': '5px', 'margin-bottom': '5px'}),
                     ]),
+                    html.Div(id='hidden-div', children=[
+                        html.P('', id="chainCallback")
+                    ], style={'display':'none'}),
+               
                 ]),
+                html.Div(id="outer-2d-graph-div", children=[ # Time Series Graphs Div
+                    html.Div(id="inner-2d-graph-div", children=[
+                        html.Div(id='add-new-btn-and-graphs-div', children=[
+                            html.Div(id="normal-graphs-div", children=[]),
+                            html.Button("Add New 2D Graph", id="addNew2dGraphBtn")
+                        ]),
+                    ]),
+                ],
+                style={ # Styling for the time Series Graphs Div
+                    'display': 'flex',
+                    'flex-direction': 'column',
+                    'overflow': 'auto',
+                    'max-height': '100vh'
+                })
             ],
-            style={ # Styling for the time Series Graphs Div
+            style={ # Styling for the Div that holds the Dropdown menu and the Times Series Graph
                 'display': 'flex',
                 'flex-direction': 'column',
-                'overflow': 'auto',
-                'max-height': '100vh'
-            })
+                'width': '50%',
+                'margin-right': '10px'
+
+            }),
+            html.Div([  # Div for the Actual 3D Visualization
+                html.Div([
+                    dcc.Checklist(
+                        [
+                            {
+                                "label": html.Div(['Points'], style={'font-size': 20}),
+                                "value": "Points", "disabled": True
+                            },
+                            {
+                                "label": html.Div(['Line'], style={'font-size': 20}),
+                                "value": "Line",
+                            },
+                            {
+                                "label": html.Div(['Anatomical Axes'], style={'font-size': 20}),
+                                "value": "Anatomical Axes",
+                            },
+                            {
+                                "label": html.Div(['Vector'], style={'font-size': 20}),
+                                "value": "Vector",
+                            },
+                        ], value=['Points'],
+                        inline=True,
+                        labelStyle={"display": "inline-block", "align-items": "center", "width" : "20%"},
+                        id='3dGenChecklist'
+                    ),
+                    dcc.RadioItems(
+                        [
+                            {"label": "Embedded Frames", "value": "embedded"},
+                            {"label": "Streaming", "value": "stream"},
+                            {"label": "Client", "value": "client"},
+                        ], value='embedded',
+                        inline=True,
+                        labelStyle={"margin-right": "15px"},
+                        id='3dPlaybackMode'
+                    ),
+                    html.Button('Generate 3D Graph', id='3dGenButton', n_clicks=0)
+                ])
+                # End of div that holds all framrate, current frame inputs and the sliders
+            ], 
+            style={ # Styling for the 3D Visiaulization Div
+                'display':'flex',
+                'justify-content': 'center',
+                'width': '50%',
+                "height": "100vh",
+                'flex-direction': 'column',
+                'margin-left': '10px'
+            }, id="3dGraphDiv"),        
         ],
-        style={ # Styling for the Div that holds the Dropdown menu and the Times Series Graph
+        style={ #Styling for the Div that hold the two main divs (Dropdown and Times Series Divs, and the 3D Visualization Div)
             'display': 'flex',
-            'flex-direction': 'column',
-            'width': '50%',
-            'margin-right': '10px'
-
-        }),
-        html.Div([  # Div for the Actual 3D Visualization
-            html.Div([
-                dcc.Checklist(
-                    [
-                        {
-                            "label": html.Div(['Points'], style={'font-size': 20}),
-                            "value": "Points", "disabled": True
-                        },
-                        {
-                            "label": html.Div(['Line'], style={'font-size': 20}),
-                            "value": "Line",
-                        },
-                        {
-                            "label": html.Div(['Anatomical Axes'], style={'font-size': 20}),
-                            "value": "Anatomical Axes",
-                        },
-                        {
-                            "label": html.Div(['Vector'], style={'font-size': 20}),
-                            "value": "Vector",
-                        },
-                    ], value=['Points'],
-                    inline=True,
-                    labelStyle={"display": "inline-block", "align-items": "center", "width" : "20%"},
-                    id='3dGenChecklist'
-                ),
-                html.Button('Generate 3D Graph', id='3dGenButton', n_clicks=0)
-            ])
-            # End of div that holds all framrate, current frame inputs and the sliders
-        ], 
-        style={ # Styling for the 3D Visiaulization Div
-            'display':'flex',
-            'justify-content': 'center',
-            'width': '50%',
-            "height": "100vh",
-            'flex-direction': 'column',
-            'margin-left': '10px'
-        }, id="3dGraphDiv"),        
-    ],
-    style={ #Styling for the Div that hold the two main divs (Dropdown and Times Series Divs, and the 3D Visualization Div)
-        'display': 'flex',
-        'width' : '100%',
-        'flex-direction': 'row-reverse',
-        'height': '90vh'
-    }) # End of the Div that holds eveyrthing
-    ],
-    style={
-        'width': '100%',
-        'padding': '0px',
-        'margin': '0px'
-    }) # End of Dash App
+            'width' : '100%',
+            'flex-direction': 'row-reverse',
+            'height': '90vh'
+        }) # End of the Div that holds eveyrthing
+        ] + compare_panel() + debug_panel(),
+        style={
+            'width': '100%',
+            'padding': '0px',
+            'margin': '0px'
+        }) # End of Dash App
+
+    app.layout = serve_layout
 
    
     # Callback for drawing the 3D Plot
-    @app.callback(
+    # Generate, a new framerate or new files rebuild the figure as a background job (backgroundJobs.py),
+    # a new upload or another Generate click stops the one still running
+    @job_callback(app, manager,
         Output("graph4", "figure"), 
+        Output("3dStreamConfig", "data"),
+        Output("3dStreamControls", "style"),
+        Output("3dClientTrial", "data"),
+        Output("3dClientControls", "style"),
+        Output("3dLayerState", "data"),
+        Output("3dSeekFrame", "data"),
         Input("3dGenButton", 'n_clicks'),
-        Input("3dInputSlider", "value"),
         Input("3dFramerateInput", "value"),
-        Input('upload-data', 'contents'),
-        State('3dGenChecklist', 'value'))
-    def draw_3d_graph(n_clicks, startingFrame, framerate, filecontents, checklistValues):
-        global points, COMs, axes, vectors, all_points_for_2D_graphs, mocap_data_2D_graphs, TBCM_2D_graphs, TBCMVeloc_2D_graphs, file_list_2D
-        global dfs, labels
-        points, COMs, axes, vectors, all_points_for_2D_graphs, mocap_data_2D_graphs, TBCM_2D_graphs, TBCMVeloc_2D_graphs, file_list_2D = read_Mitchell_data(framerate)
-        dfs, labels = filter_points_to_draw(points, COMs)
-        main_plot = base_plot(dfs, labels, startingFrame // framerate)
-        if 'Line' in checklistValues:
-            main_plot = draw_line(main_plot, [COMs[list(COMs.keys())[0]], points[list(points.keys())[0]]], [COMs[list(COMs.keys())[1]], points[list(points.keys())[1]]], startingFrame // framerate)
-        if 'Anatomical Axes' in checklistValues:
-            main_plot = draw_anat_ax(main_plot, axes, COMs, startingFrame // framerate)
-        if 'Vector' in checklistValues:
-            main_plot = draw_vectors(main_plot, vectors, startingFrame // framerate)
-        return main_plot
+        Input('chainCallback', 'children'), #set once the uploaded files are loaded
+        State("3dInputSlider", "value"),
+        State('3dGenChecklist', 'value'),
+        State('3dPlaybackMode', 'value'),
+        State('session-id', 'data'),
+        progress=Output('3dProgress', 'children'),
+        running=[(Output('3dProgress', 'style'), {'display': 'block'}, {'display': 'none'})],
+        cancel=[Input('upload-data', 'contents')])
+    def draw_3d_graph(set_progress, n_clicks, framerate, chainCallbackValue, startingFrame, checklistValues, playbackMode, sid):
+        set_progress("Loading trial")
+        with metrics.stage('load'):
+            session = session_for(sid, framerate, set_progress)
+        layers = [layer for layer in checklistValues if layer != 'Points']
+        hidden = {'display': 'none'}
+        shown = {'display': 'flex', 'justify-content': 'center', 'align-items': 'center'}
+
+        drawn = session.drawn
+        start = min((startingFrame or 0) // framerate, drawn.frame_count - 1)
+        #streaming and client playback only need the start frame in the figure, the rest is sent separately
+        #Embedded Frames draws every layer, unchecked ones hidden, so toggling one doesn't touch the frames
+        embedded = playbackMode not in ('stream', 'client')
+        drawn_layers = list(LINE_LAYERS) if embedded else layers
+        lines, counts, hidden_traces = [], [], []
+        with metrics.stage('layers'):
+            for layer in drawn_layers:
+                layer_lines_ = layer_traces(session.points, session.axes, session.vectors, layer)
+                if layer not in layers:
+                    hidden_traces += range(1 + len(lines), 1 + len(lines) + len(layer_lines_))
+                lines += layer_lines_
+                counts.append(len(layer_lines_))
+        set_progress("Building figure")
+        with metrics.stage('figure'):
+            main_plot = base_plot(drawn, start, animate=embedded, lines=lines)
+            for idx in hidden_traces:
+                main_plot.data[idx].visible = False
+        state = {'layers': layers, 'drawn': drawn_layers, 'traces': counts, 'framerate': framerate, 'mode': playbackMode,
+                 'frames': drawn.frame_count}
+        if playbackMode == 'stream':
+            return main_plot, stream_config(session, start, layers), shown, None, hidden, state, None
+        if playbackMode == 'client':
+            set_progress("Packing trial for the browser")
+            with metrics.stage('client trial'):
+                trial = client_trial(session, start, layers)
+            return main_plot, None, hidden, trial, shown, state, None
+        return main_plot, None, hidden, None, hidden, state, {'frame': start, 'mode': playbackMode}
+
+    # Moving the slider or toggling a layer only patches the figure drawn above, in the request (it is quick)
+    @app.callback(
+        Output("graph4", "figure", allow_duplicate=True),
+        Output("3dStreamConfig", "data", allow_duplicate=True),
+        Output("3dClientTrial", "data", allow_duplicate=True),
+        Output("3dLayerState", "data", allow_duplicate=True),
+        Output("3dSeekFrame", "data", allow_duplicate=True),
+        Input("3dInputSlider", "value"),
+        Input('3dGenChecklist', 'value'),
+        State("3dFramerateInput", "value"),
+        State('3dLayerState', 'data'),
+        State('session-id', 'data'),
+        prevent_initial_call=True)
+    def patch_3d_view(startingFrame, checklistValues, framerate, layerState, sid):
+        if not layerState or layerState['framerate'] != framerate:
+            raise PreventUpdate #nothing drawn yet or the draw job for a new framerate is still running
+        with metrics.stage('load'):
+            session = session_for(sid, framerate)
+        layers = [layer for layer in checklistValues if layer != 'Points']
+        start = min(startingFrame // framerate, layerState['frames'] - 1)
+        with metrics.stage('patch'):
+            patched, state = patch_3d_graph(session, layerState, start, layers)
+        mode = state['mode']
+        if mode == 'stream':
+            return patched, stream_config(session, start, state['layers']), no_update, state, no_update
+        if mode == 'client':
+            with metrics.stage('client trial'):
+                trial = client_trial(session, start, state['layers']) if state['layers'] != layerState['layers'] else no_update
+            return patched, no_update, trial, state, {'frame': start, 'mode': mode}
+        return patched, no_update, no_update, state, {'frame': start, 'mode': mode}
+
+    # Streaming playback: the browser asks for the next few frames as its buffer drains (see assets/playback.js)
+    @app.callback(
+        Output("3dStreamBatch", "data"),
+        Input("3dStreamRequest", "data"),
+        State('session-id', 'data'),
+        prevent_initial_call=True)
+    def send_stream_batch(request, sid):
+        if not request:
+            raise PreventUpdate
+        batch = stream_batch(session_for(sid, request.get('framerate')), request['start'], min(request['count'], STREAM_BATCH), request['layers'])
+        batch['gen'] = request['gen']
+        return batch
+
+    app.clientside_callback(
+        ClientsideFunction(namespace='biomech', function_name='stream_control'),
+        Output("3dStreamTick", "disabled"),
+        Output("3dStreamRequest", "data"),
+        Input("3dStreamPlay", "n_clicks"),
+        Input("3dStreamPause", "n_clicks"),
+        Input("3dStreamRestart", "n_clicks"),
+        Input("3dStreamConfig", "data"))
+
+    app.clientside_callback(
+        ClientsideFunction(namespace='biomech', function_name='stream_tick'),
+        Output("3dStreamRequest", "data", allow_duplicate=True),
+        Output("3dStreamTick", "disabled", allow_duplicate=True),
+        Input("3dStreamTick", "n_intervals"),
+        prevent_initial_call=True)
+
+    app.clientside_callback(
+        ClientsideFunction(namespace='biomech', function_name='stream_receive'),
+        Output("3dStreamBuffered", "data"),
+        Input("3dStreamBatch", "data"),
+        prevent_initial_call=True)
+
+    # Client playback: the whole trial is in 3dClientTrial, play/pause/scrub never go back to the server
+    app.clientside_callback(
+        ClientsideFunction(namespace='biomech', function_name='client_load'),
+        Output("3dClientSlider", "max"),
+        Output("3dClientSlider", "value"),
+        Input("3dClientTrial", "data"))
+
+    app.clientside_callback(
+        ClientsideFunction(namespace='biomech', function_name='client_frame'),
+        Output("3dClientFrame", "data"),
+        Input("3dClientSlider", "value"),
+        prevent_initial_call=True)
+
+    app.clientside_callback(
+        ClientsideFunction(namespace='biomech', function_name='seek_frame'),
+        Output("3dClientSlider", "value", allow_duplicate=True),
+        Input("3dSeekFrame", "data"),
+        prevent_initial_call=True)
+
+    app.clientside_callback(
+        ClientsideFunction(namespace='biomech', function_name='client_play'),
+        Output("3dClientTick", "disabled"),
+        Input("3dClientPlay", "n_clicks"),
+        Input("3dClientPause", "n_clicks"),
+        Input("3dClientTrial", "data"))
+
+    app.clientside_callback(
+        ClientsideFunction(namespace='biomech', function_name='client_tick'),
+        Output("3dClientSlider", "value", allow_duplicate=True),
+        Output("3dClientTick", "disabled", allow_duplicate=True),
+        Input("3dClientTick", "n_intervals"),
+        State("3dClientSlider", "value"),
+        State("3dClientSlider", "max"),
+        prevent_initial_call=True)
 
     @app.callback(
     Output("newGraphModal", "is_open"),
@@ -664,13 +1272,15 @@ def dash():
     [Input("addNew2dGraphBtn", "n_clicks"),
     Input("cancel-add-new-modal", "n_clicks"),
     Input("submit-add-new-modal", "n_clicks")],
-    [State("newGraphModal", "is_open"), State('new-graph-add-line-dropdowns-div', "children")], prevent_initial_call=True
+    [State("newGraphModal", "is_open"), State('new-graph-add-line-dropdowns-div', "children"), State('session-id', 'data')], prevent_initial_call=True
     )   
-    def toggle_add_new_modal(n_clicks_open, n_clicks_close, n_clicks_submit, is_open, current_children):
-        global newGraphNumOfLines
+    def toggle_add_new_modal(n_clicks_open, n_clicks_close, n_clicks_submit, is_open, current_children, sid):
+        session = session_for(sid)
         if n_clicks_open or n_clicks_close or n_clicks_submit:
-            if newGraphNumOfLines != 1:
+            if session.newGraphNumOfLines != 1:
+                session.newGraphNumOfLines = 1
                 newGraphNumOfLines = 1
+                sessions.save(sid)
                 new_children = [html.Div([
                 html.Div(id='new-graph-line-1-title', children=[
                 html.H6("Line:", id='new-graph-modal-line-1-text'),
@@ -678,8 +1288,8 @@ def dash():
                 html.Div(id='new-graph-line-1-inputs',className='new-graph-line-inputs', children=[ 
                     dcc.Dropdown(
                         id={'type': "new-graph-point-dropdown", 'index': f'{newGraphNumOfLines}'},
-                        options=[{"label": point, "value": point} for point in selected_y_axis_point_2D.keys()],
-                        value= list(selected_y_axis_point_2D.keys())[0],
+                        options=[{"label": point, "value": point} for point in session.mocap_data_2D_graphs.keys()],
+                        value= list(session.mocap_data_2D_graphs.keys())[0],
                         clearable=False,
                         style={'width': '100%', 'margin-right': '4px'}
                     ),
@@ -704,13 +1314,14 @@ def dash():
         Output('new-graph-add-line-dropdowns-div', 'children', allow_duplicate=True),
         Input('new-graph-add-another-line-button', 'n_clicks'),
         State('new-graph-add-line-dropdowns-div', "children"),
+        State('session-id', 'data'),
         prevent_initial_call=True
     )
-    def add_line_options(n_clicks, current_children):
-        global points
-        global newGraphNumOfLines
-
-        newGraphNumOfLines = newGraphNumOfLines + 1
+    def add_line_options(n_clicks, current_children, sid):
+        session = session_for(sid)
+        session.newGraphNumOfLines = session.newGraphNumOfLines + 1
+        newGraphNumOfLines = session.newGraphNumOfLines
+        sessions.save(sid)
 
         current_children.append(html.Div(id={'type': 'new-graph-dynamically-added-inputs-div', 'index': f'{newGraphNumOfLines}'}, children=[
             html.Div(id=f'new-graph-line-{newGraphNumOfLines}-title', children=[
@@ -719,8 +1330,8 @@ def dash():
                     html.Div(id={'type': 'new-graph-dynamic-inputs-div', 'index': f'{newGraphNumOfLines}'},className='new-graph-line-inputs', children=[ 
                         dcc.Dropdown(
                             id={'type': 'new-graph-point-dropdown', 'index': f'{newGraphNumOfLines}'},
-                            options=[{"label": point, "value": point} for point in selected_y_axis_point_2D.keys()],
-                            value= list(selected_y_axis_point_2D.keys())[0],
+                            options=[{"label": point, "value": point} for point in session.mocap_data_2D_graphs.keys()],
+                            value= list(session.mocap_data_2D_graphs.keys())[0],
                             clearable=False,
                             style={'width': '100%', 'margin-right': '4px'}
                         ),
@@ -758,96 +1369,83 @@ def dash():
         State('new-graph-x-axis-input', 'value'),
         State('new-graph-y-axis-input', 'value'),
         State('new-graph-height-input', 'value'),
-        State("normal-graphs-div", "children")], prevent_initial_call=True
+        State("normal-graphs-div", "children"),
+        State('session-id', 'data')], prevent_initial_call=True
     )
-    def add_new_graph(submit_clicks, selected_point_keys, selected_xyzs, lineColors, x_axis_point, x_axis_xyz, title, x_axis_title, y_axis_title, height, current_children):
-        global numOf2dGraphs
-        global all_points_for_2D_graphs
-        fig = go.Figure()
-        y_title_not_given = False
-
-        if y_axis_title is None: 
-            y_title_not_given = True
-            y_axis_title = ""
-        if height is None: height = 300
-
-        for i in range(len(selected_point_keys)):
-            selected_point_key = selected_point_keys[i]
-            selected_xyz = selected_xyzs[i]
-            lineColor = lineColors[i]
-            if y_title_not_given:
-                y_axis_title = y_axis_title + selected_point_key + "_" + selected_xyz
-                if i < len(selected_point_keys)-1:
-                    y_axis_title += ", "
-
-            selected_point = all_points_for_2D_graphs[selected_point_key]  
-
-
-            if selected_xyz == "X":
-                point = selected_point[:, 0].T
-            elif selected_xyz == "Y":
-                point = selected_point[:, 1].T
-            elif selected_xyz == "Z":
-                point = selected_point[:, 2].T
-
-            if(i==0):
-                if(x_axis_point == "frames"):
-                    if x_axis_title is None: x_axis_title = "Frames"
-                    x_axis_point = list(range(len(point)))
-                else:
-                    if x_axis_title is None: x_axis_title = x_axis_point + "_" + x_axis_xyz
-
-                    x_axis_point = all_points_for_2D_graphs[x_axis_point]
-                    if x_axis_xyz == "X":
-                        x_axis_point = x_axis_point[:, 0].T
-                    elif x_axis_xyz == "Y":
-                        x_axis_point = x_axis_point[:, 1].T
-                    elif x_axis_xyz == "Z":
-                        x_axis_point = x_axis_point[:, 2].T
-
-            fig.add_trace(go.Scatter(x=x_axis_point , y=point, mode='markers+lines', line=dict(color=lineColor), name=f"{selected_point_key} {selected_xyz}"))
-        
-        if title is None: title = y_axis_title + " Plotted Over " + x_axis_title
-
-        fig.update_layout(title=title, xaxis_title=x_axis_title,
-                                            yaxis_title=y_axis_title, height=height)
-        
+    def add_new_graph(submit_clicks, selected_point_keys, selected_xyzs, lineColors, x_axis_point, x_axis_xyz, title, x_axis_title, y_axis_title, height, current_children, sid):
+        with metrics.stage('load'):
+            session = session_for(sid)
+        #what each line plots, kept with the graph so zooming can re-read the full resolution data
+        spec = {'x': [x_axis_point, x_axis_xyz], 'lines': [list(line) for line in zip(selected_point_keys, selected_xyzs)]}
+        with metrics.stage('figure'):
+            fig = new_graph_figure(session, spec, lineColors, title, x_axis_title, y_axis_title, height)
 
         if submit_clicks:
-            numOf2dGraphs = numOf2dGraphs + 1 
+            session.numOf2dGraphs = session.numOf2dGraphs + 1 
+            numOf2dGraphs = session.numOf2dGraphs
+            sessions.save(sid)
             current_children.append(html.Div(className='dynamically-added-graph-divs', id={'type':'dynamically-added-graph-divs', 'index':f'{numOf2dGraphs}'}, children=[
-                                        dcc.Graph(figure=fig),
+                                        dcc.Graph(figure=fig, id={'type': 'dynamically-added-graph', 'index': f'{numOf2dGraphs}'}),
                                         html.Div(className='dynaimically-add-button-div', id={'type': 'button-div', 'index':f'{numOf2dGraphs}'}, children=[
                                             html.Button("Remove Graph",className='remove-graph-button', id={'type':'remove-button', 'index': f'{numOf2dGraphs}'}, style={'margin': '10px'})
                                         ]),
+                                        dcc.Store(id={'type': 'dynamically-added-graph-spec', 'index': f'{numOf2dGraphs}'}, data=spec),
                                         ], style={'display': 'flex', 'align-items': 'center', 'justify-content': 'center', 'flex-direction': 'column'})) 
 
         return current_children, None, None, None, 300, "frames", " "
     
+    # Zooming a 2D graph re-sends its lines for just the visible window, zooming out goes back to the whole trial
+    @app.callback(
+        Output({'type': 'dynamically-added-graph', 'index': MATCH}, 'figure'),
+        Input({'type': 'dynamically-added-graph', 'index': MATCH}, 'relayoutData'),
+        State({'type': 'dynamically-added-graph-spec', 'index': MATCH}, 'data'),
+        State('session-id', 'data'),
+        prevent_initial_call=True
+    )
+    def zoom_2d_graph(relayoutData, spec, sid):
+        changed, x_range = zoom_range(relayoutData)
+        if not changed or spec is None:
+            return no_update
+        session = session_for(sid)
+        patched = Patch()
+        for i in range(len(spec['lines'])):
+            x, y = line_samples(session, spec, i, x_range)
+            patched['data'][i]['x'] = x
+            patched['data'][i]['y'] = y
+        return patched
+
     @app.callback(
     Output({'type': "new-graph-point-dropdown", 'index': MATCH}, "options", allow_duplicate=True),
     Output({'type': "new-graph-point-dropdown", 'index': MATCH}, "value", allow_duplicate=True),
-    [Input("y-axis-select-file", "value")], prevent_initial_call='initial_duplicate'
+    [Input("y-axis-select-file", "value")], State('session-id', 'data'), prevent_initial_call='initial_duplicate'
     )
-    def update_y_axis_options(selected_value):
+    def update_y_axis_options(selected_value, sid):
+        session = session_for(sid)
+        mocap_data_2D_graphs, TBCM_2D_graphs, TBCMVeloc_2D_graphs = session.mocap_data_2D_graphs, session.TBCM_2D_graphs, session.TBCMVeloc_2D_graphs
         if selected_value == "Mocap":
             return [{"label": point, "value": point} for point in mocap_data_2D_graphs.keys()], list(mocap_data_2D_graphs.keys())[0]
         elif selected_value == "TBCM":
             return [{"label": point, "value": point} for point in TBCM_2D_graphs.keys()],  list(TBCM_2D_graphs.keys())[0]
         elif selected_value == "TBCMVeloc":
             return [{"label": point, "value": point} for point in TBCMVeloc_2D_graphs.keys()],  list(TBCMVeloc_2D_graphs.keys())[0]
+        elif selected_value == "Derived":
+            return [{"label": point, "value": point} for point in session.derived_2D_graphs.keys()],  list(session.derived_2D_graphs.keys())[0]
 
     @app.callback(
     Output("x-axis-point-dropdown", "options"),
-    [Input("x-axis-select-file", "value")], prevent_initial_call=True
+    [Input("x-axis-select-file", "value")], State('session-id', 'data'), prevent_initial_call=True
     )
-    def update_x_axis_options(selected_value):
+    def update_x_axis_options(selected_value, sid):
+        session = session_for(sid)
+        mocap_data_2D_graphs, TBCM_2D_graphs, TBCMVeloc_2D_graphs = session.mocap_data_2D_graphs, session.TBCM_2D_graphs, session.TBCMVeloc_2D_graphs
         if selected_value == "Mocap":
             return [{"label": "Frames", "value": "frames"}] + [{"label": point, "value": point} for point in mocap_data_2D_graphs.keys()]
         elif selected_value == "TBCM":
             return [{"label": "Frames", "value": "frames"}] + [{"label": point, "value": point} for point in TBCM_2D_graphs.keys()]
         elif selected_value == "TBCMVeloc":
             return [{"label": "Frames", "value": "frames"}] + [{"label": point, "value": point} for point in TBCMVeloc_2D_graphs.keys()]
+        elif selected_value == "Derived":
+            return [{"label": "Frames", "value": "frames"}] + [{"label": point, "value": point} for point in session.derived_2D_graphs.keys()]
 
 
     @app.callback(
@@ -902,9 +1500,10 @@ def dash():
     @app.callback(
         Output("sliderDiv", "children"),
         Input("3dFramerateInput", "value"),
-        Input('chainCallback', 'children'))
-    def callback(framerate, chainCallbackValue):
-        global frameLength
+        Input('chainCallback', 'children'),
+        State('session-id', 'data'))
+    def callback(framerate, chainCallbackValue, sid):
+        frameLength = session_for(sid).frameLength
 
         div = html.Div([
             dcc.Slider(
@@ -920,10 +1519,11 @@ def dash():
         Output("3dGraphDiv", "children"),
         Input("3dGenButton", "n_clicks"),
         State("3dGraphDiv", "children"),
+        State('session-id', 'data'),
         prevent_inital_call=True,
         running=[(Output("3dGenButton", "disabled"), True, False)]
         )
-    def callback(n_clicks, ogChildren):
+    def callback(n_clicks, ogChildren, sid):
 
         print(n_clicks)
         if n_clicks == 0 or n_clicks is None:
@@ -939,6 +1539,29 @@ def dash():
                                 dcc.Graph(id="graph4", config={'responsive': True}),
                             ]
                         ),
+                        html.Div(id='3dProgress', className='job-progress', style={'display': 'none'}),
+                        html.Div([ # Stream playback controls, only shown in Streaming mode
+                            html.Button('Play', id='3dStreamPlay'),
+                            html.Button('Pause', id='3dStreamPause'),
+                            html.Button('Restart', id='3dStreamRestart'),
+                        ], id='3dStreamControls', style={'display': 'none'}),
+                        dcc.Interval(id='3dStreamTick', interval=STREAM_TICK_MS, disabled=True),
+                        dcc.Store(id='3dStreamConfig'),
+                        dcc.Store(id='3dStreamRequest'),
+                        dcc.Store(id='3dStreamBatch'),
+                        dcc.Store(id='3dStreamBuffered'),
+                        html.Div([ # Client playback controls, only shown in Client mode
+                            html.Button('Play', id='3dClientPlay'),
+                            html.Button('Pause', id='3dClientPause'),
+                            html.Div([
+                                dcc.Slider(0, 1, 1, value=0, id='3dClientSlider', updatemode='drag', marks=None),
+                            ], style={'flex-grow': 1}),
+                        ], id='3dClientControls', style={'display': 'none'}),
+                        dcc.Interval(id='3dClientTick', interval=STREAM_TICK_MS, disabled=True),
+                        dcc.Store(id='3dClientTrial'),
+                        dcc.Store(id='3dClientFrame'),
+                        dcc.Store(id='3dLayerState'),
+                        dcc.Store(id='3dSeekFrame'),
                     ], style={"height": "50vh"}) # End of Div for the 3D graph only
             div2 =  html.Div([ # Start of div that holds all framrate, current frame inputs and the sliders
                         html.Div([ # Start of div that holds both the framerate and current frame inputs
@@ -982,7 +1605,7 @@ def dash():
             div3 = html.P('Frame Slider', style={"margin": "0px", "font-weight": "bold"})
             div4 = html.Div([
                         dcc.Slider(
-                            0, frameLength, 1,
+                            0, session_for(sid).frameLength, 1,
                             value=0,
                             id='3dInputSlider',
                         )], id="sliderDiv")
@@ -992,7 +1615,8 @@ def dash():
 
             return newChildren
     
-    @app.callback(
+    # Uploads are spooled and parsed as a background job, a newer upload stops the one still running
+    @job_callback(app, manager,
         Output({"type": "new-graph-point-dropdown", "index": '1'}, "value"),
         Output({"type": "new-graph-point-dropdown", "index": '1'}, "options"),
         Output('chainCallback', 'children'),
@@ -1002,10 +1626,12 @@ def dash():
         Input('upload-data', 'contents'),
         State('upload-data', 'filename'),
         State('upload-data', 'last_modified'),
+        State('session-id', 'data'),
+        progress=Output('uploadProgress', 'children'),
+        running=[(Output('uploadProgress', 'style'), {'display': 'block'}, {'display': 'none'})],
         prevent_initial_call=True)
-    def update_output(list_of_contents, list_of_names, list_of_dates):
+    def update_output(set_progress, list_of_contents, list_of_names, list_of_dates, sid):
         if list_of_contents is not None:
-            global filesList, removedTraces
             filesList = {'AnatAx' : [], 'SegCOM': [], 
              'TBCM' : [], 'TBCMVeloc' : [],
              'MocapData' : []}
@@ -1014,66 +1640,180 @@ def dash():
             AnatAxNew = False
             SegComNew = False
             MocapNew = False
-            #https://stackoverflow.com/questions/1124810/how-can-i-find-path-to-given-file
-            for filename in list_of_names:
-                for root, dirs, files in os.walk(os.getcwd()):
-                    for name in files:
-                        if name == filename:
-                            if "tbcm_" in filename.casefold():
-                                if not TBCMnew:
-                                    filesList['TBCM'] = []
-                                filesList['TBCM'].append(os.path.abspath(os.path.join(root, name)))
-                                TBCMnew = True
-                            if "tbcmveloc" in filename.casefold():
-                                if not TBCMVelocNew:
-                                    filesList['TBCMVeloc'] = []
-                                filesList['TBCMVeloc'].append(os.path.abspath(os.path.join(root, name)))
-                                TBCMVelocNew = True
-                            if "segcom" in filename.casefold():
-                                if not SegComNew:
-                                    filesList['SegCOM'] = []
-                                filesList['SegCOM'].append(os.path.abspath(os.path.join(root, name)))
-                                SegComNew = True
-                            if "anatax" in filename.casefold():
-                                if not AnatAxNew:
-                                    filesList['AnatAx'] = []
-                                filesList['AnatAx'].append(os.path.abspath(os.path.join(root, name)))
-                                AnatAxNew = True
-                            if "mocap" in filename.casefold():
-                                if not MocapNew:
-                                    filesList['MocapData'] = []
-                                filesList['MocapData'].append(os.path.abspath(os.path.join(root, name)))
-                                MocapNew = True
-            global points, COMs, axes, vectors, all_points_for_2D_graphs, mocap_data_2D_graphs, TBCM_2D_graphs, TBCMVeloc_2D_graphs, selected_y_axis_point_2D, file_list_2D
-            global dfs, labels
-            global frameLength
-            global numOf2dGraphs
-            numOf2dGraphs=0
-            points, COMs, axes, vectors, all_points_for_2D_graphs, mocap_data_2D_graphs, TBCM_2D_graphs, TBCMVeloc_2D_graphs, file_list_2D = read_Mitchell_data(frameRate)
-            selected_y_axis_point_2D = mocap_data_2D_graphs
-            dfs, labels = filter_points_to_draw(points, COMs)
-            frameLength = len(dfs) * frameRate
-            return list(points.keys())[0], list(points.keys()), frameLength, [], file_list_2D, file_list_2D 
+            #the uploaded bytes are spooled to disk chunk by chunk (uploadSpool.py) instead of searching the cwd for the name
+            for i, (filename, contents) in enumerate(zip(list_of_names, list_of_contents)):
+                set_progress(f"Receiving {filename} ({i + 1}/{len(list_of_names)})")
+                with metrics.stage('spool'):
+                    path = spool_upload(filename, contents)
+                if "tbcm_" in filename.casefold():
+                    if not TBCMnew:
+                        filesList['TBCM'] = []
+                    filesList['TBCM'].append(path)
+                    TBCMnew = True
+                if "tbcmveloc" in filename.casefold():
+                    if not TBCMVelocNew:
+                        filesList['TBCMVeloc'] = []
+                    filesList['TBCMVeloc'].append(path)
+                    TBCMVelocNew = True
+                if "segcom" in filename.casefold():
+                    if not SegComNew:
+                        filesList['SegCOM'] = []
+                    filesList['SegCOM'].append(path)
+                    SegComNew = True
+                if "anatax" in filename.casefold():
+                    if not AnatAxNew:
+                        filesList['AnatAx'] = []
+                    filesList['AnatAx'].append(path)
+                    AnatAxNew = True
+                if "mocap" in filename.casefold():
+                    if not MocapNew:
+                        filesList['MocapData'] = []
+                    filesList['MocapData'].append(path)
+                    MocapNew = True
+            return switch_files(sid, filesList, set_progress)
+
+    if watcher is not None:
+        # The trial list is refreshed when the watcher ingested something (trialWatcher.py)
+        @app.callback(
+            Output('watch-trials', 'options'),
+            Output('watch-version', 'data'),
+            Input('watch-interval', 'n_intervals'),
+            State('watch-version', 'data'))
+        def refresh_watched_trials(n_intervals, version):
+            watcher.start() #its thread doesn't survive the fork into wsgi.py workers, it takes over if the watching one exits
+            if watcher.version == version:
+                raise PreventUpdate
+            return [{'label': name, 'value': name} for name in watcher.trials()], watcher.version
+
+        # Opening a captured trial switches this tab to it like an upload, its files are already parsed
+        @job_callback(app, manager,
+            Output({"type": "new-graph-point-dropdown", "index": '1'}, "value", allow_duplicate=True),
+            Output({"type": "new-graph-point-dropdown", "index": '1'}, "options", allow_duplicate=True),
+            Output('chainCallback', 'children', allow_duplicate=True),
+            Output("normal-graphs-div", 'children', allow_duplicate=True),
+            Output('y-axis-select-file', 'options', allow_duplicate=True),
+            Output('x-axis-select-file', 'options', allow_duplicate=True),
+            Input('watch-trials', 'value'),
+            State('session-id', 'data'),
+            progress=Output('uploadProgress', 'children'),
+            running=[(Output('uploadProgress', 'style'), {'display': 'block'}, {'display': 'none'})],
+            cancel=[Input('upload-data', 'contents')],
+            prevent_initial_call=True)
+        def open_watched_trial(set_progress, name, sid):
+            files = files_by_kind(watcher.trials().get(name, []))
+            if not files['MocapData']:
+                raise PreventUpdate #cleared, or its mocap file hasn't landed yet
+            return switch_files(sid, files, set_progress)
+
+    # Trials to compare are uploaded together and grouped by name, each keeps its own files (trialBatch.py)
+    @job_callback(app, manager,
+        Output('compare-trials', 'children'),
+        Output('compare-marker', 'options'),
+        Output('compare-marker', 'value'),
+        Output('compare-event-marker', 'options'),
+        Output('compare-event-marker', 'value'),
+        Input('compare-upload', 'contents'),
+        State('compare-upload', 'filename'),
+        State('compare-marker', 'value'),
+        State('compare-event-marker', 'value'),
+        State('session-id', 'data'),
+        progress=Output('compare-progress', 'children'),
+        running=[(Output('compare-progress', 'style'), {'display': 'block'}, {'display': 'none'})],
+        prevent_initial_call=True)
+    def load_compare_trials(set_progress, list_of_contents, list_of_names, marker, eventMarker, sid):
+        paths = []
+        for i, (filename, contents) in enumerate(zip(list_of_names, list_of_contents)):
+            set_progress(f"Receiving {filename} ({i + 1}/{len(list_of_names)})")
+            with metrics.stage('spool'):
+                paths.append(spool_upload(filename, contents))
+        trials = {name: files_by_kind(files) for name, files in group_trials(paths).items()}
+        trials = {name: files for name, files in trials.items() if files['MocapData']}
+        if not trials:
+            return html.P("No trial with a mocap data file was uploaded"), [], None, [], None
+        trial_cache.invalidate(paths, stale_only=True)
+        session = sessions.get(sid)
+        session.compare_files = trials
+        sessions.save(sid)
+        with metrics.stage('load'):
+            batch = load_trial_batch(trials, set_progress)
+        summary = ", ".join(f"{name or '(unnamed)'} ({length} frames)" for name, length in zip(batch.names, batch.lengths))
+        return (html.P(f"{len(batch)} trials: {summary}"), batch.labels, marker if marker in batch else batch.labels[0],
+                batch.labels, eventMarker if eventMarker in batch else None)
 
-    #When giving code, set debug to False to make only one tkinter run needed
-    app.run_server(debug=False)
+    @app.callback(
+        Output('compare-event-marker', 'disabled'),
+        Output('compare-event-xyz', 'disabled'),
+        Input('compare-align', 'value'))
+    def toggle_compare_event(alignment):
+        off = alignment not in ('max', 'min')
+        return off, off
+
+    @app.callback(
+        Output('compare-graph', 'figure'),
+        Output('compare-graph', 'style'),
+        Input('compare-marker', 'value'),
+        Input('compare-xyz', 'value'),
+        Input('compare-align', 'value'),
+        Input('compare-show', 'value'),
+        Input('compare-event-marker', 'value'),
+        Input('compare-event-xyz', 'value'),
+        Input('compare-trials', 'children'), #a new upload with the same marker selected
+        State('session-id', 'data'),
+        prevent_initial_call=True)
+    def draw_comparison(label, xyz, alignment, show, eventLabel, eventXyz, trialsText, sid):
+        session = sessions.get(sid)
+        if not session.compare_files or not label:
+            raise PreventUpdate
+        with metrics.stage('load'):
+            batch = load_trial_batch(session.compare_files)
+        if label not in batch:
+            raise PreventUpdate
+        event = (eventLabel if eventLabel in batch else label, eventXyz or xyz)
+        with metrics.stage('figure'):
+            fig = comparison_figure(batch, label, xyz, alignment, show, event)
+        return fig, {'display': 'block'}
+
+    # Callback timings (callbackMetrics.py) as JSON, only for requests from this machine
+    @app.server.route('/_biomechvis/metrics')
+    def callback_metrics():
+        if flask.request.remote_addr not in ('127.0.0.1', '::1'):
+            flask.abort(403)
+        return flask.jsonify(metrics.snapshot())
+
+    if DEBUG_PANEL:
+        # The debug panel only polls the metrics while it is open
+        @app.callback(
+            Output('debug-metrics-interval', 'disabled'),
+            Input('debug-panel', 'open'))
+        def toggle_debug_panel(is_open):
+            return not is_open
+
+        @app.callback(
+            Output('debug-metrics', 'children'),
+            Input('debug-metrics-interval', 'n_intervals'),
+            prevent_initial_call=True)
+        def show_callback_metrics(n_intervals):
+            return metrics_table(metrics.snapshot())
+
+    metrics.instrument(app, skip=('show_callback_metrics',))
+    return app
 
 figureX = ""
 figureY = ""
 figureZ = ""
 frameRate = 8
 
-global points, COMs, axes, vectors
-global dfs, labels
-
-root = tk.Tk()
-root.geometry("300x100")
-root.config(bg = "#d6d6d6")
-root.title("BiomechVis")
-root.resizable(False,False)
-text = tk.Label(root, text = "Select Files to Use:", font=("Times New Roman", "12"), padx=5, pady=5, bg="#d6d6d6")
-text.pack(side="left")
-button = tk.Button(root, text='Browse', relief=tk.RAISED, bd=2, command=UploadAction)
-button.pack(side="left")
-
-root.mainloop()
+#guarded so process pool workers (matIngest) that re-import this file don't open the window
+if __name__ == "__main__":
+    import tkinter as tk #only the launch window needs it, wsgi.py serves without one
+    root = tk.Tk()
+    root.geometry("300x100")
+    root.config(bg = "#d6d6d6")
+    root.title("BiomechVis")
+    root.resizable(False,False)
+    text = tk.Label(root, text = "Select Files to Use:", font=("Times New Roman", "12"), padx=5, pady=5, bg="#d6d6d6")
+    text.pack(side="left")
+    button = tk.Button(root, text='Browse', relief=tk.RAISED, bd=2, command=UploadAction)
+    button.pack(side="left")
+
+    root.mainloop()
@@ -0,0 +1,176 @@
+import functools
+import json
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+
+#off turns recording off, memory also records peak allocations (tracemalloc, makes every callback slower)
+METRICS_MODE = os.environ.get('BIOMECHVIS_METRICS', 'on')
+#Show the collapsible callback timings panel under the app
+DEBUG_PANEL = os.environ.get('BIOMECHVIS_DEBUG_PANEL', '') not in ('', '0')
+#Calls kept for the recent list of the metrics endpoint
+RECENT_CALLS = 100
+
+def _summary():
+    return {'count': 0, 'last': 0, 'total': 0, 'max': 0}
+
+def _add(summary, value):
+    summary['count'] += 1
+    summary['last'] = value
+    summary['total'] += value
+    summary['max'] = max(summary['max'], value)
+
+class CallbackMetrics:
+    '''Wall time, bytes sent and peak allocation of every Dash callback call, per callback name
+    instrument(app) wraps every registered callback, inside a callback stage(name) times one part of it
+    (parsing, figure building...), the time of a call not in any stage is mostly the JSON serialization Dash does
+    Peak allocations are only recorded when METRICS_MODE is memory, with several requests at once they overlap
+    Every worker process (wsgi.py) has its own. Background jobs run in a process of their own, wrap_job writes their
+    calls to job_dir and the serving process merges them on its next snapshot'''
+
+    def __init__(self, mode=METRICS_MODE, recent=RECENT_CALLS):
+        self.enabled = mode != 'off'
+        self.trace_memory = mode == 'memory'
+        self._callbacks = {} # name => {'wall_ms', 'bytes', 'peak_bytes', 'errors', 'stages': {stage: summary}}
+        self._recent = deque(maxlen=recent)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.job_dir = None #where background jobs leave their calls (set by backgroundJobs.job_callback)
+
+    def instrument(self, app, skip=()):
+        '''Wrap every callback registered on app so far (call after the last @app.callback)
+        Callbacks named in skip (ex: the one showing the metrics) are left alone'''
+        if not self.enabled:
+            return app
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        for entry in app.callback_map.values():
+            func = entry.get('callback') #clientside callbacks have none, they never reach the server
+            if func is not None and func.__name__ not in skip and not getattr(func, '_metrics', False):
+                entry['callback'] = self._wrap(func)
+        return app
+
+    def wrap_job(self, func):
+        '''Wrap the function of a background job (backgroundJobs.py), recorded as "<name> job" with its stages
+        It runs in its own process, so the call is written to job_dir instead of kept here'''
+        if not self.enabled or not self.job_dir:
+            return func
+        return self._wrap(func, func.__name__ + ' job', self._spool)
+
+    def _wrap(self, func, name=None, record=None):
+        name = name or func.__name__
+        record = record or self._record
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            call = {'name': name, 'time': time.time(), 'stages': {}, 'peak_bytes': None, 'error': None}
+            self._local.call = call
+            if self.trace_memory:
+                tracemalloc.reset_peak()
+            began = time.perf_counter()
+            try:
+                response = func(*args, **kwargs) #Dash's wrapper, it returns the serialized JSON
+                call['bytes'] = len(response) if isinstance(response, (str, bytes)) else 0
+                return response
+            except Exception as error: #PreventUpdate too, still counted
+                call['bytes'] = 0
+                call['error'] = type(error).__name__
+                raise
+            finally:
+                call['wall_ms'] = (time.perf_counter() - began) * 1000
+                if self.trace_memory:
+                    self._fold_peak(call)
+                self._local.call = None
+                record(call)
+        timed._metrics = True
+        return timed
+
+    @contextmanager
+    def stage(self, name):
+        '''Time one part of the current callback, does nothing outside a callback or with metrics off'''
+        call = getattr(self._local, 'call', None)
+        if call is None:
+            yield
+            return
+        if self.trace_memory:
+            self._fold_peak(call)
+            tracemalloc.reset_peak()
+        began = time.perf_counter()
+        try:
+            yield
+        finally:
+            call['stages'][name] = call['stages'].get(name, 0) + (time.perf_counter() - began) * 1000
+            if self.trace_memory:
+                self._fold_peak(call)
+
+    @staticmethod
+    def _fold_peak(call):
+        #a stage resets the tracemalloc peak, so the call keeps the highest peak seen so far
+        call['peak_bytes'] = max(call['peak_bytes'] or 0, tracemalloc.get_traced_memory()[1])
+
+    def _record(self, call):
+        with self._lock:
+            summary = self._callbacks.setdefault(call['name'], {'wall_ms': _summary(), 'bytes': _summary(),
+                                                                'peak_bytes': _summary(), 'errors': 0, 'stages': {}})
+            _add(summary['wall_ms'], call['wall_ms'])
+            _add(summary['bytes'], call['bytes'])
+            if call['peak_bytes'] is not None:
+                _add(summary['peak_bytes'], call['peak_bytes'])
+            if call['error'] and call['error'] != 'PreventUpdate':
+                summary['errors'] += 1
+            for stage, ms in call['stages'].items():
+                _add(summary['stages'].setdefault(stage, _summary()), ms)
+            self._recent.append(call)
+
+    def _spool(self, call):
+        try:
+            os.makedirs(self.job_dir, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.job_dir, prefix='.tmp-')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(call, f)
+            os.replace(tmp, os.path.join(self.job_dir, f'{time.time_ns()}-{os.getpid()}.json'))
+        except OSError as error: #only the timings are lost
+            print("job metrics error", type(error).__name__)
+
+    def _collect(self):
+        '''Record the calls background jobs left in job_dir since the last time'''
+        try:
+            entries = sorted(e.name for e in os.scandir(self.job_dir) if e.name.endswith('.json'))
+        except OSError:
+            return
+        for filename in entries:
+            path = os.path.join(self.job_dir, filename)
+            try:
+                with open(path) as f:
+                    call = json.load(f)
+                os.remove(path)
+            except (OSError, ValueError): #another worker took it first
+                continue
+            self._record(call)
+
+    def snapshot(self):
+        '''Everything recorded as JSON-able dicts: totals per callback (with the mean) and the most recent calls
+        Background jobs are in it as "<callback name> job"'''
+        if self.job_dir:
+            self._collect()
+        with self._lock:
+            callbacks = {}
+            for name, summary in self._callbacks.items():
+                out = {'errors': summary['errors']}
+                for key in ('wall_ms', 'bytes', 'peak_bytes'):
+                    out[key] = dict(summary[key], mean=summary[key]['total'] / max(summary[key]['count'], 1))
+                out['calls'] = summary['wall_ms']['count']
+                out['stages'] = {stage: dict(s, mean=s['total'] / max(s['count'], 1)) for stage, s in summary['stages'].items()}
+                callbacks[name] = out
+            return {'pid': os.getpid(), 'memory': self.trace_memory, 'callbacks': callbacks,
+                    'recent': [dict(call, stages=dict(call['stages'])) for call in self._recent]}
+
+    def reset(self):
+        with self._lock:
+            self._callbacks.clear()
+            self._recent.clear()
+
+metrics = CallbackMetrics()
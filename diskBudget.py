@@ -0,0 +1,64 @@
+import os
+import shutil
+import time
+
+#Seconds between two prunes of the same folder by one process, listing a big cache folder isn't free
+PRUNE_EVERY_S = 60
+
+_last_prune = {} # folder => time.monotonic() of its last prune
+
+def entry_size(path):
+    '''Bytes of a file, or of every file under a folder'''
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError: #removed while walking
+                pass
+    return total
+
+def touch(path):
+    '''Mark an entry as just used (its mtime is what prune goes by)'''
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+def prune(folder, max_bytes, max_age_s, keep_s, force=False):
+    '''Delete entries (files or folders right under folder) least recently used first (by mtime, see touch)
+    Entries unused for longer than max_age_s go, then the oldest until the rest fits max_bytes
+    Entries used in the last keep_s seconds are never deleted (a session may still need them), hidden ones
+    (temp files being written) neither. Does nothing when folder was pruned in the last PRUNE_EVERY_S unless force
+    Returns the bytes freed'''
+    now = time.monotonic()
+    if not force and now - _last_prune.get(folder, -PRUNE_EVERY_S) < PRUNE_EVERY_S:
+        return 0
+    _last_prune[folder] = now
+    entries = []
+    try:
+        for entry in os.scandir(folder):
+            if not entry.name.startswith('.'):
+                entries.append((entry.stat().st_mtime, entry_size(entry.path), entry.path))
+    except OSError:
+        return 0
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    freed = 0
+    wall = time.time()
+    for mtime, size, path in entries:
+        age = wall - mtime
+        if age < keep_s or (age < max_age_s and total <= max_bytes):
+            break
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError: #in use (Windows) or already gone
+                continue
+        total -= size
+        freed += size
+    return freed
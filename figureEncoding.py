@@ -0,0 +1,32 @@
+import base64
+import importlib.util
+import os
+
+import numpy as np
+
+#How coordinates go to the browser: float32 is base64 float32 typed arrays (plotly.js decodes them without parsing
+#JSON numbers), mm also rounds them to whole millimetres (positions are in metres)
+#Plotly typed arrays can't carry a scale factor or NaN (line breaks, missing markers) in integers,
+#so mm keeps float32 but the rounded values repeat and the gzipped response is a fraction of the size
+FIGURE_ENCODING = os.environ.get('BIOMECHVIS_FIGURE_ENCODING', 'float32')
+#Smallest step kept by the mm encoding
+MM = 0.001
+#Responses are gzipped when flask-compress is installed (pip install flask-compress), which is where mm pays off
+HTTP_COMPRESSION = importlib.util.find_spec('flask_compress') is not None
+
+def coords(arr, encoding=None):
+    '''arr as the float32 array that gets sent, rounded to MM with the mm encoding'''
+    encoding = encoding or FIGURE_ENCODING
+    arr = np.asarray(arr, dtype=np.float32)
+    if encoding == 'mm':
+        arr = np.round(arr / MM) * np.float32(MM)
+    return np.ascontiguousarray(arr, dtype='<f4')
+
+def pack_float32(arr, encoding=None):
+    '''Little endian float32 bytes of arr (see coords) as base64 text'''
+    return base64.b64encode(coords(arr, encoding).tobytes()).decode('ascii')
+
+def typed_array(arr, encoding=None):
+    '''arr as a plotly.js typed array ({'dtype': 'f4', 'bdata': base64}), usable for any data array of a trace
+    Plotly only does this itself for arrays going through go.Figure validation, not in Patch objects or plain dicts'''
+    return {'dtype': 'f4', 'bdata': pack_float32(arr, encoding)}
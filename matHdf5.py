@@ -0,0 +1,77 @@
+import numpy as np
+
+MAT73_HEADER = b'MATLAB 7.3 MAT-file'
+
+def is_v73(filename):
+    '''True if filename is a MATLAB v7.3 (HDF5) .mat file, those can't be read by scipy.io.loadmat'''
+    with open(filename, 'rb') as f:
+        return f.read(len(MAT73_HEADER)) == MAT73_HEADER
+
+class LazyArray:
+    '''A MATLAB array inside a v7.3 file, only read when it gets indexed
+    MATLAB stores column major so the HDF5 dataset has its axes reversed,
+    this class flips them back so indexing uses the MATLAB shape (N x 3 points, 3 x 3 x N AnatAx)'''
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    @property
+    def shape(self):
+        return self.dataset.shape[::-1]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def dtype(self):
+        return self.dataset.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __array__(self, dtype=None, copy=None):
+        out = self[...]
+        return out if dtype is None else out.astype(dtype)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            at = key.index(Ellipsis)
+            key = key[:at] + (slice(None),) * (self.ndim - len(key) + 1) + key[at + 1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        #h5py reads just the hyperslab asked for, then put the axes back in MATLAB order
+        return np.asarray(self.dataset[key[::-1]]).T
+
+def _field_order(group):
+    '''Struct field names in the order MATLAB saved them (h5py lists them alphabetically)'''
+    try:
+        return [b''.join(field).decode() for field in group.attrs['MATLAB_fields']]
+    except (KeyError, TypeError, UnicodeDecodeError):
+        return list(group.keys())
+
+def _walk(node, h5py):
+    if isinstance(node, h5py.Dataset):
+        return LazyArray(node)
+    data = {}
+    for field in _field_order(node):
+        if field.startswith('#') or field not in node: #'#refs#' and '#subsystem#' are MATLAB internals
+            continue
+        data[field] = _walk(node[field], h5py)
+    return data
+
+def load_v73(filename):
+    '''Open the Data variable of a v7.3 file without reading it
+    Structs come back as (nested) dicts of LazyArray, a plain Data matrix (TBCM) as one LazyArray
+    The file stays open as long as any of the arrays are referenced'''
+    try:
+        import h5py #only needed for v7.3 files, imported on the first one
+    except ImportError:
+        raise ImportError("h5py is needed to read MATLAB v7.3 files (pip install h5py)")
+    f = h5py.File(filename, 'r')
+    return _walk(f['Data'] if 'Data' in f else f, h5py)
@@ -0,0 +1,76 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from matHdf5 import is_v73, load_v73
+from matSidecar import load_parsed, sidecar_fresh, sidecars_writable
+
+#Worker processes used to parse .mat files, None means one per core
+INGEST_WORKERS = None
+
+def read_mat_data(filename):
+    '''sio.loadmat the file and return the Data struct (or everything if there is no Data field)'''
+    import scipy.io as sio #imported on the first parse, sidecar loads and startup don't need it
+    loaded = sio.loadmat(filename,struct_as_record=True)
+    if 'Data' in loaded.keys():
+        loaded = loaded["Data"] #Data is labeled differently, so just specified data field - Nick
+    return loaded
+
+def struct_to_dict(loaded):
+    '''Recursively walk a loadmat struct into a nested dict'''
+    data = {}
+    whats_inside = loaded.dtype.fields
+    fields = list(whats_inside.keys())
+    for field in fields:
+        if len(loaded[0,0][field].dtype) > 0: # it's a struct
+            data[field] = struct_to_dict(loaded[0,0][field])
+        else: # it's a variable
+            data[field] = loaded[0,0][field]
+    return data
+
+def read_mat_array(filename):
+    '''The plain Data matrix of a file (TBCM, TBCMVeloc), v7.3 or older'''
+    if is_v73(filename):
+        return np.asarray(load_v73(filename))
+    import scipy.io as sio
+    return sio.loadmat(filename, struct_as_record=True)['Data']
+
+def parse_struct(filename):
+    '''Struct file (AnatAx, SegCOM, MocapData) as a nested dict
+    Memory mapped from its sidecar when that is up to date, v7.3 files are opened lazily (see matHdf5)'''
+    if is_v73(filename):
+        return load_v73(filename)
+    return load_parsed(filename, lambda: struct_to_dict(read_mat_data(filename)))
+
+def parse_array(filename):
+    '''Array file (TBCM, TBCMVeloc), memory mapped from its sidecar when that is up to date'''
+    return load_parsed(filename, lambda: read_mat_array(filename))
+
+PARSERS = {'struct': parse_struct, 'array': parse_array}
+
+def _parse_in_worker(kind, filename):
+    #only the sidecar matters, the parsed arrays are not sent back to the parent
+    PARSERS[kind](filename)
+
+def warm_sidecars(jobs, workers=INGEST_WORKERS, progress=None):
+    '''Parse the (kind, filename) jobs at the same time in a process pool so every file has an up to date sidecar
+    The caller then memory maps each parse instead of unpickling arrays from the workers
+    Files with a fresh sidecar and v7.3 files (read lazily) are skipped, with less than two files left nothing is started
+    Nothing is started either when the cache dir can't be written, the workers' parses would be lost
+    progress(done, total, filename) is called as each file finishes
+    Returns the number of files parsed'''
+    todo = [(kind, f) for kind, f in jobs if not is_v73(f) and not sidecar_fresh('mat', [f])]
+    if len(todo) < 2 or not sidecars_writable():
+        return 0
+    workers = min(len(todo), workers or os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_parse_in_worker, kind, f): f for kind, f in todo}
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                future.result()
+            except Exception as error: #the file is parsed again by the caller, which reports the error as before
+                print("parallel ingest error", type(error).__name__)
+            if progress:
+                progress(done, len(todo), futures[future])
+    return len(todo)
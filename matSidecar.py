@@ -0,0 +1,183 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from trialCache import file_key
+from diskBudget import prune, touch
+from sessionStore import SESSION_TTL
+from trialBatch import TrialBatch
+from trialStore import TrialStore
+
+#Bump when the on disk layout changes, older sidecars are then rebuilt
+SIDECAR_VERSION = 1
+#Sidecars go in a cache dir (not next to the .mat) so read only data folders still work
+SIDECAR_DIR = os.environ.get('BIOMECHVIS_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.biomechvis', 'sidecars'))
+#Sidecars past this many GB (or unused for SIDECAR_MAX_AGE_S) are deleted least recently used first, they are
+#rebuilt if needed again. Ones used within a session's lifetime (SESSION_TTL) are kept
+SIDECAR_MAX_GB = float(os.environ.get('BIOMECHVIS_CACHE_MAX_GB', 20))
+SIDECAR_MAX_AGE_S = 30 * 24 * 3600
+
+def sidecar_path(kind, sources):
+    '''Folder holding the sidecar of kind built from the source files (order matters)'''
+    digest = hashlib.sha1('\n'.join([kind] + [os.path.abspath(s) for s in sources]).encode()).hexdigest()[:16]
+    stem = os.path.splitext(os.path.basename(sources[0]))[0] if sources else kind
+    return os.path.join(SIDECAR_DIR, f'{stem}-{kind}-{digest}')
+
+def _source_keys(sources):
+    return [list(file_key(s)) for s in sources]
+
+def _manifest(path, sources):
+    '''manifest.json of a sidecar, None if it is missing, from an old version or the sources changed'''
+    try:
+        with open(os.path.join(path, 'manifest.json')) as f:
+            manifest = json.load(f)
+        if manifest.get('version') != SIDECAR_VERSION or manifest.get('sources') != _source_keys(sources):
+            return None
+    except (OSError, ValueError):
+        return None
+    return manifest
+
+def sidecar_fresh(kind, sources):
+    '''True if the sidecar of kind built from sources is up to date (only the manifest is read)'''
+    return _manifest(sidecar_path(kind, sources), sources) is not None
+
+def sidecars_writable():
+    '''True if sidecars can be written to SIDECAR_DIR (made when missing)'''
+    try:
+        os.makedirs(SIDECAR_DIR, exist_ok=True)
+        with tempfile.TemporaryFile(dir=SIDECAR_DIR):
+            pass
+    except OSError:
+        return False
+    return True
+
+def read_sidecar(path, sources):
+    '''Memory map the arrays of a sidecar
+    Returns (list of (name, array), meta) or None if it is missing, from an old version or the sources changed'''
+    try:
+        manifest = _manifest(path, sources)
+        if manifest is None:
+            return None
+        arrays = []
+        for entry in manifest['arrays']:
+            filename = os.path.join(path, entry['file'])
+            try:
+                arr = np.load(filename, mmap_mode='r', allow_pickle=False)
+            except ValueError: #empty arrays can't be mapped
+                arr = np.load(filename, allow_pickle=False)
+            arrays.append((entry['name'], arr))
+        touch(path)
+        return arrays, manifest.get('meta', {})
+    except (OSError, ValueError, KeyError):
+        return None
+
+def write_sidecar(path, sources, arrays, meta=None):
+    '''Write the (name, array) pairs as .npy files plus a manifest.json
+    Written to a temp folder first and renamed so a half written sidecar is never read'''
+    parent = os.path.dirname(path)
+    os.makedirs(parent, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=parent, prefix='.tmp-')
+    try:
+        entries = []
+        for i, (name, arr) in enumerate(arrays):
+            np.save(os.path.join(tmp, f'{i}.npy'), np.ascontiguousarray(arr), allow_pickle=False)
+            entries.append({'name': name, 'file': f'{i}.npy'})
+        manifest = {'version': SIDECAR_VERSION, 'sources': _source_keys(sources),
+                    'arrays': entries, 'meta': meta or {}}
+        with open(os.path.join(tmp, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp, path)
+    except Exception:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    prune(SIDECAR_DIR, SIDECAR_MAX_GB * 1024 ** 3, SIDECAR_MAX_AGE_S, SESSION_TTL)
+
+def _flatten(value, prefix=()):
+    '''Nested dict of arrays => list of (key path, array), None if something can't be saved without pickle'''
+    if isinstance(value, dict):
+        flat = []
+        for key, item in value.items():
+            inner = _flatten(item, prefix + (key,))
+            if inner is None:
+                return None
+            flat.extend(inner)
+        return flat
+    value = np.asarray(value)
+    if value.dtype.hasobject:
+        return None
+    return [(list(prefix), value)]
+
+def _unflatten(arrays, layout):
+    if layout == 'array':
+        return arrays[0][1]
+    data = {}
+    for path, arr in arrays:
+        node = data
+        for key in path[:-1]:
+            node = node.setdefault(key, {})
+        node[path[-1]] = arr
+    return data
+
+def load_parsed(filename, parse):
+    '''Parsed contents of one .mat file (a nested dict of arrays or a single array)
+    Comes memory mapped from the sidecar when it is up to date, otherwise parse() is run and the sidecar rebuilt'''
+    return load_derived('mat', [filename], parse)
+
+def load_derived(kind, sources, build):
+    '''Nested dict of arrays (or a single array) of kind built from the source files, see load_parsed
+    Processes mapping the same sidecar share one copy of it in the page cache (see wsgi.py)'''
+    path = sidecar_path(kind, sources)
+    hit = read_sidecar(path, sources)
+    if hit is not None:
+        arrays, meta = hit
+        return _unflatten(arrays, meta.get('layout'))
+
+    value = build()
+    flat = _flatten(value)
+    if flat is not None:
+        try:
+            write_sidecar(path, sources, flat, {'layout': 'struct' if isinstance(value, dict) else 'array'})
+        except OSError as error:
+            print("sidecar write error", type(error).__name__)
+    return value
+
+def load_store(sources, build):
+    '''TrialStore built from the source files, memory mapped from its sidecar when up to date
+    build() is only called (and the sidecar rewritten) when it is missing or stale'''
+    path = sidecar_path('store', sources)
+    hit = read_sidecar(path, sources)
+    if hit is not None:
+        arrays, meta = hit
+        arrays = dict(arrays)
+        return TrialStore(arrays['positions'], meta['labels'], arrays['segment_ids'])
+
+    store = build()
+    try:
+        write_sidecar(path, sources, [('positions', store.positions), ('segment_ids', store.segment_ids)],
+                      {'labels': store.labels})
+    except OSError as error:
+        print("sidecar write error", type(error).__name__)
+    return store
+
+def load_batch(sources, build):
+    '''TrialBatch built from the source files of every trial, memory mapped from its sidecar when up to date
+    so any process (background jobs, wsgi.py workers) gets the stacked trials without building them again'''
+    path = sidecar_path('batch', sources)
+    hit = read_sidecar(path, sources)
+    if hit is not None:
+        arrays, meta = hit
+        arrays = dict(arrays)
+        return TrialBatch(arrays['positions'], meta['names'], meta['labels'], arrays['lengths'])
+
+    batch = build()
+    try:
+        write_sidecar(path, sources, [('positions', batch.positions), ('lengths', batch.lengths)],
+                      {'names': batch.names, 'labels': batch.labels})
+    except OSError as error:
+        print("sidecar write error", type(error).__name__)
+    return batch
@@ -0,0 +1,45 @@
+import numpy as np
+
+#Samples sent per 2D line, zooming in re-sends the visible window at this resolution (or every sample if it has fewer)
+TARGET_POINTS = 2000
+
+def lttb(x, y, target=TARGET_POINTS):
+    '''Largest Triangle Three Buckets: indices of target samples that keep the visual shape of y over x
+    The first and last samples are always kept, in between one sample per bucket is picked, the one making the
+    biggest triangle with the previous pick and the mean of the next bucket (so peaks and dips survive)
+    NaN samples (marker missing) are only picked when a whole bucket is NaN, which keeps the gap in the line'''
+    n = len(y)
+    if target >= n or target < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    edges = np.linspace(1, n - 1, target - 1).astype(np.int64) #target - 2 buckets between the first and last sample
+    #mean of every bucket (the last sample is its own bucket), NaN samples left out
+    starts = np.append(edges[:-1], n - 1)
+    finite = np.isfinite(y)
+    counts = np.add.reduceat(finite.astype(np.int64), starts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_x = np.add.reduceat(np.where(finite, x, 0), starts) / counts
+        mean_y = np.add.reduceat(np.where(finite, y, 0), starts) / counts
+    keep = np.empty(target, dtype=np.int64)
+    keep[0], keep[-1] = 0, n - 1
+    a = 0 #last finite pick
+    for b in range(target - 2):
+        lo, hi = edges[b], edges[b + 1]
+        cx, cy = mean_x[b + 1], mean_y[b + 1]
+        area = np.abs((x[a] - cx) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (cy - y[a]))
+        area[np.isnan(area)] = -1
+        pick = lo + int(area.argmax())
+        keep[b + 1] = pick
+        if finite[pick]:
+            a = pick
+    return keep
+
+def window(x, x_range):
+    '''Indices of the samples with x inside x_range plus one on each side, so the line runs off the edges of the plot'''
+    inside = (x >= x_range[0]) & (x <= x_range[1])
+    grown = inside.copy()
+    grown[:-1] |= inside[1:]
+    grown[1:] |= inside[:-1]
+    return np.flatnonzero(grown)
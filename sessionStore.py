@@ -0,0 +1,204 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from trialCache import nbytes_of
+
+#Sessions not used for this long are dropped (seconds)
+SESSION_TTL = 4 * 3600
+#Memory every session together may hold (bytes), past it the least recently used sessions release their arrays
+SESSION_BUDGET = 1024 ** 3
+#Where worker processes share session state when serving with several workers (see wsgi.py)
+SESSION_DIR = os.environ.get('BIOMECHVIS_SESSION_DIR', os.path.join(os.path.expanduser('~'), '.biomechvis', 'sessions'))
+
+class SessionExpired(KeyError):
+    '''The browser tab's session is gone (idle past the ttl, or the server restarted), the tab has to reload'''
+
+def new_session_id():
+    return uuid.uuid4().hex
+
+class Session:
+    '''Everything one browser tab works on: its files, the trial loaded from them and its 2D graph counters
+    release() drops the arrays but keeps the files, loaded is then False until the app loads them again
+    (cheap, they come back out of trial_cache or the sidecars)'''
+
+    def __init__(self, files):
+        self.files = files
+        self.framerate = None
+        self.numOf2dGraphs = 0
+        self.newGraphNumOfLines = 1
+        self.compare_files = {} #trial name => filesList style dict of the trials being compared (trialBatch.py)
+        self.last_used = time.monotonic()
+        self.saved = None #mtime of the shared state this session matches
+        self.users = 0 #requests working on it right now, fit() leaves it loaded until they are done
+        self.release()
+
+    def release(self):
+        self.loaded = False
+        self.points = self.drawn = None
+        self.axes, self.vectors = {}, {}
+        self.all_points_for_2D_graphs, self.mocap_data_2D_graphs = {}, {}
+        self.TBCM_2D_graphs, self.TBCMVeloc_2D_graphs = {}, {}
+        self.derived_2D_graphs = {} #velocities, speeds, angles... (trialKinematics.py), computed when a graph reads them
+        self.file_list_2D = []
+        self.frameLength = 0
+
+    def shared_state(self):
+        '''What other worker processes need to pick this session up (no arrays)'''
+        return {'files': self.files, 'numOf2dGraphs': self.numOf2dGraphs, 'newGraphNumOfLines': self.newGraphNumOfLines,
+                'compare_files': self.compare_files}
+
+    def apply_state(self, state):
+        if state['files'] != self.files:
+            self.files = state['files']
+            self.release()
+        self.numOf2dGraphs = state['numOf2dGraphs']
+        self.newGraphNumOfLines = state['newGraphNumOfLines']
+        self.compare_files = state.get('compare_files', {})
+
+    @property
+    def nbytes(self):
+        '''Bytes of the arrays this session holds, views into shared trial_cache entries count in full
+        so this is an upper bound'''
+        if not self.loaded:
+            return 0
+        return nbytes_of(self.points) + nbytes_of(self.axes) + nbytes_of(self.vectors) \
+            + nbytes_of(self.all_points_for_2D_graphs)
+
+class SessionStore:
+    '''Sessions by id, least recently used first
+    Sessions idle for longer than ttl are dropped, when all of them hold more than budget
+    the least recently used ones release their arrays (see Session.release)
+    With shared_dir set the state of each session (files and counters, see Session.shared_state) is also kept there
+    as json, so with several worker processes any of them can serve any session. save() after changing it
+    A session got by a thread stays in use (never released by fit) until that thread calls unpin(), the app does it
+    when each request is answered'''
+
+    def __init__(self, budget=SESSION_BUDGET, ttl=SESSION_TTL, shared_dir=None):
+        self.budget = budget
+        self.ttl = ttl
+        self.shared_dir = shared_dir
+        self._sessions = OrderedDict() # id => Session
+        self._lock = threading.RLock()
+        self._local = threading.local() # .pinned: id => Session this thread got and hasn't unpinned
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, sid):
+        return sid in self._sessions
+
+    def get(self, sid, create=None):
+        '''Session sid, made with create() if it doesn't exist (or expired)
+        Without create one this process doesn't have is picked up from the shared dir, SessionExpired when
+        it isn't there either (so a tab never silently starts over on other files)'''
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            session = self._sessions.get(sid)
+            if session is None:
+                if create is None:
+                    path = self._shared_path(sid)
+                    if path is None or not os.path.exists(path):
+                        raise SessionExpired(sid)
+                    create = lambda: Session(None) #the files come from the shared state just below
+                session = self._sessions[sid] = create()
+                self._expire_shared()
+            self._sync(sid, session)
+            if session.files is None: #its shared state expired in between
+                del self._sessions[sid]
+                raise SessionExpired(sid)
+            self._sessions.move_to_end(sid)
+            session.last_used = now
+            pinned = self._pinned()
+            if pinned.get(sid) is not session:
+                pinned[sid] = session
+                session.users += 1
+            return session
+
+    def unpin(self):
+        '''Sessions this thread got are no longer in use, call once its request is answered'''
+        pinned = self._pinned()
+        with self._lock:
+            for session in pinned.values():
+                session.users -= 1
+            pinned.clear()
+
+    def _pinned(self):
+        if not hasattr(self._local, 'pinned'):
+            self._local.pinned = {}
+        return self._local.pinned
+
+    def fit(self, sid):
+        '''Call after session sid loaded its arrays, releases other sessions (least recently used first)
+        until everything fits the budget. sid itself and sessions other requests are working on are never released
+        Returns the number of sessions released'''
+        with self._lock:
+            total = sum(session.nbytes for session in self._sessions.values())
+            released = 0
+            for other, session in self._sessions.items():
+                if total <= self.budget:
+                    break
+                if other == sid or not session.loaded or session.users:
+                    continue
+                total -= session.nbytes
+                session.release()
+                released += 1
+            return released
+
+    def save(self, sid):
+        '''Write the shared state of session sid so the other workers see the change (nothing without shared_dir)'''
+        path = self._shared_path(sid)
+        session = self._sessions.get(sid)
+        if path is None or session is None:
+            return
+        os.makedirs(self.shared_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.shared_dir, prefix='.tmp-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(session.shared_state(), f)
+        os.replace(tmp, path)
+        session.saved = os.stat(path).st_mtime_ns
+
+    def _shared_path(self, sid):
+        #ids come from the browser, only ones new_session_id could have made touch the disk
+        if not self.shared_dir or not sid or not all(c in '0123456789abcdef' for c in sid):
+            return None
+        return os.path.join(self.shared_dir, sid + '.json')
+
+    def _sync(self, sid, session):
+        '''Pick up a newer shared state saved by another worker'''
+        path = self._shared_path(sid)
+        if path is None:
+            return
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            if mtime != session.saved:
+                with open(path) as f:
+                    session.apply_state(json.load(f))
+                session.saved = mtime
+            elif time.time() - mtime / 1e9 > self.ttl / 2:
+                #still in use, keep it from expiring in the other workers
+                os.utime(path)
+                session.saved = os.stat(path).st_mtime_ns
+        except (OSError, ValueError, KeyError):
+            return
+
+    def _expire_shared(self):
+        if not self.shared_dir:
+            return
+        cutoff = time.time() - self.ttl #_sync keeps the files of sessions in use fresh
+        try:
+            for entry in os.scandir(self.shared_dir):
+                if entry.name.endswith('.json') and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+        except OSError:
+            pass
+
+    def _expire(self, now):
+        stale = [sid for sid, session in self._sessions.items() if now - session.last_used > self.ttl]
+        for sid in stale:
+            del self._sessions[sid]
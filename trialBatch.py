@@ -0,0 +1,126 @@
+import os
+import warnings
+
+import numpy as np
+
+#lower case pieces of file names that tell the kind (the same ones files_by_kind checks)
+KIND_MARKERS = ('tbcmveloc', 'tbcm_', 'segcom', 'anatax', 'mocap')
+#Samples of a normalized time axis, 0 to 100% of the movement in 1% steps
+NORMALIZED_SAMPLES = 101
+#How trials can be lined up: on their first frame, on the frame where the compared signal peaks or bottoms out,
+#or stretched to 0-100% of the movement
+ALIGNMENTS = ('start', 'max', 'min', 'normalized')
+
+def trial_name(filename):
+    '''Name of the trial a file belongs to, its file name up to the kind marker (None when it has no kind)'''
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    found = [stem.casefold().find(marker) for marker in KIND_MARKERS]
+    found = [at for at in found if at >= 0]
+    if not found:
+        return None
+    return stem[:min(found)].rstrip('_-. ')
+
+def group_trials(filenames):
+    '''{trial name: files} of the given files, files without a kind are left out
+    Files only named by kind (mocapData.mat) go to the trial ""'''
+    groups = {}
+    for filename in filenames:
+        name = trial_name(filename)
+        if name is not None:
+            groups.setdefault(name, []).append(filename)
+    return groups
+
+class TrialBatch:
+    '''Several trials of the same markers in one array, each trial keeps its own entry
+    positions is float32 shaped (trials, frames, markers, 3), trials shorter than the longest are NaN padded
+    names[t] is the trial at positions[t], lengths[t] its real frame count, labels[i] the marker at positions[:, :, i]
+    Only markers every trial has are kept'''
+
+    def __init__(self, positions, names, labels, lengths):
+        self.positions = positions
+        self.names = list(names)
+        self.labels = list(labels)
+        self.lengths = np.asarray(lengths, dtype=np.intp)
+        self._index = {name: i for i, name in enumerate(self.labels)}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, label):
+        return label in self._index
+
+    @property
+    def nbytes(self):
+        return self.positions.nbytes + self.lengths.nbytes
+
+    def index(self, label):
+        return self._index[label]
+
+    def series(self, label):
+        '''(trials, frames, 3) view of one marker in every trial'''
+        return self.positions[:, :, self._index[label]]
+
+def stack_trials(stores, names):
+    '''TrialBatch of TrialStores (full resolution, one per trial name), the markers are the ones in every store
+    in the order of the first one. Lazy (v7.3) stores only read the markers that are kept'''
+    labels = [label for label in stores[0].labels if all(label in store for store in stores[1:])]
+    lengths = [store.frame_count for store in stores]
+    positions = np.full((len(stores), max(lengths, default=0), len(labels), 3), np.nan, dtype=np.float32)
+    for t, store in enumerate(stores):
+        positions[t, :lengths[t]] = np.asarray(store.positions[:, [store.index(label) for label in labels]])
+    return TrialBatch(positions, names, labels, lengths)
+
+def event_frames(values, lengths, alignment):
+    '''Frame of each trial that alignment lines up, values is (trials, frames) of the compared signal
+    start is frame 0, max/min the frame of the highest/lowest value (0 for a trial with no data)'''
+    if alignment == 'start':
+        return np.zeros(len(values), dtype=np.intp)
+    if alignment not in ('max', 'min'):
+        raise ValueError(f"no event frame for alignment {alignment}")
+    frames = np.arange(values.shape[1])
+    #padding and gaps can never be the event
+    fill = -np.inf if alignment == 'max' else np.inf
+    values = np.where((frames < np.asarray(lengths)[:, None]) & ~np.isnan(values), values, fill)
+    return (np.argmax(values, axis=1) if alignment == 'max' else np.argmin(values, axis=1)).astype(np.intp)
+
+def align_to_events(values, lengths, events):
+    '''Shift every trial of values (trials, frames, ...) so its event frame lands on the same row
+    Returns the aligned (trials, window, ...) array (NaN where a trial has no frame) and the frame of each row
+    relative to the event (negative before it). One gather for all trials'''
+    values = np.asarray(values)
+    lengths, events = np.asarray(lengths, dtype=np.intp), np.asarray(events, dtype=np.intp)
+    before, after = int(events.max(initial=0)), int((lengths - events).max(initial=0))
+    relative = np.arange(-before, after)
+    source = events[:, None] + relative[None, :] #(trials, window) frame of each trial on each row
+    inside = (source >= 0) & (source < lengths[:, None])
+    picked = np.take_along_axis(values, np.clip(source, 0, max(values.shape[1] - 1, 0)).reshape(source.shape + (1,) * (values.ndim - 2)), axis=1)
+    aligned = np.where(inside.reshape(inside.shape + (1,) * (values.ndim - 2)), picked, np.nan)
+    return aligned.astype(values.dtype, copy=False), relative
+
+def normalize_time(values, lengths, samples=NORMALIZED_SAMPLES):
+    '''Resample every trial of values (trials, frames, ...) to samples frames spread from its first to its last frame
+    (linear interpolation, all trials at once). Returns (trials, samples, ...) and the percent of each sample'''
+    values = np.asarray(values)
+    lengths = np.asarray(lengths, dtype=np.intp)
+    percent = np.linspace(0, 100, samples)
+    position = percent[None, :] / 100 * np.maximum(lengths - 1, 0)[:, None] #(trials, samples) fractional frame
+    below = np.floor(position).astype(np.intp)
+    above = np.minimum(below + 1, np.maximum(lengths - 1, 0)[:, None])
+    weight = (position - below).reshape(position.shape + (1,) * (values.ndim - 2))
+    rows = np.arange(len(values))[:, None]
+    resampled = values[rows, below] * (1 - weight) + values[rows, above] * weight
+    return resampled.astype(values.dtype, copy=False), percent
+
+def align_trials(values, lengths, alignment, signal=None):
+    '''values (trials, frames, ...) aligned the way alignment says, with the x axis to plot them against
+    signal (trials, frames) is what max/min look for, the values themselves when not given (they must be 2D then)'''
+    if alignment == 'normalized':
+        return normalize_time(values, lengths)
+    return align_to_events(values, lengths, event_frames(values if signal is None else signal, lengths, alignment))
+
+def mean_sd(values):
+    '''Mean, standard deviation and count of the trials on every frame of aligned values (trials, frames, ...)
+    Trials with no data on a frame are left out of it, frames no trial has are NaN'''
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning) #empty frames, they are NaN
+        return np.nanmean(values, axis=0), np.nanstd(values, axis=0), np.sum(~np.isnan(values), axis=0)
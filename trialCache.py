@@ -0,0 +1,107 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+#Default memory budget for everything held in the cache (bytes)
+DEFAULT_BUDGET = 2 * 1024 ** 3
+
+def file_key(filename):
+    '''Identity of a file on disk: (absolute path, mtime, size)
+    If the file is rewritten the key changes, so stale entries are never returned'''
+    stat = os.stat(filename)
+    return (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+
+def nbytes_of(value):
+    '''Rough size in bytes of a parsed value (arrays inside dicts/lists/tuples)
+    Memory mapped arrays live in the page cache so they don't count against the budget'''
+    if isinstance(value, np.memmap):
+        return 0
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(nbytes_of(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(nbytes_of(v) for v in value)
+    if hasattr(value, 'nbytes'):
+        return value.nbytes
+    return 0
+
+def _deps_of(paths):
+    '''path => file_key for each source file (None if it is gone)'''
+    deps = {}
+    for path in paths:
+        path = os.path.abspath(path)
+        try:
+            deps[path] = file_key(path)
+        except OSError:
+            deps[path] = None
+    return deps
+
+class TrialCache:
+    '''LRU cache of parsed trial data with a memory budget
+    Each entry remembers which source files it was built from so only the entries
+    that depend on a changed/uploaded file get dropped'''
+
+    def __init__(self, budget=DEFAULT_BUDGET):
+        self.budget = budget
+        self.used = 0
+        self._entries = OrderedDict() # key => (value, size, {path: file_key})
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, build, paths=()):
+        '''Return the cached value for key, calling build() to make it on a miss'''
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+        value = build()
+        self.put(key, value, paths)
+        return value
+
+    def put(self, key, value, paths=()):
+        '''Store value, evicting least recently used entries until it fits the budget
+        Values bigger than the whole budget are returned to the caller but not kept'''
+        size = nbytes_of(value)
+        with self._lock:
+            self._discard(key)
+            if size > self.budget:
+                return
+            while self._entries and self.used + size > self.budget:
+                self._discard(next(iter(self._entries)))
+            self._entries[key] = (value, size, _deps_of(paths))
+            self.used += size
+
+    def invalidate(self, paths, stale_only=False):
+        '''Drop every entry built from any of the given files
+        With stale_only, entries are only dropped if one of those files changed since it was cached
+        Returns the number of entries removed'''
+        paths = {os.path.abspath(p) for p in paths}
+        if stale_only:
+            current = _deps_of(paths)
+        with self._lock:
+            stale = []
+            for key, (_, _, deps) in self._entries.items():
+                hit = paths.intersection(deps)
+                if hit and (not stale_only or any(deps[p] != current.get(p) for p in hit)):
+                    stale.append(key)
+            for key in stale:
+                self._discard(key)
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.used = 0
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.used -= entry[1]
@@ -0,0 +1,245 @@
+'''Export parsed trials to columnar Parquet (or Arrow IPC) files, so other scripts don't have to parse the .mat files again
+
+    python trialExport.py trials/ -o exported/
+    python trialExport.py Dunk_mocapData.mat Dunk_SegCOM.mat Dunk_AnatAx.mat -o exported/ --format arrow --derived
+
+A folder is searched recursively and grouped into trials like batchRender.py does, trials are exported at the same time
+in a process pool. Each trial gets a folder with one long format table per data type it has:
+    markers     frame, marker, x, y, z
+    segcom      frame, segment, x, y, z
+    anatax      frame, segment, axis (X, Y or Z), x, y, z
+    tbcm        frame, x, y, z
+    tbcmveloc   frame, x, y, z
+    kinematics  frame, marker, vx, vy, vz, ax, ay, az, speed (--derived, see trialKinematics.py)
+Names are dictionary encoded and coordinates keep the precision of the .mat file (kinematics are float32)
+Tables are written a row group at a time from the memory mapped parse (matSidecar.py), so memory stays around
+one row group whatever the trial length (kinematics too, they are worked out a chunk at a time)
+pandas: pd.read_parquet('exported/Dunk/markers.parquet')
+'''
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError: #only exporting needs it (pip install pyarrow)
+    pa = pq = None
+
+import biomechVis
+from batchRender import find_trials, up_to_date
+from matIngest import warm_sidecars
+from trialBatch import trial_name
+from trialKinematics import derivative, magnitude
+
+#Rows per row group (Parquet) or record batch (Arrow), about 10 MB of markers
+ROW_GROUP_ROWS = 256 * 1024
+FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
+#Parquet compression, zstd is small and quick to read back
+COMPRESSION = 'zstd'
+#Written in a trial's folder once all of its tables are, what was exported ({format, derived, tables: {table: rows}})
+DONE_FILE = 'export.json'
+
+def frame_chunks(frames, width, rows=ROW_GROUP_ROWS):
+    '''(start, stop) frame ranges of about rows rows each when every frame is width rows'''
+    step = max(1, rows // max(width, 1))
+    return [(start, min(start + step, frames)) for start in range(0, frames, step)]
+
+def read_frames(arrays, start, stop, dtype):
+    '''(stop - start, len(arrays), 3) block of Nx3 arrays, only those frames are read. NaN past an array's end'''
+    out = np.full((stop - start, len(arrays), 3), np.nan, dtype=dtype)
+    for i, array in enumerate(arrays):
+        block = np.asarray(array[start:min(stop, len(array))])
+        out[:len(block), i] = block[:, :3]
+    return out
+
+def long_batch(schema, start, block, names=None, extra=()):
+    '''Record batch of a (frames, items, columns) block starting at frame start, one row per frame and item
+    names label the items (dictionary encoded), extra are (name, values) columns put in front of the coordinates'''
+    frames, items = block.shape[:2]
+    columns = [pa.array(np.repeat(np.arange(start, start + frames, dtype=np.int32), items))]
+    if names is not None:
+        columns.append(pa.DictionaryArray.from_arrays(np.tile(np.arange(items, dtype=np.int32), frames), names))
+    columns += [values for _, values in extra]
+    rows = block.reshape(frames * items, -1)
+    columns += [pa.array(rows[:, i]) for i in range(rows.shape[1])]
+    return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+def table_schema(item, coords, dtype, extra=()):
+    fields = [pa.field('frame', pa.int32())]
+    if item:
+        fields.append(pa.field(item, pa.dictionary(pa.int32(), pa.string())))
+    fields += [pa.field(name, pa.dictionary(pa.int32(), pa.string())) for name in extra]
+    fields += [pa.field(c, pa.from_numpy_dtype(np.dtype(dtype))) for c in coords]
+    return pa.schema(fields)
+
+def open_writer(path, schema, fmt):
+    if fmt == 'arrow':
+        return pa.ipc.new_file(path, schema)
+    return pq.ParquetWriter(path, schema, compression=COMPRESSION)
+
+def write_table(path, schema, fmt, batches):
+    '''Write the record batches batches yields to path one at a time (tmp file then rename), returns the rows written'''
+    tmp = path + '.tmp'
+    rows = 0
+    with open_writer(tmp, schema, fmt) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+            rows += batch.num_rows
+    os.replace(tmp, path)
+    return rows
+
+def point_batches(points, schema, rows):
+    '''Batches of a name => Nx3 dict (markers, SegCOM)'''
+    names = pa.array(list(points), pa.string())
+    arrays = list(points.values())
+    frames = max(len(a) for a in arrays)
+    for start, stop in frame_chunks(frames, len(arrays), rows):
+        yield long_batch(schema, start, read_frames(arrays, start, stop, schema.field('x').type.to_pandas_dtype()), names)
+
+def anatax_batches(AnatAx, schema, rows):
+    '''Batches of AnatAx (segment => 3 x 3 x N, [axis][x, y, z] over frames), one row per frame, segment and axis'''
+    segments = list(AnatAx)
+    frames = max(np.shape(AnatAx[seg])[2] for seg in segments)
+    dtype = schema.field('x').type.to_pandas_dtype()
+    segment_names, axis_names = pa.array(segments, pa.string()), pa.array(['X', 'Y', 'Z'], pa.string())
+    for start, stop in frame_chunks(frames, len(segments) * 3, rows):
+        block = np.full((stop - start, len(segments), 3, 3), np.nan, dtype=dtype)
+        for i, seg in enumerate(segments):
+            part = np.asarray(AnatAx[seg][:, :, start:stop]) # (axis, xyz, frames)
+            block[:part.shape[2], i] = part.transpose(2, 0, 1)
+        count = (stop - start) * len(segments) * 3
+        segment = pa.DictionaryArray.from_arrays(np.tile(np.repeat(np.arange(len(segments), dtype=np.int32), 3), stop - start), segment_names)
+        axis = pa.DictionaryArray.from_arrays(np.tile(np.arange(3, dtype=np.int32), count // 3), axis_names)
+        yield long_batch(schema, start, block.reshape(stop - start, len(segments) * 3, 3), extra=[('segment', segment), ('axis', axis)])
+
+def vector_batches(array, schema, rows):
+    '''Batches of one Nx3 array (TBCM, TBCMVeloc)'''
+    for start, stop in frame_chunks(len(array), 1, rows):
+        yield long_batch(schema, start, read_frames([array], start, stop, schema.field('x').type.to_pandas_dtype()))
+
+def kinematics_batches(arrays, labels, schema, rows):
+    '''Batches of the velocity, acceleration and speed of Nx3 arrays (markers then SegCOM, like the TrialStore)
+    Worked out a chunk at a time, each chunk reads two more frames on both sides so the central differences at its
+    edges (derivative twice, see trialKinematics.py) come out the same as over the whole trial'''
+    names = pa.array(labels, pa.string())
+    frames = max(len(a) for a in arrays)
+    for start, stop in frame_chunks(frames, len(arrays), rows):
+        before, after = max(start - 2, 0), min(stop + 2, frames)
+        velocity = derivative(read_frames(arrays, before, after, np.float32))
+        acceleration = derivative(velocity)
+        inside = slice(start - before, stop - before)
+        block = np.concatenate([velocity[inside], acceleration[inside], magnitude(velocity[inside])[:, :, None]], axis=2)
+        yield long_batch(schema, start, block, names)
+
+def export_trial(name, files, out_dir, fmt='parquet', derived=False, rows=ROW_GROUP_ROWS):
+    '''Write the tables of one trial (files of every kind) to out_dir, runs in a pool worker
+    Returns (name, seconds, {table: rows})'''
+    began = time.perf_counter()
+    files = biomechVis.files_by_kind(files)
+    os.makedirs(out_dir, exist_ok=True)
+    ext = FORMATS[fmt]
+    written = {}
+    def dtype_of(array):
+        return np.asarray(array[:1]).dtype
+    points_of = {}
+    for kind, table, item in (('MocapData', 'markers', 'marker'), ('SegCOM', 'segcom', 'segment')):
+        if files[kind]:
+            points = points_of[kind] = biomechVis.load_from_mat(files[kind], {})
+            schema = table_schema(item, 'xyz', dtype_of(next(iter(points.values()))))
+            written[table] = write_table(os.path.join(out_dir, table + ext), schema, fmt, point_batches(points, schema, rows))
+    if files['AnatAx']:
+        AnatAx = biomechVis.load_from_mat(files['AnatAx'], {})
+        schema = table_schema('segment', 'xyz', np.asarray(next(iter(AnatAx.values()))[:1, :1, :1]).dtype, extra=['axis'])
+        written['anatax'] = write_table(os.path.join(out_dir, 'anatax' + ext), schema, fmt, anatax_batches(AnatAx, schema, rows))
+    for kind, table in (('TBCM', 'tbcm'), ('TBCMVeloc', 'tbcmveloc')):
+        if files[kind]:
+            array = biomechVis.load_from_mat2(files[kind])
+            schema = table_schema(None, 'xyz', dtype_of(array))
+            written[table] = write_table(os.path.join(out_dir, table + ext), schema, fmt, vector_batches(array, schema, rows))
+    if derived and points_of:
+        labels = [label for points in points_of.values() for label in points]
+        arrays = [array for points in points_of.values() for array in points.values()]
+        schema = table_schema('marker', ['vx', 'vy', 'vz', 'ax', 'ay', 'az', 'speed'], np.float32)
+        written['kinematics'] = write_table(os.path.join(out_dir, 'kinematics' + ext), schema, fmt,
+                                            kinematics_batches(arrays, labels, schema, rows))
+    #last, so a trial that stopped half way is exported again
+    tmp = os.path.join(out_dir, DONE_FILE + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump({'format': fmt, 'derived': derived, 'tables': written}, f)
+    os.replace(tmp, os.path.join(out_dir, DONE_FILE))
+    return name, time.perf_counter() - began, written
+
+def exported(out_dir, files, fmt, derived):
+    '''True if every table of the trial in out_dir was written in format fmt (with the kinematics if derived)
+    after files last changed'''
+    done = os.path.join(out_dir, DONE_FILE)
+    if not up_to_date(done, files):
+        return False
+    try:
+        with open(done) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return manifest.get('format') == fmt and (manifest.get('derived') or not derived)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export parsed trials to Parquet or Arrow tables")
+    parser.add_argument('paths', nargs='+', help="a folder of trials (searched recursively) or the .mat files of one trial")
+    parser.add_argument('-o', '--out', default='exported', help="folder the trials are written to (default: exported)")
+    parser.add_argument('--format', choices=FORMATS, default='parquet', help="parquet (default) or arrow (IPC file)")
+    parser.add_argument('--derived', action='store_true', help="also write the velocities, accelerations and speeds")
+    parser.add_argument('--row-group', type=int, default=ROW_GROUP_ROWS,
+                        help=f"rows per row group, bounds the memory used (default: {ROW_GROUP_ROWS})")
+    parser.add_argument('-j', '--workers', type=int, default=None, help="worker processes (default: one per core)")
+    parser.add_argument('--force', action='store_true', help="export trials that were already fully exported since their files changed too")
+    args = parser.parse_args(argv)
+    if pa is None:
+        parser.error("exporting needs pyarrow (pip install pyarrow)")
+    if args.row_group < 1:
+        parser.error("--row-group must be at least 1")
+
+    if len(args.paths) == 1 and os.path.isdir(args.paths[0]):
+        trials = find_trials(args.paths[0])
+    else:
+        missing = [p for p in args.paths if not os.path.isfile(p)]
+        if missing:
+            parser.error(f"no such file: {missing[0]}")
+        name = trial_name(args.paths[0]) or os.path.basename(os.path.dirname(os.path.abspath(args.paths[0])))
+        trials = {name: args.paths}
+        if not biomechVis.files_by_kind(args.paths)['MocapData']:
+            print("exporting without a mocap data file")
+    todo = {name: files for name, files in trials.items()
+            if args.force or not exported(os.path.join(args.out, name), files, args.format, args.derived)}
+    print(f"{len(trials)} trials, {len(trials) - len(todo)} already exported, {len(todo)} to export")
+    if not todo:
+        return 0
+
+    workers = min(len(todo), args.workers or os.cpu_count() or 1)
+    #parse every file once up front (a pool over all of them), the exports below then just map the sidecars
+    kinds = {'TBCM': 'array', 'TBCMVeloc': 'array'}
+    warm_sidecars([(kinds.get(kind, 'struct'), f) for files in todo.values()
+                   for kind, paths in biomechVis.files_by_kind(files).items() for f in paths], workers)
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(export_trial, name, files, os.path.join(args.out, name), args.format,
+                               args.derived, args.row_group): name
+                   for name, files in todo.items()}
+        for future in as_completed(futures):
+            try:
+                name, seconds, written = future.result()
+                tables = ', '.join(f"{table} {rows}" for table, rows in written.items())
+                print(f"exported {name} ({seconds:.1f}s): {tables} rows")
+            except Exception as error: #one bad trial doesn't stop the batch
+                failed += 1
+                print(f"failed {futures[future]}: {type(error).__name__}: {error}")
+    print(f"{len(todo) - failed} exported, {failed} failed")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
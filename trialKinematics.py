@@ -0,0 +1,117 @@
+import hashlib
+import itertools
+from collections.abc import Mapping
+
+import numpy as np
+
+#Seconds between frames, velocities and accelerations are per frame while this is 1
+FRAME_TIME = 1.0
+#(marker, marker) name pairs that also get a distance series, every pair of segment COMs always gets one
+MARKER_PAIRS = []
+
+def kinematics_kind():
+    '''Cache kind of the derived signals, it changes with the settings above so old results aren't reused'''
+    return 'kinematics-' + hashlib.sha1(repr((FRAME_TIME, sorted(MARKER_PAIRS))).encode()).hexdigest()[:8]
+
+def derivative(values, dt=FRAME_TIME):
+    '''d/dt along the frame axis of a (frames, ...) array, central differences inside and one sided at the ends
+    Every marker is done at once, NaN gaps stay NaN (and make their neighbours NaN)'''
+    values = np.asarray(values)
+    if len(values) < 2:
+        return np.zeros_like(values)
+    return np.gradient(values, dt, axis=0)
+
+def magnitude(vectors):
+    '''Length of the last axis, (frames, markers, 3) velocities => (frames, markers) speeds'''
+    return np.linalg.norm(vectors, axis=-1)
+
+def pair_distances(positions, pairs):
+    '''(frames, pairs) distance between the two markers of each (i, j) index pair of a (frames, markers, 3) array'''
+    pairs = np.asarray(pairs, dtype=np.intp).reshape(-1, 2)
+    return magnitude(positions[:, pairs[:, 0]] - positions[:, pairs[:, 1]])
+
+def unit_axes(axes, coms, segments):
+    '''(frames, segments, 3, 3) unit X, Y and Z axis of each segment from the axis end points build_axes made
+    (end point - COM, so the .1 scale doesn't matter)'''
+    ends = np.stack([np.stack([axes[seg][a] for a in ('X', 'Y', 'Z')], axis=1) for seg in segments], axis=1)
+    directions = ends - np.asarray(coms)[:, :, None, :]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return directions / magnitude(directions)[..., None]
+
+def axis_angles(frames_a, frames_b):
+    '''Degrees between the X axes, the Y axes and the Z axes of two (..., 3, 3) unit axes => (..., 3)'''
+    cos = np.clip(np.sum(frames_a * frames_b, axis=-1), -1, 1)
+    return np.degrees(np.arccos(cos))
+
+def kinematics_layout(store, axes, TBCM=()):
+    '''What KinematicSeries offers for a trial: (segments with axes, COM/marker pairs, has TBCM)
+    Only depends on names, so listing the series computes nothing'''
+    segments = [seg for seg in axes if seg in store and all(a in axes[seg] for a in ('X', 'Y', 'Z'))]
+    pairs = list(itertools.combinations(store.com_names(), 2))
+    pairs += [(a, b) for a, b in MARKER_PAIRS if a in store and b in store and (a, b) not in pairs]
+    return segments, pairs, np.ndim(TBCM) == 2 and len(TBCM) > 0
+
+class KinematicSeries(Mapping):
+    '''name => 2D graph series of a trial's derived signals, ex: "LFHD velocity", "Head-Trunk angle"
+    Only the names are known up front, a series is computed from the store when it is asked for (one marker, pair or
+    segment pair at a time) so loading a trial costs nothing however many segment pairs it has
+    Vectors and angles are (frames, 3) so X/Y/Z picks the component (for angles the X, Y or Z axes),
+    speeds and distances are (frames,)'''
+    nbytes = 0 #nothing is kept (trialCache.nbytes_of)
+
+    def __init__(self, store, axes, TBCM=()):
+        self.store = store
+        self.axes = axes
+        segments, pairs, has_tbcm = kinematics_layout(store, axes, TBCM)
+        self.TBCM = np.asarray(TBCM)[:, :3] if has_tbcm else None
+        self._recipes = {} # name => (kind, arguments)
+        for i, name in enumerate(store.labels):
+            for kind in ('velocity', 'acceleration', 'speed'):
+                self._recipes[f'{name} {kind}'] = (kind, i)
+        for a, b in pairs:
+            self._recipes[f'{a}-{b} distance'] = ('distance', (store.index(a), store.index(b)))
+        if len(segments) > 1:
+            for a, b in itertools.combinations(segments, 2):
+                self._recipes[f'{a}-{b} angle'] = ('angle', (a, b))
+        if has_tbcm:
+            for kind in ('velocity', 'acceleration', 'speed'):
+                self._recipes['TBCM ' + kind] = ('TBCM ' + kind, None)
+            for i, name in enumerate(store.labels):
+                self._recipes[name + '-TBCM distance'] = ('TBCM distance', i)
+
+    def __len__(self):
+        return len(self._recipes)
+
+    def __iter__(self):
+        return iter(self._recipes)
+
+    def __contains__(self, name):
+        return name in self._recipes
+
+    def __getitem__(self, name):
+        kind, arg = self._recipes[name]
+        if kind in ('velocity', 'acceleration', 'speed'):
+            return _motion(self._marker(arg), kind)
+        if kind == 'distance':
+            return magnitude(self._marker(arg[0]) - self._marker(arg[1]))
+        if kind == 'angle':
+            coms = np.stack([self._marker(self.store.index(seg)) for seg in arg], axis=1)
+            unit = unit_axes(self.axes, coms, list(arg))
+            return axis_angles(unit[:, 0], unit[:, 1])
+        if kind == 'TBCM distance':
+            position = self._marker(arg)
+            frames = min(len(self.TBCM), len(position))
+            return magnitude(position[:frames] - self.TBCM[:frames])
+        return _motion(self.TBCM, kind[len('TBCM '):])
+
+    def _marker(self, i):
+        return np.asarray(self.store.positions[:, i])
+
+def _motion(positions, kind):
+    '''velocity, acceleration or speed of a (frames, 3) position series'''
+    velocity = derivative(positions)
+    if kind == 'velocity':
+        return velocity
+    if kind == 'acceleration':
+        return derivative(velocity)
+    return magnitude(velocity)
@@ -0,0 +1,118 @@
+import warnings
+
+import numpy as np
+
+from trialCache import nbytes_of
+from trialStore import TrialStore
+
+#Strides of every trial's levels, any framerate is served from the biggest one that divides it
+PYRAMID_STRIDES = (1, 2, 4, 8, 16)
+
+def shrink(array, factor, average=False):
+    '''Every factor-th frame of a (frames, ...) array
+    With average each frame is the mean of the factor frames it replaces (the last window may be shorter),
+    NaN frames (marker missing) are left out of the mean so a window is only NaN if all of it is missing'''
+    if not average:
+        return np.ascontiguousarray(array[::factor])
+    array = np.asarray(array, dtype=np.float32)
+    full = len(array) // factor
+    out = np.empty((-(-len(array) // factor),) + array.shape[1:], dtype=np.float32)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning) #all NaN windows
+        out[:full] = np.nanmean(array[:full * factor].reshape((full, factor) + array.shape[1:]), axis=1)
+        if len(out) > full:
+            out[full] = np.nanmean(array[full * factor:], axis=0)
+    return out
+
+class TemporalPyramid:
+    '''One (frames, ...) array at several frame strides (PYRAMID_STRIDES)
+    Without average the levels are strided views of the array (nothing is copied or saved), level[s][k] is frame k * s
+    With average level[s][k] is the mean of frames k * s ... k * s + s - 1, each level built from the one below it
+    Arrays that are not in RAM (LazyPositions for v7.3 files) are never averaged, that would read the whole trial
+    levels ({str(stride): array}, see saved_levels) skips building, ex: levels memory mapped from a sidecar'''
+
+    def __init__(self, array, strides=PYRAMID_STRIDES, average=False, levels=None):
+        self.strides = sorted(strides)
+        self.average = average and (bool(levels) or isinstance(array, np.ndarray))
+        self.levels = {1: array}
+        if levels:
+            self.levels.update((int(stride), level) for stride, level in levels.items())
+            return
+        for stride in self.strides:
+            if stride == 1:
+                continue
+            if not self.average:
+                self.levels[stride] = array[::stride]
+                continue
+            #build from the finest level this stride is a multiple of (the one just below for 1, 2, 4, 8, 16)
+            base = max(s for s in self.levels if stride % s == 0)
+            self.levels[stride] = shrink(self.levels[base], stride // base, average)
+
+    def nearest(self, framerate):
+        '''Biggest stride that divides framerate (1 always does)
+        Averaged levels fall back to the biggest stride under framerate instead of 1 (ex: odd framerates),
+        undersample re-strides it'''
+        stride = max(s for s in self.levels if framerate % s == 0)
+        if stride == 1 and self.average:
+            stride = max(s for s in self.levels if s <= framerate)
+        return stride
+
+    def undersample(self, framerate):
+        '''Every framerate-th frame, read from the nearest level so the full resolution data is not touched'''
+        stride = self.nearest(framerate)
+        level = self.levels[stride]
+        if framerate % stride == 0:
+            return level[::framerate // stride]
+        #the level frame each framerate-th frame falls in, as many frames as [::framerate] gives
+        return level[np.arange(0, len(self.levels[1]), framerate) // stride]
+
+    def saved_levels(self):
+        '''{str(stride): array} of every averaged level but stride 1, what levels takes back (views aren't saved)'''
+        if not self.average:
+            return {}
+        return {str(stride): level for stride, level in self.levels.items() if stride != 1}
+
+    @property
+    def nbytes(self):
+        '''Bytes held by the levels built here (the stride 1 level belongs to whoever passed it in, views hold nothing)'''
+        if not self.average:
+            return 0
+        return sum(nbytes_of(level) for stride, level in self.levels.items() if stride != 1)
+
+class TrialPyramid:
+    '''Temporal pyramids for everything the 3D graph draws: the TrialStore positions, anatomical axes and vectors
+    axes is {segment: {'X'|'Y'|'Z': Nx3}} and vectors {name: [froms, tos]}, same as build_trial in biomechVis
+    levels is what saved_levels returned for the same trial, nothing is rebuilt then'''
+
+    def __init__(self, store, axes, vectors, strides=PYRAMID_STRIDES, average=False, levels=None):
+        levels = levels or {}
+        self.store = store
+        self.positions = TemporalPyramid(store.positions, strides, average, levels.get('positions'))
+        saved = levels.get('axes', {})
+        self.axes = {ax: {coord: TemporalPyramid(data, strides, average, saved.get(ax, {}).get(coord))
+                          for coord, data in temp.items()}
+                     for ax, temp in axes.items()}
+        saved = levels.get('vectors', {})
+        self.vectors = {key: [TemporalPyramid(np.asarray(end), strides, average, saved.get(key, {}).get(str(i)))
+                              for i, end in enumerate(value)]
+                        for key, value in vectors.items()}
+
+    def saved_levels(self):
+        '''Every built level as a nested dict of arrays (matSidecar can save it), give it back as levels'''
+        return {'positions': self.positions.saved_levels(),
+                'axes': {ax: {coord: p.saved_levels() for coord, p in temp.items()} for ax, temp in self.axes.items()},
+                'vectors': {key: {str(i): p.saved_levels() for i, p in enumerate(value)}
+                            for key, value in self.vectors.items()}}
+
+    def undersample(self, framerate):
+        '''(TrialStore, axes, vectors) with every framerate-th frame'''
+        store = TrialStore(self.positions.undersample(framerate), self.store.labels, self.store.segment_ids)
+        axes = {ax: {coord: p.undersample(framerate) for coord, p in temp.items()} for ax, temp in self.axes.items()}
+        vectors = {key: [p.undersample(framerate) for p in value] for key, value in self.vectors.items()}
+        return store, axes, vectors
+
+    @property
+    def nbytes(self):
+        pyramids = [self.positions] + [p for temp in self.axes.values() for p in temp.values()] \
+            + [p for value in self.vectors.values() for p in value]
+        return sum(p.nbytes for p in pyramids)
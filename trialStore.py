@@ -0,0 +1,191 @@
+import numpy as np
+
+COM_SEGMENT_ID = 0 #segment id used for every segment center of mass
+
+class TrialStore:
+    '''Columnar store of every drawable point in a trial
+    positions is one contiguous float32 array shaped (frames, markers, 3)
+    labels[i] and segment_ids[i] describe the marker at positions[:, i]
+    Frames where a marker has no data (shorter file) are NaN'''
+
+    def __init__(self, positions, labels, segment_ids):
+        self.positions = positions
+        self.labels = list(labels)
+        self.segment_ids = np.asarray(segment_ids)
+        self._index = {name: i for i, name in enumerate(self.labels)}
+
+    def __len__(self):
+        return self.frame_count
+
+    def __contains__(self, name):
+        return name in self._index
+
+    @property
+    def frame_count(self):
+        return self.positions.shape[0]
+
+    @property
+    def marker_count(self):
+        return self.positions.shape[1]
+
+    @property
+    def nbytes(self):
+        '''Bytes held in RAM, memory mapped (sidecar) and lazy (v7.3) positions are not counted'''
+        if isinstance(self.positions, np.memmap) or not isinstance(self.positions, np.ndarray):
+            return self.segment_ids.nbytes
+        return self.positions.nbytes + self.segment_ids.nbytes
+
+    def index(self, name):
+        return self._index[name]
+
+    def frame(self, i):
+        '''(markers, 3) positions of every marker at frame i'''
+        return self.positions[i]
+
+    def series(self, name):
+        '''(frames, 3) view of one marker over the whole trial'''
+        return self.positions[:, self._index[name]]
+
+    def point_names(self):
+        '''Names of the mocap points (everything that is not a COM)'''
+        return [name for name, seg in zip(self.labels, self.segment_ids) if seg != COM_SEGMENT_ID]
+
+    def com_names(self):
+        return [name for name, seg in zip(self.labels, self.segment_ids) if seg == COM_SEGMENT_ID]
+
+    def as_dict(self, names=None):
+        '''name => (frames, 3) view for each name, no data is copied'''
+        if names is None:
+            names = self.labels
+        return {name: self.series(name) for name in names}
+
+    def coms(self):
+        return self.as_dict(self.com_names())
+
+    def select(self, p_filter=()):
+        '''New store without the markers named in p_filter'''
+        if not p_filter:
+            return self
+        keep = [i for i, name in enumerate(self.labels) if name not in p_filter]
+        positions = self.positions[:, keep]
+        if isinstance(positions, np.ndarray):
+            positions = np.ascontiguousarray(positions)
+        return TrialStore(positions,
+                          [self.labels[i] for i in keep], self.segment_ids[keep])
+
+    def undersample(self, framerate):
+        '''Every framerate-th frame (a view, nothing is copied)'''
+        return TrialStore(self.positions[::framerate], self.labels, self.segment_ids)
+
+class LazyPositions:
+    '''(frames, markers, 3) positions read on demand from one Nx3 column per marker
+    Columns only need len() and [start:stop:step] slicing (matHdf5.LazyArray for v7.3 files)
+    Slicing frames/markers gives another lazy view, anything else reads just the frames asked for
+    With marker_axis False it is a single marker shaped (frames, 3), which is what TrialStore.series hands out'''
+
+    dtype = np.dtype(np.float32)
+
+    def __init__(self, columns, frames=None, marker_axis=True):
+        self.columns = list(columns)
+        if frames is None:
+            frames = range(max((len(c) for c in self.columns), default=0))
+        self.frames = frames
+        self.marker_axis = marker_axis
+
+    @property
+    def shape(self):
+        if self.marker_axis:
+            return (len(self.frames), len(self.columns), 3)
+        return (len(self.frames), 3)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __array__(self, dtype=None, copy=None):
+        out = self._read(self.frames, self.columns)
+        if not self.marker_axis:
+            out = out[:, 0]
+        return out if dtype is None else out.astype(dtype)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        frames = key[0]
+        if not self.marker_axis:
+            rest = key[1:]
+            if isinstance(frames, slice) and not rest:
+                return LazyPositions(self.columns, self.frames[frames], marker_axis=False)
+            out = self._read(self._frames(frames), self.columns)[:, 0]
+            return self._finish(out, frames, rest)
+
+        markers = key[1] if len(key) > 1 else slice(None)
+        if isinstance(frames, slice) and len(key) <= 2:
+            #stays lazy: undersampling, filtering markers or picking one marker series
+            if isinstance(markers, (int, np.integer)):
+                return LazyPositions([self.columns[markers]], self.frames[frames], marker_axis=False)
+            return LazyPositions(self._columns(markers), self.frames[frames])
+        out = self._read(self._frames(frames), self._columns(markers))
+        if isinstance(markers, (int, np.integer)):
+            out = out[:, 0]
+        return self._finish(out, frames, key[2:])
+
+    def _frames(self, frames):
+        if isinstance(frames, (int, np.integer)):
+            return [self.frames[frames]]
+        if isinstance(frames, slice):
+            return self.frames[frames]
+        return [self.frames[i] for i in frames]
+
+    def _columns(self, markers):
+        if isinstance(markers, (int, np.integer)):
+            return [self.columns[markers]]
+        if isinstance(markers, slice):
+            return self.columns[markers]
+        return [self.columns[i] for i in markers]
+
+    @staticmethod
+    def _finish(out, frames, rest):
+        if isinstance(frames, (int, np.integer)):
+            out = out[0]
+        if rest:
+            out = out[(Ellipsis,) + tuple(rest)]
+        return out
+
+    def _read(self, frames, columns):
+        '''Read the given frames of every column into a (frames, columns, 3) float32 array (NaN past a column's end)'''
+        out = np.full((len(frames), len(columns), 3), np.nan, dtype=np.float32)
+        if len(frames) == 0:
+            return out
+        for i, column in enumerate(columns):
+            if isinstance(frames, range) and frames.step > 0:
+                stop = min(frames.stop, len(column))
+                if frames.start < stop:
+                    block = np.asarray(column[frames.start:stop:frames.step])
+                    out[:len(block), i] = block[:, :3]
+            else:
+                for j, f in enumerate(frames):
+                    if f < len(column):
+                        out[j, i] = np.asarray(column[f])[:3]
+        return out
+
+def build_trial_store(MocapData, SegCOM):
+    '''Pack the MocapData and SegCOM dicts (name => Nx3) into one TrialStore
+    Mocap points get segment id index + 1 and COMs get COM_SEGMENT_ID, same as the old Segment_ID column
+    Lazy columns (v7.3 files) stay lazy, see LazyPositions'''
+    names = list(MocapData) + list(SegCOM)
+    arrays = [MocapData[name] for name in MocapData] + [SegCOM[name] for name in SegCOM]
+    segment_ids = np.array([i + 1 for i in range(len(MocapData))] + [COM_SEGMENT_ID] * len(SegCOM), dtype=np.int32)
+    if not all(isinstance(a, np.ndarray) for a in arrays):
+        return TrialStore(LazyPositions(arrays), names, segment_ids)
+    frames = max((len(a) for a in arrays), default=0)
+
+    positions = np.full((frames, len(arrays), 3), np.nan, dtype=np.float32)
+    for i, a in enumerate(arrays):
+        a = np.asarray(a)
+        positions[:len(a), i] = a[:, :3]
+
+    return TrialStore(positions, names, segment_ids)
@@ -0,0 +1,168 @@
+import json
+import os
+import tempfile
+import threading
+try:
+    import fcntl
+except ImportError: #Windows, there is no multi-worker server there so every process just watches
+    fcntl = None
+
+from trialBatch import trial_name
+
+#Capture folder to watch for new trials, nothing is watched when it isn't set
+WATCH_DIR = os.environ.get('BIOMECHVIS_WATCH_DIR', '')
+#Seconds between two looks at the folder, the page asks for the trial list this often too
+WATCH_POLL_S = 2.0
+#Files in the shared dir: the lock the watching process holds and the trial list it publishes for the others
+WATCH_LOCK = 'trial-watcher.lock'
+WATCH_STATE = 'trial-watcher.state'
+
+def scan(folder):
+    '''(size, mtime) of every .mat file with a kind in its name under folder, by absolute path'''
+    found = {}
+    for dirpath, _, filenames in os.walk(folder):
+        for filename in filenames:
+            if not filename.casefold().endswith('.mat') or trial_name(filename) is None:
+                continue
+            path = os.path.abspath(os.path.join(dirpath, filename))
+            try:
+                stat = os.stat(path)
+            except OSError: #removed between the listing and the stat
+                continue
+            found[path] = (stat.st_size, stat.st_mtime_ns)
+    return found
+
+class TrialWatcher:
+    '''Watches a capture folder and ingests the trials that land in it while the app runs
+    A thread looks at the folder every poll seconds, files that are new or changed are handed to ingest(paths)
+    (which parses them into trial_cache) once they stopped changing for one poll, so files still being written
+    are left alone. Unchanged files are never handed over again
+    version goes up every time the trial list changes, the page compares it to know when to refresh
+    Threads don't survive a fork, call start() in the process that serves the requests (it is a no-op when running)
+    With shared_dir set (wsgi.py workers, background jobs) only the process holding a lock file in it watches and
+    publishes the trial list and version there, the others read them from it and take over if it exits'''
+
+    def __init__(self, folder, ingest, poll=WATCH_POLL_S, shared_dir=None):
+        self.folder = folder
+        self.ingest = ingest
+        self.poll = poll
+        self.shared_dir = shared_dir
+        self._version = 0
+        self._seen = {} # path => (size, mtime) when last ingested
+        self._pending = {} # path => (size, mtime) at the previous look, not ingested yet
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._pid = os.getpid()
+        self._lock_file = None # open while this process is the one watching
+        self._state_key = None # (mtime, size) of the published state last read
+
+    @property
+    def version(self):
+        self._read_state()
+        return self._version
+
+    def start(self):
+        if self._pid != os.getpid(): #forked, the thread and the lock stayed in the parent
+            if self._lock_file is not None:
+                self._lock_file.close()
+            self._pid, self._thread, self._lock_file = os.getpid(), None, None
+        if self._thread is not None and self._thread.is_alive():
+            return self
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='trial-watcher', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _watching(self):
+        return not self.shared_dir or fcntl is None or self._lock_file is not None
+
+    def _elect(self):
+        '''True if this process watches the folder, it tries to take the lock file when it doesn't yet'''
+        if self._watching():
+            return True
+        os.makedirs(self.shared_dir, exist_ok=True)
+        f = open(os.path.join(self.shared_dir, WATCH_LOCK), 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError: #another process watches
+            f.close()
+            return False
+        self._read_state() #carry on from the list and version of the process that watched before
+        self._lock_file = f
+        return True
+
+    def _publish(self):
+        '''Write the trial list and version to the shared dir for the processes that don't watch'''
+        if not self.shared_dir:
+            return
+        with self._lock:
+            state = {'version': self._version, 'seen': {path: list(key) for path, key in self._seen.items()}}
+        fd, tmp = tempfile.mkstemp(dir=self.shared_dir, prefix='.tmp-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, os.path.join(self.shared_dir, WATCH_STATE))
+
+    def _read_state(self):
+        '''Pick up the trial list and version published by the watching process (nothing when this one watches)'''
+        if self._watching():
+            return
+        try:
+            path = os.path.join(self.shared_dir, WATCH_STATE)
+            stat = os.stat(path)
+            if (stat.st_mtime_ns, stat.st_size) == self._state_key:
+                return
+            with open(path) as f:
+                state = json.load(f)
+            with self._lock:
+                self._seen = {path: tuple(key) for path, key in state['seen'].items()}
+                self._version = state['version']
+            self._state_key = (stat.st_mtime_ns, stat.st_size)
+        except (OSError, ValueError, KeyError): #nothing published yet
+            return
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self._elect():
+                    self.check()
+            except Exception as error: #keep watching, the next look retries the files that failed
+                print("watch error", type(error).__name__, error)
+            self._stop.wait(self.poll)
+
+    def check(self):
+        '''Look at the folder once, ingest what settled since the last look. Returns the paths ingested'''
+        found = scan(self.folder) if os.path.isdir(self.folder) else {}
+        with self._lock:
+            settled = [path for path, key in found.items() if self._seen.get(path) != key and self._pending.get(path) == key]
+            self._pending = {path: key for path, key in found.items() if self._seen.get(path) != key}
+            gone = [path for path in self._seen if path not in found]
+        if settled:
+            self.ingest(settled)
+        with self._lock:
+            for path in settled:
+                self._seen[path] = self._pending.pop(path)
+            for path in gone:
+                del self._seen[path]
+            changed = bool(settled or gone)
+            if changed:
+                self._version += 1
+        if changed:
+            self._publish()
+        return settled
+
+    def trials(self):
+        '''{trial name: paths} of every ingested trial, named by their folder under the watched one and file name
+        (capture/s01/Dunk_mocapData.mat is trial s01/Dunk)'''
+        self._read_state()
+        with self._lock:
+            paths = sorted(self._seen)
+        trials = {}
+        for path in paths:
+            relative = os.path.relpath(os.path.dirname(path), self.folder)
+            name = trial_name(path) or os.path.basename(os.path.dirname(path))
+            trials.setdefault(os.path.normpath(os.path.join(relative, name)), []).append(path)
+        return trials
@@ -0,0 +1,54 @@
+import base64
+import hashlib
+import os
+import tempfile
+
+from diskBudget import prune, touch
+from sessionStore import SESSION_TTL
+
+#Uploaded files are written here, under the original file name so the kind can still be told from it
+SPOOL_DIR = os.environ.get('BIOMECHVIS_SPOOL_DIR', os.path.join(os.path.expanduser('~'), '.biomechvis', 'uploads'))
+#base64 characters decoded at a time (a multiple of 4), so the decoded file is never all in memory at once
+CHUNK = 4 * 1024 * 1024
+#Uploads past this many GB (or unused for SPOOL_MAX_AGE_S) are deleted least recently used first,
+#never ones used within a session's lifetime (SESSION_TTL)
+SPOOL_MAX_GB = float(os.environ.get('BIOMECHVIS_SPOOL_MAX_GB', 20))
+SPOOL_MAX_AGE_S = 30 * 24 * 3600
+
+def spool_upload(filename, contents, spool_dir=None):
+    '''Write one dcc.Upload file (a base64 data URL) to the spool folder and return its path
+    Files are stored by content hash, uploading the same bytes again returns the same path with the same mtime
+    so the parsed trial, sidecars (matSidecar.py) and trial_cache entries are all reused'''
+    spool_dir = spool_dir or SPOOL_DIR
+    os.makedirs(spool_dir, exist_ok=True)
+    start = contents.index(',') + 1 #skip "data:<type>;base64,"
+    digest = hashlib.sha1()
+    fd, tmp = tempfile.mkstemp(dir=spool_dir, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for at in range(start, len(contents), CHUNK):
+                block = base64.b64decode(contents[at:at + CHUNK])
+                digest.update(block)
+                f.write(block)
+        folder = os.path.join(spool_dir, digest.hexdigest()[:16])
+        path = os.path.join(folder, os.path.basename(filename))
+        if os.path.exists(path):
+            os.remove(tmp)
+            touch(folder)
+        else:
+            os.makedirs(folder, exist_ok=True)
+            os.replace(tmp, path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    prune(spool_dir, SPOOL_MAX_GB * 1024 ** 3, SPOOL_MAX_AGE_S, SESSION_TTL)
+    return path
+
+def touch_uploads(paths, spool_dir=None):
+    '''Mark the spooled uploads among paths as used, so prune keeps them while a session works on them
+    (only the folder is touched, the file keeps the mtime its cache keys were made with)'''
+    spool_dir = os.path.abspath(spool_dir or SPOOL_DIR)
+    for folder in {os.path.dirname(os.path.abspath(p)) for p in paths}:
+        if os.path.dirname(folder) == spool_dir:
+            touch(folder)
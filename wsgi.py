@@ -0,0 +1,25 @@
+'''Production serving: the BiomechVis Dash app as a WSGI application for a multi-worker server
+
+    BIOMECHVIS_FILES=trial/Dunk_mocapData.mat:trial/Dunk_SegCOM.mat:trial/Dunk_AnatAx.mat gunicorn -w 4 --preload wsgi:server
+
+BIOMECHVIS_FILES are the launch files (what the Browse window picks), separated by os.pathsep (; on Windows)
+--preload parses them once before the workers are forked
+Every parsed and derived array is memory mapped from its sidecar (matSidecar.py) so all workers share one copy
+in the page cache, and sessions are shared through BIOMECHVIS_SESSION_DIR (sessionStore.py) so any worker can
+answer any browser tab
+'''
+import os
+
+import biomechVis
+from sessionStore import SESSION_DIR
+
+biomechVis.filesList = biomechVis.files_by_kind([f for f in os.environ.get('BIOMECHVIS_FILES', '').split(os.pathsep) if f])
+if not biomechVis.filesList['MocapData']:
+    raise RuntimeError("BIOMECHVIS_FILES needs at least one mocap data file")
+biomechVis.sessions.shared_dir = SESSION_DIR
+
+#parse (or map) the launch trial now, with --preload that happens once in the master
+biomechVis.read_Mitchell_data(biomechVis.frameRate, biomechVis.filesList)
+
+app = biomechVis.create_app()
+server = app.server